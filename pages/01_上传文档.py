@@ -11,8 +11,16 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入模块
 from src.utils import generate_document_id, get_document_metadata, delete_document
-from src.pdf_processor import save_pdf, process_pdf_with_magic, get_markdown_content
+from src.pdf_processor import save_pdf, get_markdown_content, get_output_name
 from src.auth import get_user_data_path, get_system_config
+from src.task_queue import (
+    submit_task,
+    get_task,
+    get_document_task,
+    is_task_active,
+    TASK_DONE,
+    TASK_STATUS_LABELS,
+)
 
 # 处理markdown中的图片，转换为base64编码
 def process_markdown_images(markdown_content: str, base_dir: str) -> str:
@@ -75,6 +83,16 @@ def process_markdown_images(markdown_content: str, base_dir: str) -> str:
         st.error(f"处理markdown图片时出错: {str(e)}")
         return markdown_content
 
+# 轮询显示转换任务进度，任务结束后刷新整个页面
+@st.fragment(run_every=2)
+def show_conversion_status(task_id: str, filename: str):
+    task = get_task(task_id)
+    if not is_task_active(task):
+        st.rerun()
+
+    st.text(f"{filename} 转换{TASK_STATUS_LABELS[task['status']]}：{task.get('message', '')}")
+    st.progress(task.get("progress", 0) / 100)
+
 # 设置页面
 st.set_page_config(
     page_title="上传文档",
@@ -120,39 +138,45 @@ with st.expander("上传新文档", expanded=True):
 
             # 处理按钮
             if st.button("处理文档"):
-                with st.spinner("正在处理文档..."):
-                    # 生成文档ID
-                    doc_id = generate_document_id()
-
-                    # 保存PDF文件
-                    st.write("保存文件...")
-                    success, result = save_pdf(user_id, uploaded_file, doc_id)
-                    
-                    if not success:
-                        st.error(f"保存文件失败: {result}")
-                        st.stop()
-                    
-                    pdf_path = result
-                    st.write(f"文件已保存：{pdf_path}")
-
-                    # 处理PDF
-                    st.write("使用magic-pdf处理文件...")
-                    success, result = process_pdf_with_magic(user_id, pdf_path, doc_id)
+                # 生成文档ID
+                doc_id = generate_document_id()
 
-                    if not success:
-                        st.error(f"处理文件失败: {result}")
-                        st.stop()
-
-                    result_dir = result
-                    st.success(f"文件处理完成！结果保存在：{result_dir}")
-
-                    # 获取markdown内容
-                    success, content = get_markdown_content(user_id, doc_id)
-
-                    if success:
-                        st.session_state.current_doc_id = doc_id
-                        st.session_state.current_content = content
-                        st.rerun()
+                # 保存PDF文件
+                success, result = save_pdf(user_id, uploaded_file, doc_id)
+                
+                if not success:
+                    st.error(f"保存文件失败: {result}")
+                    st.stop()
+
+                # 提交后台转换任务，页面不再阻塞等待 magic-pdf 处理完成
+                submit_task("convert", user_id, doc_id)
+                st.session_state.setdefault("submitted_conversions", []).append(doc_id)
+                st.rerun()
+
+# 显示本会话提交的转换任务
+for submitted_doc_id in list(st.session_state.get("submitted_conversions", [])):
+    convert_task = get_document_task(user_id, submitted_doc_id, "convert")
+    if convert_task is None:
+        st.session_state.submitted_conversions.remove(submitted_doc_id)
+        continue
+
+    submitted_metadata = get_document_metadata(user_id, submitted_doc_id) or {}
+    submitted_filename = submitted_metadata.get("filename", "未知文件")
+
+    if is_task_active(convert_task):
+        show_conversion_status(convert_task["task_id"], submitted_filename)
+        continue
+
+    # 任务结束：显示一次结果，成功时打开预览
+    st.session_state.submitted_conversions.remove(submitted_doc_id)
+    if convert_task["status"] == TASK_DONE:
+        st.success(f"{submitted_filename}：{convert_task['message']}")
+        success, content = get_markdown_content(user_id, submitted_doc_id)
+        if success:
+            st.session_state.current_doc_id = submitted_doc_id
+            st.session_state.current_content = content
+    else:
+        st.error(f"{submitted_filename}：{convert_task['message']}")
 
 # 显示用户已有文档
 st.subheader("我的文档")
@@ -256,7 +280,7 @@ if "current_doc_id" in st.session_state and "current_content" in st.session_stat
     filename = metadata.get("filename", "未知文件") if metadata else "未知文件"
 
     # 获取markdown文件所在目录，用于处理图片路径
-    pdf_name_without_ext = os.path.splitext(filename)[0]
+    pdf_name_without_ext = get_output_name(metadata or {}) or os.path.splitext(filename)[0]
     user_output_dir = get_user_data_path(user_id, "output")
     markdown_dir = os.path.join(
         user_output_dir,
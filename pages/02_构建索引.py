@@ -8,8 +8,25 @@ from datetime import datetime
 # 添加项目根目录到Python路径
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from src.utils import get_user_documents, is_document_indexed, is_document_processed
-from src.build_index import build_index_for_document
+from src.utils import get_user_documents, is_document_indexed, is_document_indexable
+from src.task_queue import (
+    submit_task,
+    get_task,
+    get_document_task,
+    is_task_active,
+    TASK_DONE,
+    TASK_STATUS_LABELS,
+)
+
+# 轮询显示后台任务进度，任务结束后刷新整个页面
+@st.fragment(run_every=2)
+def show_active_task_status(task_id: str):
+    task = get_task(task_id)
+    if not is_task_active(task):
+        st.rerun()
+
+    st.text(f"索引任务{TASK_STATUS_LABELS[task['status']]}：{task.get('message', '')}")
+    st.progress(task.get("progress", 0) / 100)
 
 # 设置页面
 st.set_page_config(
@@ -33,8 +50,8 @@ st.write(f"欢迎，{st.session_state.username}！您现在可以在此处为已
 # 获取用户文档列表
 user_docs = get_user_documents(user_id)
 
-# 过滤已处理但未索引的文档
-processed_docs = [doc for doc in user_docs if is_document_processed(user_id, doc["doc_id"])]
+# 过滤已处理的文档（包括上次索引构建失败、可以重试的文档）
+processed_docs = [doc for doc in user_docs if is_document_indexable(user_id, doc["doc_id"])]
 
 if not processed_docs:
     st.info("您还没有处理完成的文档，请先上传并处理文档")
@@ -66,7 +83,9 @@ else:
         already_indexed = next((doc for doc in processed_docs if doc["doc_id"] == selected_doc_id), {}).get("indexed", False)
 
         # 构建索引按钮
+        incremental = False
         if already_indexed:
+            incremental = st.checkbox("增量更新", value=True, help="只处理内容发生变化的分块，未变化的分块沿用原有索引")
             if st.button("重新构建索引", help="文档已索引，但您可以重新构建"):
                 st.warning("正在重新构建索引...")
                 start_indexing = True
@@ -78,28 +97,20 @@ else:
             else:
                 start_indexing = False
 
-        # 构建索引
+        # 提交后台索引任务（任务在后台线程池中执行，页面刷新不会中断，并发数受系统配置限制）
         if start_indexing:
-            # 创建进度条
-            progress_text = st.empty()
-            progress_bar = st.progress(0)
-
-            # 进度条回调函数
-            def update_progress(message, percent):
-                progress_text.text(message)
-                progress_bar.progress(percent / 100)
-
-            # 开始构建索引
-            with st.spinner("正在构建索引..."):
-                success, result = build_index_for_document(user_id, selected_doc_id, update_progress)
-
-                if success:
-                    st.success(result)
-                    # 等待1秒显示成功消息
-                    time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(result)
+            submit_task("build_index", user_id, selected_doc_id, incremental=incremental)
+
+        # 显示所选文档最近一次索引任务的状态
+        index_task = get_document_task(user_id, selected_doc_id, "build_index")
+        if is_task_active(index_task):
+            show_active_task_status(index_task["task_id"])
+        elif index_task and index_task["task_id"] not in st.session_state.get("acknowledged_tasks", set()):
+            if index_task["status"] == TASK_DONE:
+                st.success(index_task["message"])
+            else:
+                st.error(index_task["message"])
+            st.session_state.setdefault("acknowledged_tasks", set()).add(index_task["task_id"])
 
 # 显示已索引文档
 indexed_docs = [doc for doc in user_docs if is_document_indexed(user_id, doc["doc_id"])]
@@ -12,11 +12,17 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # 导入模块
 from src.utils import get_user_documents, is_document_indexed, get_document_metadata
 from src.retriever import (
-    find_source_references,
-    get_source_nodes_from_index,
+    find_source_references_shared,
+    get_source_node_lookup,
     match_source_references,
-    load_document_engines
+    load_document_engines,
+    seed_chat_history,
+    stream_chat_shared
 )
+from src.stream_renderer import StreamRenderer
+from src.citation import StreamingCitationMatcher, resolve_streamed_references
+from src.answer_cache import get_cached_answer, save_cached_answer, update_cached_references
+from src.content_store import get_content_key
 
 # 设置页面
 st.set_page_config(
@@ -57,6 +63,10 @@ if "source_query_engines" not in st.session_state:
 if "source_indices" not in st.session_state:
     st.session_state.source_indices = {}
 
+# 初始化 BM25 索引（本地引用匹配）
+if "bm25_indices" not in st.session_state:
+    st.session_state.bm25_indices = {}
+
 # 初始化引用功能开关
 if "enable_reference" not in st.session_state:
     st.session_state.enable_reference = True
@@ -80,6 +90,7 @@ if "last_indexed_doc_id" in st.session_state:
             if st.session_state.enable_reference and "source_index" in result:
                 st.session_state.source_indices[st.session_state.selected_doc_id] = result["source_index"]
                 st.session_state.source_query_engines[st.session_state.selected_doc_id] = result["source_query_engine"]
+                st.session_state.bm25_indices[st.session_state.selected_doc_id] = result.get("bm25_index")
             
             # 确保当前文档有聊天历史
             if st.session_state.selected_doc_id not in st.session_state.chat_histories:
@@ -142,6 +153,7 @@ with st.sidebar:
                 if st.session_state.enable_reference and "source_index" in result:
                     st.session_state.source_indices[selected_doc_id] = result["source_index"]
                     st.session_state.source_query_engines[selected_doc_id] = result["source_query_engine"]
+                    st.session_state.bm25_indices[selected_doc_id] = result.get("bm25_index")
                 
                 st.success("文档加载成功！")
             else:
@@ -170,6 +182,7 @@ with st.sidebar:
             if st.session_state.enable_reference and "source_index" in result:
                 st.session_state.source_indices[selected_doc_id] = result["source_index"]
                 st.session_state.source_query_engines[selected_doc_id] = result["source_query_engine"]
+                st.session_state.bm25_indices[selected_doc_id] = result.get("bm25_index")
         
         st.rerun()
 
@@ -189,6 +202,9 @@ current_doc_id = st.session_state.selected_doc_id
 current_chat_engine = st.session_state.chat_engines[current_doc_id]
 current_source_query_engine = st.session_state.source_query_engines.get(current_doc_id)
 current_source_index = st.session_state.source_indices.get(current_doc_id)
+current_bm25_index = st.session_state.bm25_indices.get(current_doc_id)
+# 相同问题的合并按内容标识进行，不同用户各自上传的同一篇论文也能共享一次调用
+current_doc_key = get_content_key(user_id, current_doc_id)
 
 # 获取当前文档的聊天历史
 current_chat_history = st.session_state.chat_histories[current_doc_id]
@@ -211,6 +227,9 @@ for message in current_chat_history:
 
 # 用户输入
 if prompt := st.chat_input("请输入您的问题"):
+    # 只有会话的第一个问题使用答案缓存（后续问题的回答依赖对话上下文）
+    is_first_turn = not current_chat_history
+
     # 添加用户消息到历史
     current_chat_history.append({"role": "user", "content": prompt})
 
@@ -224,40 +243,76 @@ if prompt := st.chat_input("请输入您的问题"):
         full_response = ""
 
         try:
-            # 使用流式模式获取回答
-            streaming_response = current_chat_engine.stream_chat(prompt)
-            
-            # 流式处理响应
-            for token in streaming_response.response_gen:
-                full_response += token
-                message_placeholder.markdown(full_response + "▌")
-                time.sleep(0.01)
-
-            # 显示最终完整回答（去掉光标）
-            message_placeholder.markdown(full_response)
+            cached_answer = get_cached_answer(user_id, current_doc_id, prompt) if is_first_turn else None
+            citation_matcher = None
+
+            if cached_answer:
+                # 命中答案缓存：直接显示，并写入聊天引擎的记忆，保证后续追问有上下文
+                full_response = cached_answer["answer"]
+                seed_chat_history(current_chat_engine, prompt, full_response)
+                message_placeholder.markdown(full_response)
+            else:
+                # 使用流式模式获取回答（其他会话同时提出相同问题时共享同一次调用）
+                streaming_response = stream_chat_shared(current_chat_engine, current_doc_key, prompt)
+
+                # 有 BM25 索引时边生成边匹配已完整的句子，回答结束时参考基本已就绪
+                if st.session_state.enable_reference and current_bm25_index is not None:
+                    citation_matcher = StreamingCitationMatcher(current_bm25_index)
+
+                # 流式处理响应（片段按帧合并后再刷新页面，不再逐片段重新渲染整段回答）
+                renderer = StreamRenderer(message_placeholder)
+                for token in streaming_response:
+                    renderer.append(token)
+                    if citation_matcher is not None:
+                        citation_matcher.feed(token)
+
+                # 显示最终完整回答（去掉光标）
+                full_response = renderer.finish()
             
             # 查找源文本参考
             references = []
+            references_checked = False
             if st.session_state.enable_reference and current_source_query_engine and current_source_index:
-                with st.spinner("正在查找原文参考..."):
-                    # 查找源文本参考片段
-                    source_list = find_source_references(current_source_query_engine, full_response)
-                    
-                    # 获取源文本节点
-                    source_nodes = get_source_nodes_from_index(current_source_index)
-                    
-                    # 匹配源文本参考
-                    references = match_source_references(source_list, source_nodes)
+                references_checked = True
+                if cached_answer and cached_answer["references"] is not None:
+                    references = cached_answer["references"]
+                else:
+                    with st.spinner("正在查找原文参考..."):
+                        # 查找源文本参考片段
+                        if citation_matcher is not None:
+                            source_list = resolve_streamed_references(
+                                citation_matcher, current_doc_key, current_source_query_engine, full_response
+                            )
+                        else:
+                            source_list = find_source_references_shared(
+                                current_doc_key, current_source_query_engine, full_response, current_bm25_index
+                            )
+                        
+                        # 获取源文本节点编号查找表（加载索引时已构建）
+                        source_node_lookup = get_source_node_lookup(current_source_index)
+                        
+                        # 匹配源文本参考
+                        references = match_source_references(source_list, source_node_lookup)
+
+                    if cached_answer:
+                        update_cached_references(user_id, current_doc_id, cached_answer["key"], references)
                     
-                    # 显示源文本参考
-                    if references:
-                        with st.expander("查看原文参考"):
-                            for i, ref in enumerate(references):
-                                st.markdown(f"**<span style='color:red;'>参考 {i+1}</span>**:", unsafe_allow_html=True)
-                                st.markdown(f"\n{ref['node_text']}\n")
-                    else:
-                        with st.expander("查看原文参考"):
-                            st.info("未找到与回答直接相关的原文参考。")
+                # 显示源文本参考
+                if references:
+                    with st.expander("查看原文参考"):
+                        for i, ref in enumerate(references):
+                            st.markdown(f"**<span style='color:red;'>参考 {i+1}</span>**:", unsafe_allow_html=True)
+                            st.markdown(f"\n{ref['node_text']}\n")
+                else:
+                    with st.expander("查看原文参考"):
+                        st.info("未找到与回答直接相关的原文参考。")
+
+            # 缓存第一个问题的回答和参考
+            if is_first_turn and not cached_answer:
+                save_cached_answer(
+                    user_id, current_doc_id, prompt, full_response,
+                    references if references_checked else None
+                )
 
             # 添加助手消息到历史（包含源文本参考）
             current_chat_history.append({
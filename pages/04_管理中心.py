@@ -13,6 +13,9 @@ from src.admin import (
     update_system_config, toggle_registration, get_usage_statistics
 )
 from src.auth import is_admin, get_system_config
+from src.engine_cache import get_engine_cache_stats
+from src.embedding_cache import get_embedding_cache_stats
+from src.retriever import get_single_flight_stats, get_citation_stats
 
 # 设置页面标题
 st.set_page_config(
@@ -191,6 +194,10 @@ elif menu == "系统设置":
         # 显示和修改设置
         new_max_documents = st.number_input("每个用户最大文档数量", min_value=1, value=max_documents)
         new_max_size = st.number_input("每个文档最大大小 (MB)", min_value=1, value=max_size)
+        # Streamlit 在读入上传文件前按 server.maxUploadSize 拒绝，超过它的设置不会生效
+        upload_limit_mb = st.get_option("server.maxUploadSize")
+        if new_max_size > upload_limit_mb:
+            st.warning(f"上传文件大小还受 .streamlit/config.toml 中 server.maxUploadSize（当前 {upload_limit_mb}MB）限制，请同步修改后重启应用")
         new_max_tasks = st.number_input("最大并发处理任务数", min_value=1, value=max_tasks)
 
         # 更新按钮
@@ -265,6 +272,33 @@ elif menu == "使用统计":
     # 显示存储表格
     st.dataframe(storage_df.set_index("目录"))
 
+    # 索引缓存情况
+    st.subheader("索引缓存")
+    cache_stats = get_engine_cache_stats()
+    st.write(f"缓存条目: {cache_stats['entries']} / {cache_stats['max_entries']}")
+    st.write(f"内存占用（估算）: {humanize.naturalsize(cache_stats['memory_bytes'])} / {humanize.naturalsize(cache_stats['max_memory_bytes'])}")
+    st.write(f"命中率: {cache_stats['hit_rate'] * 100:.1f}% （命中 {cache_stats['hits']}，未命中 {cache_stats['misses']}）")
+    st.write(f"淘汰次数: {cache_stats['evictions']}，失效次数: {cache_stats['invalidations']}")
+
+    # 嵌入缓存情况
+    st.subheader("嵌入缓存")
+    embedding_stats = get_embedding_cache_stats()
+    st.write(f"缓存条目: {embedding_stats['entries']} / {embedding_stats['max_entries']}（{humanize.naturalsize(embedding_stats['db_size_bytes'])}）")
+    st.write(f"命中率: {embedding_stats['hit_rate'] * 100:.1f}% （命中 {embedding_stats['hits']}，未命中 {embedding_stats['misses']}）")
+    st.write(f"淘汰次数: {embedding_stats['evictions']}")
+
+    # 请求合并情况
+    st.subheader("请求合并")
+    flight_stats = get_single_flight_stats()
+    st.write(f"进行中的上游调用: {flight_stats['in_flight']}")
+    st.write(f"上游调用次数: {flight_stats['calls']}，合并的请求数: {flight_stats['coalesced']}")
+
+    # 本地引用匹配情况
+    st.subheader("本地引用匹配")
+    citation_stats = get_citation_stats()
+    st.write(f"本地匹配成功: {citation_stats['matched']}，未匹配回退: {citation_stats['fallback']}，无可匹配内容直接使用大模型: {citation_stats['skipped']}")
+    st.write(f"回退到大模型的比例: {citation_stats['fallback_rate'] * 100:.1f}%")
+
     # 刷新按钮
     if st.button("刷新统计数据"):
         st.rerun()
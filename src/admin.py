@@ -98,7 +98,9 @@ def delete_user(user_id: str) -> Tuple[bool, str]:
         if admin_count <= 1:
             return False, "不能删除最后一个活跃的管理员账户，至少需要一个管理员账户"
         
-    # 删除用户数据目录
+    # 移除用户文档对共享存储的引用，再删除用户数据目录
+    from src.content_store import release_user_references
+    release_user_references(user_id)
     for dir_type in ["data", "output", "storage"]:
         user_dir = os.path.join(dir_type, user_id)
         if os.path.exists(user_dir):
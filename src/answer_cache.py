@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import time
+import unicodedata
+from typing import Any, ContextManager, Dict, List, Optional
+
+import numpy as np
+
+from src.auth import get_system_config, get_user_data_path
+from src.content_store import get_store_dir
+from src.file_lock import file_lock
+from src.utils import get_document_metadata
+
+
+# 答案缓存文件名（内容相同的文档共用共享存储中的一份，旧文档保存在用户的数据目录中）
+ANSWER_CACHE_FILE = "answer_cache.json"
+
+# 默认缓存设置（可通过 db/system_config.json 覆盖）
+DEFAULT_MAX_ENTRIES = 100
+DEFAULT_TTL_HOURS = 168
+# 问题嵌入的相似度阈值，0 表示只按规范化后的问题文本精确匹配
+DEFAULT_SIMILARITY_THRESHOLD = 0
+
+TRAILING_PUNCTUATION = "?？。.!！~～ "
+
+
+def normalize_question(question: str) -> str:
+    """
+    规范化问题文本：统一全角半角和大小写，合并空白，去掉结尾的标点
+
+    参数：
+        question: 问题
+
+    返回：
+        规范化后的问题
+    """
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(TRAILING_PUNCTUATION)
+
+def get_answer_cache_path(user_id: str, doc_id: str) -> str:
+    """
+    获取文档的答案缓存文件路径
+
+    内容相同的文档（包括不同用户各自上传的同一篇论文）共用同一个索引，答案缓存也保存在共享存储中，
+    一个用户问过的问题其他用户可以直接命中；没有内容哈希的旧文档保存在用户自己的数据目录
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        答案缓存文件路径
+    """
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    content_hash = metadata.get("content_hash")
+    if content_hash:
+        return os.path.join(get_store_dir(content_hash), ANSWER_CACHE_FILE)
+    return os.path.join(get_user_data_path(user_id, "data"), doc_id, ANSWER_CACHE_FILE)
+
+def _answer_cache_lock(user_id: str, doc_id: str) -> ContextManager[bool]:
+    """答案缓存文件的进程间锁（应用和问答服务的多个工作进程都会读写，不可重入）"""
+    return file_lock(get_answer_cache_path(user_id, doc_id) + ".lock")
+
+def _get_index_time(user_id: str, doc_id: str) -> Optional[str]:
+    """获取文档当前索引的构建时间，用于判断缓存是否对应当前索引"""
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    return metadata.get("index_time")
+
+def _load_answer_cache(user_id: str, doc_id: str) -> Dict[str, Any]:
+    """加载答案缓存，索引已重建或文件损坏时返回空缓存"""
+    index_time = _get_index_time(user_id, doc_id)
+    empty = {"index_time": index_time, "entries": {}}
+
+    path = get_answer_cache_path(user_id, doc_id)
+    if not os.path.exists(path):
+        return empty
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return empty
+
+    if cache.get("index_time") != index_time:
+        return empty
+    return cache
+
+def _save_answer_cache(user_id: str, doc_id: str, cache: Dict[str, Any]) -> None:
+    """保存答案缓存（调用方需持有锁；先写临时文件再替换，读取方不会读到写了一半的文件）"""
+    path = get_answer_cache_path(user_id, doc_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def _remove_expired(entries: Dict[str, Any]) -> None:
+    """删除超过有效期的缓存项"""
+    ttl_seconds = (get_system_config("answer_cache_ttl_hours") or DEFAULT_TTL_HOURS) * 3600
+    now = time.time()
+    for key in [k for k, entry in entries.items() if now - entry["created_at"] > ttl_seconds]:
+        del entries[key]
+
+def _get_similarity_threshold() -> float:
+    return get_system_config("answer_cache_similarity_threshold") or DEFAULT_SIMILARITY_THRESHOLD
+
+def _embed_question(question: str) -> Optional[List[float]]:
+    """计算问题的嵌入（经过本地嵌入缓存），失败时返回None"""
+    try:
+        from src.model_clients import get_embed_model
+        return get_embed_model().get_query_embedding(question)
+    except Exception as e:
+        print(f"计算问题嵌入失败: {str(e)}")
+        return None
+
+def _find_similar(entries: Dict[str, Any], embedding: List[float], threshold: float) -> Optional[str]:
+    """在缓存中查找与问题嵌入最相似且超过阈值的缓存项"""
+    keys = [key for key, entry in entries.items() if entry.get("embedding")]
+    if not keys:
+        return None
+
+    matrix = np.asarray([entries[key]["embedding"] for key in keys], dtype=np.float32)
+    query = np.asarray(embedding, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+    norms[norms == 0] = 1.0
+    scores = (matrix @ query) / norms
+
+    best = int(np.argmax(scores))
+    return keys[best] if scores[best] >= threshold else None
+
+def _touch_entry(user_id: str, doc_id: str, cache: Dict[str, Any], key: str) -> Dict[str, Any]:
+    """记录缓存项的命中并返回其答案（调用方需持有锁）"""
+    entry = cache["entries"][key]
+    entry["last_used"] = time.time()
+    entry["hits"] = entry.get("hits", 0) + 1
+    _save_answer_cache(user_id, doc_id, cache)
+    return {"key": key, "answer": entry["answer"], "references": entry.get("references")}
+
+def get_cached_answer(user_id: str, doc_id: str, question: str) -> Optional[Dict[str, Any]]:
+    """
+    查找问题的缓存答案：先按规范化后的问题精确匹配，配置了相似度阈值时再按问题嵌入匹配
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        question: 问题
+
+    返回：
+        {"key": 缓存键, "answer": 回答, "references": 源文本参考列表或None}，未命中时返回None
+    """
+    key = normalize_question(question)
+    if not key:
+        return None
+
+    with _answer_cache_lock(user_id, doc_id):
+        cache = _load_answer_cache(user_id, doc_id)
+        _remove_expired(cache["entries"])
+        if key in cache["entries"]:
+            return _touch_entry(user_id, doc_id, cache, key)
+        if not cache["entries"]:
+            return None
+
+    threshold = _get_similarity_threshold()
+    if not threshold:
+        return None
+
+    # 嵌入在锁外计算，避免网络请求阻塞其他会话
+    embedding = _embed_question(question)
+    if embedding is None:
+        return None
+
+    with _answer_cache_lock(user_id, doc_id):
+        cache = _load_answer_cache(user_id, doc_id)
+        _remove_expired(cache["entries"])
+        similar_key = _find_similar(cache["entries"], embedding, threshold)
+        if similar_key is None:
+            return None
+        return _touch_entry(user_id, doc_id, cache, similar_key)
+
+def save_cached_answer(user_id: str, doc_id: str, question: str, answer: str,
+                       references: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    保存问题的答案到缓存，超出容量时淘汰最久未使用的缓存项
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        question: 问题
+        answer: 回答
+        references: 已匹配的源文本参考（未查找参考时为None）
+    """
+    key = normalize_question(question)
+    if not key or not answer:
+        return
+
+    embedding = _embed_question(question) if _get_similarity_threshold() else None
+
+    with _answer_cache_lock(user_id, doc_id):
+        cache = _load_answer_cache(user_id, doc_id)
+        entries = cache["entries"]
+        _remove_expired(entries)
+
+        now = time.time()
+        entries[key] = {
+            "question": question,
+            "answer": answer,
+            "references": references,
+            "embedding": embedding,
+            "created_at": now,
+            "last_used": now,
+            "hits": 0,
+        }
+
+        max_entries = get_system_config("answer_cache_max_entries") or DEFAULT_MAX_ENTRIES
+        while len(entries) > max_entries:
+            oldest_key = min(entries, key=lambda k: entries[k]["last_used"])
+            del entries[oldest_key]
+
+        _save_answer_cache(user_id, doc_id, cache)
+
+def update_cached_references(user_id: str, doc_id: str, key: str, references: List[Dict[str, Any]]) -> None:
+    """为缓存答案补充源文本参考（缓存时未开启引用功能的情况），key 为 get_cached_answer 返回的缓存键"""
+    with _answer_cache_lock(user_id, doc_id):
+        cache = _load_answer_cache(user_id, doc_id)
+        if key in cache["entries"]:
+            cache["entries"][key]["references"] = references
+            _save_answer_cache(user_id, doc_id, cache)
+
+def invalidate_answer_cache(user_id: str, doc_id: str) -> None:
+    """
+    删除文档的答案缓存（重建索引后调用，内容相同的文档共用的缓存一并删除）
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+    """
+    with _answer_cache_lock(user_id, doc_id):
+        path = get_answer_cache_path(user_id, doc_id)
+        if os.path.exists(path):
+            os.remove(path)
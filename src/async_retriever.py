@@ -0,0 +1,70 @@
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from llama_index.core.base.llms.types import ChatMessage
+
+from src.provider_limits import provider_slot
+from src.retriever import (
+    build_source_query,
+    load_document_engines,
+    match_source_references_locally,
+    parse_source_references,
+)
+
+
+async def aload_document_engines(user_id: str, doc_id: str, enable_reference: bool = True) -> Tuple[bool, Dict[str, Any]]:
+    """
+    load_document_engines 的异步版本，在线程池中加载索引，不阻塞事件循环
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        enable_reference: 是否启用引用功能，默认为True
+
+    返回：
+        (是否成功, 包含索引和引擎的字典或错误消息)
+    """
+    return await asyncio.to_thread(load_document_engines, user_id, doc_id, enable_reference)
+
+async def astream_chat(chat_engine, question: str, chat_history: Optional[List[ChatMessage]] = None) -> AsyncIterator[str]:
+    """
+    异步流式问答，整个回答生成期间占用一个大模型并发名额
+
+    参数：
+        chat_engine: 聊天引擎
+        question: 用户问题
+        chat_history: 之前的对话（为None时使用聊天引擎自身的会话记忆）
+
+    返回：
+        回答片段的异步迭代器
+    """
+    async with provider_slot("llm"):
+        streaming_response = await chat_engine.astream_chat(question, chat_history=chat_history)
+        async for token in streaming_response.async_response_gen():
+            yield token
+
+async def afind_source_references(source_query_engine, response_text: str, bm25_index=None) -> list:
+    """
+    find_source_references_with_fallback 的异步版本：有 BM25 索引时先在本地匹配，匹配不到时再调用大模型
+
+    参数：
+        source_query_engine: 源文本查询引擎
+        response_text: 回复内容
+        bm25_index: 文档的 BM25 索引，为None时直接使用大模型
+
+    返回：
+        源文本参考列表（节点编号）
+    """
+    if bm25_index is not None:
+        source_list = await asyncio.to_thread(match_source_references_locally, bm25_index, response_text)
+        if source_list:
+            return source_list
+
+    try:
+        async with provider_slot("llm"):
+            source_response = await source_query_engine.aquery(build_source_query(response_text))
+        return parse_source_references(source_response.response)
+
+    except Exception as e:
+        print(f"查找源文本参考失败: {str(e)}")
+        return []
@@ -0,0 +1,152 @@
+import json
+import time
+import asyncio
+import argparse
+from typing import Any, Dict, Optional, TextIO
+
+from src.retriever import get_source_node_lookup, match_source_references
+from src.async_retriever import (
+    aload_document_engines,
+    astream_chat,
+    afind_source_references,
+)
+from src.provider_limits import set_provider_rate_limit
+
+
+DEFAULT_CONCURRENCY = 8
+
+
+async def answer_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    回答一条批量问答记录
+
+    参数：
+        record: {"user_id": 用户ID, "doc_id": 文档ID, "question": 问题, "references": 是否查找参考（默认是）}
+
+    返回：
+        结果记录：原记录字段加上 answer、references、latency（各阶段耗时，秒）或 error
+    """
+    result = dict(record)
+    latency: Dict[str, float] = {}
+    result["latency"] = latency
+    started = time.perf_counter()
+
+    try:
+        user_id, doc_id, question = record["user_id"], record["doc_id"], record["question"]
+    except KeyError as e:
+        result["error"] = f"缺少字段: {e.args[0]}"
+        return result
+
+    enable_reference = bool(record.get("references", True))
+
+    try:
+        stage_started = time.perf_counter()
+        success, engines = await aload_document_engines(user_id, doc_id, enable_reference)
+        latency["load"] = round(time.perf_counter() - stage_started, 3)
+        if not success:
+            result["error"] = engines
+            return result
+
+        # 每条记录单独提问，不使用答案缓存，保证评测结果反映当前模型的回答
+        stage_started = time.perf_counter()
+        parts = []
+        async for token in astream_chat(engines["chat_engine"], question, []):
+            if not parts:
+                latency["first_token"] = round(time.perf_counter() - stage_started, 3)
+            parts.append(token)
+        latency["generate"] = round(time.perf_counter() - stage_started, 3)
+        result["answer"] = "".join(parts)
+
+        if enable_reference and "source_query_engine" in engines:
+            stage_started = time.perf_counter()
+            source_list = await afind_source_references(
+                engines["source_query_engine"], result["answer"], engines.get("bm25_index")
+            )
+            result["references"] = match_source_references(
+                source_list, get_source_node_lookup(engines["source_index"])
+            )
+            latency["references"] = round(time.perf_counter() - stage_started, 3)
+
+    except Exception as e:
+        result["error"] = f"处理问题时出错：{str(e)}"
+
+    finally:
+        latency["total"] = round(time.perf_counter() - started, 3)
+
+    return result
+
+async def run_batch(input_file: TextIO, output_file: TextIO, concurrency: int = DEFAULT_CONCURRENCY) -> Dict[str, int]:
+    """
+    并发处理 JSONL 输入中的问答记录，每完成一条就写入输出 JSONL（按完成顺序）
+
+    参数：
+        input_file: 输入文件，每行一条记录
+        output_file: 输出文件
+        concurrency: 同时处理的记录数
+
+    返回：
+        {"total": 记录数, "failed": 失败数}
+    """
+    queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"total": 0, "failed": 0}
+
+    def write(result: Dict[str, Any]) -> None:
+        output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_file.flush()
+        stats["total"] += 1
+        if "error" in result:
+            stats["failed"] += 1
+            print(f"[{result.get('line')}] 失败: {result['error']}")
+        else:
+            print(f"[{result.get('line')}] 完成，耗时 {result['latency']['total']}s")
+
+    async def worker() -> None:
+        while True:
+            record = await queue.get()
+            if record is None:
+                break
+            write(await answer_record(record))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    # 逐行读取输入，队列满时等待，避免一次性读入全部记录
+    for line_number, line in enumerate(input_file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            write({"line": line_number, "error": f"无效的JSON: {str(e)}"})
+            continue
+        if not isinstance(record, dict):
+            write({"line": line_number, "error": "每行必须是JSON对象"})
+            continue
+        record["line"] = line_number
+        await queue.put(record)
+
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量论文问答")
+    parser.add_argument("--input", required=True, help="输入 JSONL 文件，每行包含 user_id、doc_id、question")
+    parser.add_argument("--output", required=True, help="输出 JSONL 文件")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="同时处理的问题数")
+    parser.add_argument("--llm-rpm", type=float, default=None, help="大模型每分钟请求数上限（默认读取系统配置）")
+    parser.add_argument("--embedding-rpm", type=float, default=None, help="嵌入接口每分钟请求数上限（默认读取系统配置）")
+    args = parser.parse_args()
+
+    if args.llm_rpm is not None:
+        set_provider_rate_limit("llm", args.llm_rpm)
+    if args.embedding_rpm is not None:
+        set_provider_rate_limit("embedding", args.embedding_rpm)
+
+    started = time.perf_counter()
+    with open(args.input, "r", encoding="utf-8") as input_file, open(args.output, "w", encoding="utf-8") as output_file:
+        stats = asyncio.run(run_batch(input_file, output_file, max(1, args.concurrency)))
+
+    print(f"共处理 {stats['total']} 条，失败 {stats['failed']} 条，耗时 {time.perf_counter() - started:.1f}s")
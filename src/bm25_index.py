@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import math
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.auth import get_system_config
+
+
+# BM25 索引文件名（保存在源文本索引目录中）
+BM25_INDEX_FILE = "bm25.json"
+
+# 答案句子的关键词至少有这一比例出现在分块中才视为引用
+DEFAULT_MIN_COVERAGE = 0.5
+
+# 英文停用词（不参与打分）
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "which", "with", "we", "our",
+}
+
+# 句子至少有这么多个可匹配的检索词才参与匹配
+MIN_MATCH_TERMS = 3
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*|[一-鿿]+")
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[。！？!?；;])|(?<=\.)\s+|\n+")
+# 回答中引用的原文片段（中英文引号、直角引号）
+QUOTE_PATTERN = re.compile(r"“([^”]+)”|\"([^\"]+)\"|「([^」]+)」|『([^』]+)』")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    将文本切分为检索词：英文按单词（去停用词），中文按单字和相邻双字
+
+    参数：
+        text: 文本
+
+    返回：
+        检索词列表
+    """
+    tokens = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if is_cjk(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        elif word not in STOPWORDS and len(word) > 1:
+            tokens.append(word)
+    return tokens
+
+def is_cjk(term: str) -> bool:
+    """检索词是否为中文"""
+    return "一" <= term[0] <= "鿿"
+
+def get_min_coverage() -> float:
+    """获取系统配置的句子关键词最低覆盖率"""
+    return get_system_config("bm25_min_coverage") or DEFAULT_MIN_COVERAGE
+
+def split_sentences(text: str) -> List[str]:
+    """将回答切分为句子"""
+    return [s.strip() for s in SENTENCE_SPLIT_PATTERN.split(text) if s.strip()]
+
+
+class BM25Index:
+    """单个文档的 BM25 倒排索引，用于在本地将回答句子匹配到源文本分块"""
+
+    def __init__(self, node_numbers: List[Any], doc_lengths: List[int], postings: Dict[str, List[List[int]]],
+                 k1: float = 1.5, b: float = 0.75):
+        self.node_numbers = node_numbers
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        self._is_cjk_document: Optional[bool] = None
+
+    @property
+    def is_cjk_document(self) -> bool:
+        """文档正文是否以中文为主（按中文单字和英文单词的出现次数比较）"""
+        if self._is_cjk_document is None:
+            cjk_count = latin_count = 0
+            for term, entries in self.postings.items():
+                # 中文的相邻双字与单字重复计数，只统计单字
+                if is_cjk(term):
+                    if len(term) == 1:
+                        cjk_count += sum(frequency for _, frequency in entries)
+                else:
+                    latin_count += sum(frequency for _, frequency in entries)
+            self._is_cjk_document = cjk_count > latin_count
+        return self._is_cjk_document
+
+    def match_terms(self, sentence: str) -> List[str]:
+        """
+        取出回答句子中可以和文档分块匹配的检索词
+
+        回答通常是中文，而论文原文多为英文，中文检索词与英文分块没有交集，
+        只会拉低覆盖率。因此句子中有引号引用的原文片段时只用引用片段匹配；
+        文档以英文为主时只保留句子中的英文单词和数字（术语、模型名、数据集、指标等）
+
+        参数：
+            sentence: 回答中的句子
+
+        返回：
+            去重后的检索词列表，少于 MIN_MATCH_TERMS 个时返回空列表
+        """
+        quoted = " ".join(next(group for group in match if group) for match in QUOTE_PATTERN.findall(sentence))
+        terms = list(dict.fromkeys(tokenize(quoted)))
+        if len(terms) < MIN_MATCH_TERMS:
+            terms = list(dict.fromkeys(tokenize(sentence)))
+        if not self.is_cjk_document:
+            terms = [term for term in terms if not is_cjk(term)]
+        return terms if len(terms) >= MIN_MATCH_TERMS else []
+
+    def has_matchable_text(self, response_text: str) -> bool:
+        """回答中是否有可以在本地匹配的句子（没有时不必尝试本地匹配）"""
+        return any(self.match_terms(sentence) for sentence in split_sentences(response_text))
+
+    @classmethod
+    def from_nodes(cls, nodes: List[Any]) -> "BM25Index":
+        """
+        从源文本节点构建索引
+
+        参数：
+            nodes: 带有 node_number 元数据的节点列表
+
+        返回：
+            BM25Index 对象
+        """
+        node_numbers, doc_lengths = [], []
+        postings: Dict[str, List[List[int]]] = {}
+
+        for doc_index, node in enumerate(nodes):
+            tokens = tokenize(node.get_content())
+            node_numbers.append(node.metadata.get("node_number"))
+            doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append([doc_index, frequency])
+
+        return cls(node_numbers, doc_lengths, postings)
+
+    def _idf(self, term: str) -> float:
+        doc_freq = len(self.postings.get(term, ()))
+        total = len(self.doc_lengths)
+        return math.log(1 + (total - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def search(self, query: str, top_k: int = 1) -> List[Tuple[Any, float, float]]:
+        """
+        检索与查询最相关的分块
+
+        参数：
+            query: 查询文本
+            top_k: 返回的分块数
+
+        返回：
+            [(node_number, BM25得分, 关键词覆盖率), ...]，按得分降序
+        """
+        return self._search_terms(set(tokenize(query)), top_k)
+
+    def _search_terms(self, terms: set, top_k: int) -> List[Tuple[Any, float, float]]:
+        if not terms or not self.doc_lengths:
+            return []
+
+        scores: Dict[int, float] = {}
+        matched: Counter = Counter()
+        for term in terms:
+            idf = self._idf(term)
+            for doc_index, frequency in self.postings.get(term, ()):
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_index] / (self.avg_length or 1)
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                matched[doc_index] += 1
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(self.node_numbers[i], score, matched[i] / len(terms)) for i, score in ranked]
+
+    def match_references(self, response_text: str, min_coverage: Optional[float] = None) -> List[Any]:
+        """
+        将回答逐句与源文本分块匹配，返回引用的节点编号
+
+        参数：
+            response_text: 回答内容
+            min_coverage: 句子关键词在分块中的最低覆盖率，默认读取系统配置
+
+        返回：
+            节点编号列表（按回答中出现的顺序）
+        """
+        if min_coverage is None:
+            min_coverage = get_min_coverage()
+
+        source_list = []
+        for sentence in split_sentences(response_text):
+            node_number = self.match_sentence(sentence, min_coverage)
+            if node_number is not None and node_number not in source_list:
+                source_list.append(node_number)
+        return source_list
+
+    def match_sentence(self, sentence: str, min_coverage: float) -> Optional[Any]:
+        """
+        将单个句子与源文本分块匹配
+
+        参数：
+            sentence: 回答中的句子
+            min_coverage: 句子关键词在分块中的最低覆盖率
+
+        返回：
+            匹配的节点编号，未匹配时返回None
+        """
+        # 可匹配的检索词过少的句子（如"综上所述"，或不含英文术语的中文句子）没有足够的区分度
+        terms = self.match_terms(sentence)
+        if not terms:
+            return None
+        for node_number, _, coverage in self._search_terms(set(terms), top_k=1):
+            if coverage >= min_coverage:
+                return node_number
+        return None
+
+    def estimate_size(self) -> int:
+        """估算占用的内存（字节）"""
+        return sum(len(term) * 2 + len(entries) * 72 for term, entries in self.postings.items())
+
+    def save(self, path: str) -> None:
+        """保存索引到JSON文件（先写临时文件再替换，加载方不会读到写了一半的文件）"""
+        temp_path = f"{path}.tmp-{os.getpid()}"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "k1": self.k1,
+                "b": self.b,
+                "node_numbers": self.node_numbers,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings,
+            }, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """从JSON文件加载索引"""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["node_numbers"], data["doc_lengths"], data["postings"], data["k1"], data["b"])
+
+
+def get_bm25_index_path(source_dir: str) -> str:
+    """获取源文本索引目录中 BM25 索引文件的路径"""
+    return os.path.join(source_dir, BM25_INDEX_FILE)
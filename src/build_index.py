@@ -1,20 +1,22 @@
 import os
 import sys
-import shutil
 import datetime
 import argparse
 import re
+import hashlib
+import json
+import time
 import streamlit as st
 
-from typing import List, Dict, Any, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Tuple
 from llama_index.core import (
     VectorStoreIndex,
-    SimpleDirectoryReader,
     Document,
     ListIndex,
     Settings,
     )
-from llama_index.embeddings.dashscope import DashScopeEmbedding
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.schema import TextNode
 from llama_index.core.ingestion import IngestionPipeline
@@ -23,29 +25,153 @@ from dotenv import load_dotenv
 
 from src.utils import (
     get_document_metadata,
+    save_document_metadata,
     update_document_status,
     update_document_index_status,
-    is_document_processed,
+    is_document_indexable,
+    INDEXABLE_STATUSES,
     )
-from src.auth import get_user_data_path
+from src.auth import get_user_data_path, get_system_config
+from src.engine_cache import invalidate_document_cache
+from src.answer_cache import invalidate_answer_cache
+from src.content_store import index_lock, share_index
+from src.model_clients import setup_embed_model
+from src.markdown_splitter import MinerUMarkdownSplitter
+from src.bm25_index import BM25Index, get_bm25_index_path
+from src.compact_store import (
+    DEFAULT_INDEX_STORAGE_FORMAT,
+    get_index_storage_format,
+    get_node_embedding,
+    has_persisted_index,
+    load_persisted_index,
+    persist_index,
+)
 
 load_dotenv("../.env")
 
 
-Settings.embed_model = DashScopeEmbedding(
-    model="text-embedding-v3",
-    api_key=os.getenv("ALI_API_KEY"),
-    api_base=os.getenv("ALI_API_BASE"),
-)
+# 源文本索引模式："list" 为列表索引（引用查找时所有分块都交给大模型），
+# "vector" 为向量索引（构建时存储分块嵌入，引用查找时只取 top-k 候选分块）
+SOURCE_INDEX_MODES = ("list", "vector")
+DEFAULT_SOURCE_INDEX_MODE = "list"
+
+def get_source_index_mode() -> str:
+    """获取系统配置的源文本索引模式"""
+    mode = get_system_config("source_index_mode") or DEFAULT_SOURCE_INDEX_MODE
+    if mode not in SOURCE_INDEX_MODES:
+        raise ValueError(f"不支持的源文本索引模式: {mode}")
+    return mode
+
+# 源文本切分方式："sentence" 为按句子切分，"markdown" 为按 MinerU markdown 结构切分
+SOURCE_SPLITTERS = ("sentence", "markdown")
+DEFAULT_SOURCE_SPLITTER = "sentence"
+
+def get_source_splitter_name() -> str:
+    """获取系统配置的源文本切分方式"""
+    splitter = get_system_config("source_splitter") or DEFAULT_SOURCE_SPLITTER
+    if splitter not in SOURCE_SPLITTERS:
+        raise ValueError(f"不支持的源文本切分方式: {splitter}")
+    return splitter
+
+def get_source_splitter():
+    """根据系统配置创建源文本切分器"""
+    if get_source_splitter_name() == "markdown":
+        # 按章节、表格、公式和图注对齐切分，分块带章节路径和字符偏移
+        return MinerUMarkdownSplitter(chunk_size=512)
+    return SentenceSplitter(chunk_size=512, chunk_overlap=30)
+
+# 元数据中记录的索引配置在旧元数据缺失时的取值（引入这些配置之前只有一种方式）
+INDEX_SETTING_DEFAULTS = {
+    "source_index_mode": DEFAULT_SOURCE_INDEX_MODE,
+    "source_splitter": DEFAULT_SOURCE_SPLITTER,
+    "index_storage_format": DEFAULT_INDEX_STORAGE_FORMAT,
+}
 
 class addNodeNumberer(TransformComponent):
-    """为每个节点添加编号元数据"""
+    """为每个节点添加整数编号元数据"""
 
     def __call__(self, nodes, **kwargs):
         for i, node in enumerate(nodes, start=1):
-            node.metadata["node_number"] = f"node{i}"
+            node.metadata["node_number"] = i
         return nodes
 
+def parse_node_number(value: Any) -> Optional[int]:
+    """
+    将节点编号解析为整数，兼容旧索引中的 "node12" 字符串和大模型返回的 "node12"/"12"
+
+    参数：
+        value: 节点编号
+
+    返回：
+        整数编号，无法解析时返回None
+    """
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().lower()
+    if text.startswith("node"):
+        text = text[4:]
+    return int(text) if text.isdigit() else None
+
+def _content_hash(text: str) -> str:
+    """计算文本内容的哈希值"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _merge_with_persisted_nodes(new_nodes: List[TextNode], source_dir: str) -> Tuple[List[TextNode], Dict[str, int]]:
+    """
+    将新切分的分块与已持久化的源文本索引按内容哈希对比，
+    未变化的分块沿用原节点ID、node_number和嵌入，只有新增分块需要重新编号和嵌入
+
+    参数：
+        new_nodes: 新切分出的分块（尚未编号）
+        source_dir: 源文本索引存储路径
+
+    返回：
+        (合并后的节点列表, {"reused": 复用数, "added": 新增数, "removed": 删除数})
+    """
+    stats = {"reused": 0, "added": 0, "removed": 0}
+
+    if not has_persisted_index(source_dir):
+        # 没有可复用的旧索引，全部重新编号
+        addNodeNumberer()(new_nodes)
+        stats["added"] = len(new_nodes)
+        return new_nodes, stats
+
+    old_index = load_persisted_index(source_dir)
+
+    # 按内容哈希分组旧节点（同一内容可能出现多次）
+    old_nodes_by_hash = defaultdict(list)
+    max_number = 0
+    for old_node in old_index.docstore.docs.values():
+        old_nodes_by_hash[_content_hash(old_node.get_content())].append(old_node)
+        max_number = max(max_number, parse_node_number(old_node.metadata.get("node_number")) or 0)
+
+    reassigned_ids = {}
+    for node in new_nodes:
+        bucket = old_nodes_by_hash.get(_content_hash(node.get_content()))
+        if bucket:
+            old_node = bucket.pop(0)
+            reassigned_ids[node.node_id] = old_node.node_id
+            node.id_ = old_node.node_id
+            node.metadata["node_number"] = parse_node_number(old_node.metadata["node_number"])
+            # 旧索引为列表索引时没有存储嵌入，返回None
+            node.embedding = get_node_embedding(old_index, old_node.node_id)
+            stats["reused"] += 1
+        else:
+            # 新分块使用不与旧编号冲突的新编号
+            max_number += 1
+            node.metadata["node_number"] = max_number
+            stats["added"] += 1
+
+    # 相邻分块之间的 PREVIOUS/NEXT 等关系仍指向切分时生成的ID，改为沿用后的ID
+    for node in new_nodes:
+        for related in node.relationships.values():
+            for info in related if isinstance(related, list) else [related]:
+                if info.node_id in reassigned_ids:
+                    info.node_id = reassigned_ids[info.node_id]
+
+    stats["removed"] = sum(len(bucket) for bucket in old_nodes_by_hash.values())
+    return new_nodes, stats
+
 def get_index_storage_path(user_id: str, doc_id: str) -> Tuple[str, str]:
     """
     获取索引存储路径
@@ -68,8 +194,7 @@ def get_index_storage_path(user_id: str, doc_id: str) -> Tuple[str, str]:
     full_text_dir = os.path.join(doc_storage_dir, "full_text")
     source_dir = os.path.join(doc_storage_dir, "source")
 
-    os.makedirs(full_text_dir, exist_ok=True)
-    os.makedirs(source_dir, exist_ok=True)
+    # 两个索引目录是指向最新版本目录的符号链接，在保存索引时创建（见 persist_index）
 
     return full_text_dir, source_dir
 
@@ -112,21 +237,40 @@ def get_index_storage_path(user_id: str, doc_id: str) -> Tuple[str, str]:
 
 #     return full_text_index, source_index
 
-def build_index_for_document(user_id: str, doc_id: str, progress_callback=None) -> Tuple[bool, str]:
+def build_index_for_document(user_id: str, doc_id: str, progress_callback=None, incremental: bool = False) -> Tuple[bool, str]:
     """
     为特定用户的特定文档构建索引
 
+    内容相同的文档共享同一个索引目录，构建期间持有该内容的索引构建锁，多个用户同时重建时依次进行；
+    后进行的构建读取到前一次构建同步过来的元数据，增量构建时内容未变化直接返回
+
     参数：
         user_id: 用户ID
         doc_id: 文档ID
         progress_callback: 进程回调函数
+        incremental: 是否增量构建（与已有索引按内容哈希对比，只处理变化的分块）
 
     返回：
         (是否成功, 结果消息)
     """
+    content_hash = (get_document_metadata(user_id, doc_id) or {}).get("content_hash")
+    if not content_hash:
+        return _build_index_for_document(user_id, doc_id, progress_callback, incremental)
+
+    with index_lock(content_hash, blocking=False) as acquired:
+        if acquired:
+            return _build_index_for_document(user_id, doc_id, progress_callback, incremental)
+
+    if progress_callback:
+        progress_callback("相同内容的文档正在构建索引，等待其完成...", 5)
+    with index_lock(content_hash):
+        return _build_index_for_document(user_id, doc_id, progress_callback, incremental)
+
+def _build_index_for_document(user_id: str, doc_id: str, progress_callback=None, incremental: bool = False) -> Tuple[bool, str]:
+    """build_index_for_document 的实际构建过程（调用方持有内容的索引构建锁）"""
     try:
-        # 检查文档是否已处理
-        if not is_document_processed(user_id, doc_id):
+        # 检查文档是否已处理（上次索引构建失败的文档可以重试）
+        if not is_document_indexable(user_id, doc_id):
             return False, "文档尚未处理完成，无法构建索引"
 
         # 获取文档元数据
@@ -134,8 +278,12 @@ def build_index_for_document(user_id: str, doc_id: str, progress_callback=None)
         if not metadata:
             return False, "无法获取文档元数据" 
         
-        # 获取markdown文件路径
-        from src.pdf_processor import get_markdown_content
+        # 获取markdown文件路径和内容
+        from src.pdf_processor import get_markdown_path, get_markdown_content
+        success, markdown_path = get_markdown_path(user_id, doc_id)
+        if not success:
+            return False, f"获取文档内容失败: {markdown_path}"
+
         success, markdown_content = get_markdown_content(user_id, doc_id)
 
         if not success:
@@ -144,70 +292,137 @@ def build_index_for_document(user_id: str, doc_id: str, progress_callback=None)
         # 更新文档状态为索引构建中
         update_document_status(user_id, doc_id, "索引构建中")
         
-        # 创建临时文件保存markdown内容
         if progress_callback:
             progress_callback("准备文档内容...", 10)
 
+        # 使用进程级共享的嵌入模型（外层包装本地缓存，未变化的分块不再重复请求接口）
+        setup_embed_model()
+
         # 获取索引存储路径
         full_text_dir, source_dir = get_index_storage_path(user_id, doc_id)
 
-        # 创建临时目录存放markdown文件
-        import tempfile
-        temp_dir = tempfile.mkdtemp()
-        try:
-            # 将markdown内容写入临时文件
-            temp_file_path = os.path.join(temp_dir, f"{doc_id}.md")
-            with open(temp_file_path, "w", encoding="utf-8") as f:
-                f.write(markdown_content)
+        markdown_hash = _content_hash(markdown_content)
+        source_index_mode = get_source_index_mode()
+        # 影响索引内容的配置，任一项与上次构建时不同都需要重建（旧元数据没有记录时按当时的默认值）
+        index_settings = {
+            "source_index_mode": source_index_mode,
+            "source_splitter": get_source_splitter_name(),
+            "index_storage_format": get_index_storage_format(),
+        }
+        settings_unchanged = all(
+            metadata.get(key, INDEX_SETTING_DEFAULTS[key]) == value for key, value in index_settings.items()
+        )
+        full_text_unchanged = (
+            incremental
+            and metadata.get("markdown_hash") == markdown_hash
+            and has_persisted_index(full_text_dir)
+        )
+
+        # 内容和索引配置都没有变化时无需重建
+        if full_text_unchanged and settings_unchanged:
+            if has_persisted_index(source_dir):
+                # 引入 BM25 之前构建的索引没有 BM25 文件，由已保存的源文本节点补建到当前版本目录
+                bm25_path = get_bm25_index_path(os.path.realpath(source_dir))
+                if not os.path.exists(bm25_path):
+                    source_nodes = list(load_persisted_index(source_dir).docstore.docs.values())
+                    BM25Index.from_nodes(source_nodes).save(bm25_path)
+                    invalidate_document_cache(user_id, doc_id)
+                update_document_status(user_id, doc_id, "处理完成")
+                # 索引没有重建，保留原来的 index_time，答案缓存（包括共享此索引的其他文档）继续有效
+                if not metadata.get("indexed") or not metadata.get("index_time"):
+                    update_document_index_status(user_id, doc_id, True)
+                if progress_callback:
+                    progress_callback("文档内容未变化，索引已是最新", 100)
+                return True, "文档内容未变化，索引已是最新"
 
-            if progress_callback:
-                progress_callback("加载文档...", 30)
+        if progress_callback:
+            progress_callback("加载文档...", 30)
+
+        # 直接由内存中的markdown内容构建文档，不再写入临时文件后重新读取；
+        # 元数据保持稳定（不含随机的临时路径），嵌入缓存和增量构建才能命中
+        documents = [
+            Document(
+                text=markdown_content,
+                metadata={"file_name": f"{doc_id}.md"},
+                excluded_embed_metadata_keys=["file_name"],
+                excluded_llm_metadata_keys=["file_name"],
+            )
+        ]
 
-            # 加载文档
-            documents = SimpleDirectoryReader(temp_dir).load_data()
+        if progress_callback:
+            # 旧流程需要写入一次临时文件、再读取一次，共两次完整拷贝
+            markdown_size = os.path.getsize(markdown_path)
+            progress_callback(f"已从内存加载文档（节省 2 次拷贝，{markdown_size * 2 / 1024:.1f} KB 磁盘读写）", 35)
 
-            if not documents:
-                return False, "无法加载文档内容"
-            
-            # 创建全文索引（不分割，用于传递给大模型进行问答）
-            if progress_callback:
-                progress_callback("构建全文索引...", 50)
+        # 创建全文索引（不分割，用于传递给大模型进行问答）
+        if progress_callback:
+            progress_callback("构建全文索引...", 50)
 
+        if not full_text_unchanged:
             full_text_parser = SentenceSplitter(chunk_size=1000000, chunk_overlap=50)
             full_text_nodes = full_text_parser.get_nodes_from_documents(documents)
             full_text_index = ListIndex(full_text_nodes)
 
             # 保存全文索引
-            full_text_index.storage_context.persist(persist_dir=full_text_dir)
+            persist_index(full_text_index, full_text_dir)
 
-            if progress_callback:
-                progress_callback("构建源文本索引...", 70)
+        if progress_callback:
+            progress_callback("构建源文本索引...", 70)
 
-            # 创建源文本索引（分割成小块，用于匹配答案来源）
+        # 创建源文本索引（分割成小块，用于匹配答案来源）
+        merge_stats = None
+        if incremental:
+            # 增量模式：先切分，再与旧索引对比复用未变化的节点
+            source_pipeline = IngestionPipeline(
+                transformations=[get_source_splitter()]
+            )
+            source_nodes = source_pipeline.run(documents=documents)
+            source_nodes, merge_stats = _merge_with_persisted_nodes(source_nodes, source_dir)
+        else:
             source_pipeline = IngestionPipeline(
                 transformations=[
-                    SentenceSplitter(chunk_size=512, chunk_overlap=30),
+                    get_source_splitter(),
                     addNodeNumberer(),  # 添加节点编号
                 ]
             )
             source_nodes = source_pipeline.run(documents=documents)
+
+        if source_index_mode == "vector":
+            # 构建时计算分块嵌入，查询时只检索最相关的分块（已带嵌入的复用节点不会重复计算）
+            source_index = VectorStoreIndex(source_nodes)
+        else:
             source_index = ListIndex(source_nodes)
 
-            # 保存源文本索引
-            source_index.storage_context.persist(persist_dir=source_dir)
+        # 保存源文本索引，同时构建 BM25 倒排索引（引用查找可在本地完成而无需调用大模型），与源文本索引一起切换
+        bm25_index = BM25Index.from_nodes(source_nodes)
+        persist_index(source_index, source_dir, lambda version_dir: bm25_index.save(get_bm25_index_path(version_dir)))
 
-            if progress_callback:
-                progress_callback("完成索引构建", 100)
+        if progress_callback:
+            progress_callback("完成索引构建", 100)
 
-            # 更新文档状态为索引完成
-            update_document_status(user_id, doc_id, "处理完成")
-            update_document_index_status(user_id, doc_id, True)
+        # 使进程级缓存中的旧索引和基于旧索引的答案缓存失效
+        invalidate_document_cache(user_id, doc_id)
+        invalidate_answer_cache(user_id, doc_id)
 
-            return True, "索引构建成功"
-        
-        finally:
-            # 清理临时目录
-            shutil.rmtree(temp_dir)
+        # 更新文档状态为索引完成
+        update_document_status(user_id, doc_id, "处理完成")
+        update_document_index_status(user_id, doc_id, True)
+
+        # 记录索引对应的内容哈希和配置，供下次增量构建对比
+        metadata = get_document_metadata(user_id, doc_id) or {}
+        metadata["markdown_hash"] = markdown_hash
+        metadata.update(index_settings)
+        save_document_metadata(user_id, doc_id, metadata)
+
+        # 索引目录由内容相同的文档共享，同步它们的索引状态
+        share_index(user_id, doc_id)
+
+        if merge_stats:
+            return True, (
+                f"索引增量构建成功：复用 {merge_stats['reused']} 个分块，"
+                f"新增 {merge_stats['added']} 个，删除 {merge_stats['removed']} 个"
+            )
+        return True, "索引构建成功"
 
     except Exception as e:
         # 更新文档状态为索引构建失败
@@ -217,12 +432,178 @@ def build_index_for_document(user_id: str, doc_id: str, progress_callback=None)
         return False, f"索引构建失败: {str(e)}"
 
 
+def find_documents_to_index(user_ids: List[str] = None, force: bool = False) -> List[Tuple[str, str]]:
+    """
+    遍历 data/{user_id}/{doc_id}，找出需要构建索引的文档
+
+    参数：
+        user_ids: 只检查这些用户，为None时检查所有用户
+        force: 为True时返回所有已处理完成的文档（用于强制重建），否则只返回未建索引或上次构建失败的文档
+
+    返回：
+        [(用户ID, 文档ID), ...]（内容相同的文档共享索引，只返回其中一个）
+    """
+    data_root = "data"
+    if not os.path.isdir(data_root):
+        return []
+
+    documents = []
+    seen_hashes = set()
+    for user_id in sorted(user_ids or os.listdir(data_root)):
+        user_dir = os.path.join(data_root, user_id)
+        if not os.path.isdir(user_dir):
+            continue
+
+        for doc_id in sorted(os.listdir(user_dir)):
+            if not os.path.isdir(os.path.join(user_dir, doc_id)):
+                continue
+
+            metadata = get_document_metadata(user_id, doc_id)
+            if not metadata or metadata.get("status") not in INDEXABLE_STATUSES:
+                continue
+
+            # 上次构建失败的文档（包括重建失败、仍保留旧索引的文档）总是重试
+            if force or not metadata.get("indexed", False) or metadata["status"] == "索引构建失败":
+                # 共享同一索引目录的文档不能并行构建
+                content_hash = metadata.get("content_hash")
+                if content_hash:
+                    if content_hash in seen_hashes:
+                        continue
+                    seen_hashes.add(content_hash)
+                documents.append((user_id, doc_id))
+
+    return documents
+
+def _index_document_worker(user_id: str, doc_id: str, incremental: bool) -> Tuple[str, str, bool, str, float]:
+    """在子进程中为单个文档构建索引"""
+    start_time = time.time()
+    success, message = build_index_for_document(user_id, doc_id, incremental=incremental)
+    return user_id, doc_id, success, message, time.time() - start_time
+
+def _load_checkpoint(checkpoint_path: str, run_args: Dict[str, Any], documents: List[str]) -> Tuple[set, List[str]]:
+    """
+    加载已完成文档的检查点，只有同一组运行参数、且待处理文档都在检查点记录的文档列表中时才恢复
+
+    参数：
+        checkpoint_path: 检查点文件路径
+        run_args: 本次运行参数（用户、是否强制重建、是否增量）
+        documents: 本次待处理的文档（"user_id/doc_id"）
+
+    返回：
+        (已完成的文档, 本次运行的文档列表)
+    """
+    if not os.path.exists(checkpoint_path):
+        return set(), documents
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        try:
+            checkpoint = json.load(f)
+        except json.JSONDecodeError:
+            return set(), documents
+
+    # 未使用 --force 时已完成的文档不再出现在待处理列表中，因此只要求是原列表的子集
+    recorded = checkpoint.get("documents", [])
+    if checkpoint.get("run_args") != run_args or not set(documents) <= set(recorded):
+        print("检查点来自参数或文档不同的另一次运行，忽略并重新开始")
+        return set(), documents
+    return set(checkpoint.get("completed", [])), recorded
+
+def _save_checkpoint(checkpoint_path: str, completed: set, run_args: Dict[str, Any], documents: List[str]) -> None:
+    """保存已完成文档的检查点"""
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    with open(checkpoint_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "run_args": run_args,
+            "documents": documents,
+            "completed": sorted(completed),
+            "updated_at": datetime.datetime.now().isoformat(),
+        }, f, indent=2)
+
+def build_indexes_in_parallel(
+    documents: List[Tuple[str, str]],
+    workers: int,
+    checkpoint_path: str,
+    incremental: bool = False,
+    run_args: Optional[Dict[str, Any]] = None,
+) -> Tuple[int, int]:
+    """
+    使用进程池批量构建索引，完成一个文档记录一次检查点，以相同参数重新运行时从检查点继续
+
+    参数：
+        documents: [(用户ID, 文档ID), ...]
+        workers: 进程数
+        checkpoint_path: 检查点文件路径
+        incremental: 是否增量构建
+        run_args: 选择文档的运行参数，记录在检查点中，参数不同的运行不会复用检查点
+
+    返回：
+        (成功数, 失败数)
+    """
+    run_args = dict(run_args or {}, incremental=incremental)
+    completed, run_documents = _load_checkpoint(checkpoint_path, run_args, [f"{u}/{d}" for u, d in documents])
+    pending = [(u, d) for u, d in documents if f"{u}/{d}" not in completed]
+    if len(pending) < len(documents):
+        print(f"从检查点恢复：跳过 {len(documents) - len(pending)} 个已完成的文档")
+
+    if not pending:
+        print("没有需要构建索引的文档")
+        return 0, 0
+
+    print(f"开始为 {len(pending)} 个文档构建索引（{workers} 个进程）")
+    succeeded, failed = 0, 0
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_index_document_worker, u, d, incremental) for u, d in pending]
+        for future in as_completed(futures):
+            try:
+                user_id, doc_id, success, message, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[失败] 子进程异常: {str(e)}")
+                continue
+
+            if success:
+                succeeded += 1
+                completed.add(f"{user_id}/{doc_id}")
+                _save_checkpoint(checkpoint_path, completed, run_args, run_documents)
+            else:
+                failed += 1
+
+            done = succeeded + failed
+            elapsed_minutes = max(time.time() - start_time, 1e-6) / 60
+            print(
+                f"[{done}/{len(pending)}] {'成功' if success else '失败'} {user_id}/{doc_id} "
+                f"({seconds:.1f}s): {message} | 吞吐量 {done / elapsed_minutes:.1f} 文档/分钟"
+            )
+
+    # 全部成功后清除检查点，下次运行重新开始；有失败时保留，便于重试失败的文档
+    if failed == 0 and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    elapsed_minutes = max(time.time() - start_time, 1e-6) / 60
+    print(f"完成：成功 {succeeded}，失败 {failed}，耗时 {elapsed_minutes:.1f} 分钟，平均 {len(pending) / elapsed_minutes:.1f} 文档/分钟")
+    return succeeded, failed
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="构建文档索引")
-    parser.add_argument("--dir", type=str, default="../data_2", help="文档目录路径")
-    parser.add_argument("--full_text_persist_dir", type=str, default="../storage/full_text", help="全文索引存储路径")
-    parser.add_argument("--source_persist_dir", type=str, default="../storage/source", help="源文本索引存储路径")
+    parser = argparse.ArgumentParser(description="批量构建文档索引（在项目根目录下运行：python -m src.build_index）")
+    parser.add_argument("--root", type=str, default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help="项目根目录（包含 data/ 和 storage/）")
+    parser.add_argument("--user", type=str, action="append", dest="users", help="只处理指定用户ID的文档，可重复指定")
+    parser.add_argument("--force", action="store_true", help="为所有已处理完成的文档重建索引（包括已建索引的文档）")
+    parser.add_argument("--incremental", action="store_true", help="增量构建，只处理变化的分块")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数，默认使用系统配置的最大并发任务数")
+    parser.add_argument("--checkpoint", type=str, default=os.path.join("db", "build_index_checkpoint.json"), help="检查点文件路径（相对于项目根目录）")
 
     args = parser.parse_args()
 
-    build_index_from_directory(args.dir, args.full_text_persist_dir, args.source_persist_dir)
+    os.chdir(args.root)
+    workers = args.workers or get_system_config("max_concurrent_tasks") or os.cpu_count() or 1
+
+    documents = find_documents_to_index(args.users, force=args.force)
+    print(f"找到 {len(documents)} 个待构建索引的文档")
+
+    run_args = {"users": sorted(args.users) if args.users else None, "force": args.force}
+    _, failed_count = build_indexes_in_parallel(
+        documents, workers, args.checkpoint, incremental=args.incremental, run_args=run_args
+    )
+    sys.exit(1 if failed_count else 0)
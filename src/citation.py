@@ -0,0 +1,95 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from src.bm25_index import BM25Index, SENTENCE_SPLIT_PATTERN, get_min_coverage
+from src.retriever import find_source_references_shared, record_citation_result
+
+
+# 匹配句子的后台线程池（进程级，所有会话共享）
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="citation")
+
+
+class StreamingCitationMatcher:
+    """
+    在回答流式生成的同时查找源文本参考
+
+    每收到一个片段就检查是否有句子已经完整，完整的句子交给后台线程用 BM25 索引匹配源文本分块，
+    回答生成结束时只剩最后一句需要匹配。没有可匹配检索词的句子（如英文论文的中文回答中
+    不含引用片段和英文术语的句子，见 BM25Index.match_terms）不提交给后台线程
+    """
+
+    def __init__(self, bm25_index: BM25Index, min_coverage: Optional[float] = None):
+        self.bm25_index = bm25_index
+        self.min_coverage = get_min_coverage() if min_coverage is None else min_coverage
+
+        self._buffer = ""
+        self._futures: List[Future] = []
+
+    @property
+    def submitted(self) -> int:
+        """已提交匹配的句子数"""
+        return len(self._futures)
+
+    def _submit(self, sentence: str) -> None:
+        sentence = sentence.strip()
+        if sentence and self.bm25_index.match_terms(sentence):
+            self._futures.append(_executor.submit(self.bm25_index.match_sentence, sentence, self.min_coverage))
+
+    def feed(self, token: str) -> None:
+        """接收一个回答片段，把已经完整的句子交给后台线程"""
+        self._buffer += token
+        pieces = SENTENCE_SPLIT_PATTERN.split(self._buffer)
+        if len(pieces) < 2:
+            return
+
+        # 最后一段可能还未结束，留在缓冲区等待后续片段
+        for sentence in pieces[:-1]:
+            if sentence:
+                self._submit(sentence)
+        self._buffer = pieces[-1] or ""
+
+    def finish(self) -> List[Any]:
+        """
+        匹配最后一句并等待所有句子匹配完成
+
+        返回：
+            源文本参考列表（节点编号，按回答中出现的顺序）
+        """
+        self._submit(self._buffer)
+        self._buffer = ""
+
+        source_list = []
+        for future in self._futures:
+            try:
+                node_number = future.result()
+            except Exception as e:
+                print(f"本地匹配源文本参考失败: {str(e)}")
+                continue
+            if node_number is not None and node_number not in source_list:
+                source_list.append(node_number)
+        return source_list
+
+
+def resolve_streamed_references(matcher: Optional[StreamingCitationMatcher], doc_key: str,
+                                source_query_engine, response_text: str) -> list:
+    """
+    获取流式回答的源文本参考：优先使用生成过程中本地匹配的结果，匹配不到时再调用大模型
+
+    参数：
+        matcher: 生成回答时使用的匹配器，没有 BM25 索引时为None
+        doc_key: 文档内容标识（get_content_key，内容相同的文档共享）
+        source_query_engine: 源文本查询引擎
+        response_text: 完整回答
+
+    返回：
+        源文本参考列表（节点编号）
+    """
+    if matcher is not None:
+        source_list = matcher.finish()
+        if source_list:
+            record_citation_result("matched")
+            return source_list
+        record_citation_result("fallback" if matcher.submitted else "skipped")
+
+    # 本地已匹配过，回退时不再重复 BM25 匹配
+    return find_source_references_shared(doc_key, source_query_engine, response_text)
@@ -0,0 +1,433 @@
+import os
+import json
+import mmap
+import time
+import shutil
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+from llama_index.core import ListIndex, Settings, StorageContext, VectorStoreIndex, load_index_from_storage
+from llama_index.core.data_structs.data_structs import IndexList
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeRelationship, NodeWithScore, QueryBundle, RelatedNodeInfo, TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+from src.auth import get_system_config
+
+
+# 紧凑格式的文件名
+COMPACT_META_FILE = "compact_meta.json"
+COMPACT_TEXTS_FILE = "compact_texts.bin"
+COMPACT_OFFSETS_FILE = "compact_offsets.npy"
+COMPACT_EMBEDDINGS_FILE = "compact_embeddings.npy"
+COMPACT_FILES = (COMPACT_META_FILE, COMPACT_TEXTS_FILE, COMPACT_OFFSETS_FILE, COMPACT_EMBEDDINGS_FILE)
+
+# llama_index 默认 JSON 格式的文件名
+JSON_STORE_FILES = (
+    "docstore.json",
+    "index_store.json",
+    "default__vector_store.json",
+    "image__vector_store.json",
+    "graph_store.json",
+)
+
+# 索引存储格式："json" 为 llama_index 默认格式，"compact" 为紧凑二进制格式
+INDEX_STORAGE_FORMATS = ("json", "compact")
+DEFAULT_INDEX_STORAGE_FORMAT = "json"
+
+COMPACT_FORMAT_VERSION = 1
+
+
+def get_index_storage_format() -> str:
+    """获取系统配置的索引存储格式"""
+    storage_format = get_system_config("index_storage_format") or DEFAULT_INDEX_STORAGE_FORMAT
+    if storage_format not in INDEX_STORAGE_FORMATS:
+        raise ValueError(f"不支持的索引存储格式: {storage_format}")
+    return storage_format
+
+def is_compact_index(persist_dir: str) -> bool:
+    """判断目录中是否为紧凑格式的索引"""
+    return os.path.exists(os.path.join(persist_dir, COMPACT_META_FILE))
+
+def has_persisted_index(persist_dir: str) -> bool:
+    """判断目录中是否已有任意格式的索引"""
+    return is_compact_index(persist_dir) or os.path.exists(os.path.join(persist_dir, "docstore.json"))
+
+def _remove_files(persist_dir: str, filenames) -> None:
+    """删除目录中另一种格式留下的旧文件"""
+    for filename in filenames:
+        path = os.path.join(persist_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class CompactDocumentStore(SimpleDocumentStore):
+    """
+    以内存映射的紧凑格式文件为后端的只读文档存储
+
+    加载时只读取元数据列，节点在第一次被访问时才从内存映射的文本文件解码并创建，之后复用同一个对象
+    """
+
+    def __init__(self, persist_dir: str, meta: Dict[str, Any]):
+        super().__init__()
+        self._meta = meta
+        self.ids: List[str] = meta["ids"]
+        self.positions = {node_id: i for i, node_id in enumerate(self.ids)}
+        self._offsets = np.load(os.path.join(persist_dir, COMPACT_OFFSETS_FILE), mmap_mode="r")
+
+        texts_path = os.path.join(persist_dir, COMPACT_TEXTS_FILE)
+        self.texts_size = os.path.getsize(texts_path)
+        with open(texts_path, "rb") as f:
+            # 空文件无法建立内存映射；映射在文件关闭后仍然有效
+            self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.texts_size else b""
+
+        self._nodes: Dict[int, TextNode] = {}
+
+    def node_at(self, position: int) -> TextNode:
+        """获取第 position 个节点，第一次访问时创建"""
+        node = self._nodes.get(position)
+        if node is None:
+            node = self._nodes.setdefault(position, self._build_node(position))
+        return node
+
+    def _build_node(self, i: int) -> TextNode:
+        meta = self._meta
+        metadata = {key: column[i] for key, column in meta["metadata"].items() if column[i] is not None}
+        node = TextNode(
+            id_=self.ids[i],
+            text=str(memoryview(self._texts)[self._offsets[i]:self._offsets[i + 1]], "utf-8"),
+            metadata=metadata,
+            excluded_embed_metadata_keys=meta["excluded_embed_metadata_keys"][i],
+            excluded_llm_metadata_keys=meta["excluded_llm_metadata_keys"][i],
+        )
+        if meta["ref_doc_ids"][i]:
+            node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=meta["ref_doc_ids"][i])
+        # 较早保存的索引没有记录其他关系
+        if meta.get("relationships"):
+            for relationship, related in meta["relationships"][i].items():
+                if isinstance(related, list):
+                    node.relationships[NodeRelationship(relationship)] = [RelatedNodeInfo(node_id=node_id) for node_id in related]
+                else:
+                    node.relationships[NodeRelationship(relationship)] = RelatedNodeInfo(node_id=related)
+        return node
+
+    def node_lookup(self, parse_number: Callable[[Any], Optional[int]]) -> "CompactNodeLookup":
+        """
+        获取按节点编号查找节点的映射，编号直接从元数据列读取，不需要先创建所有节点
+
+        参数：
+            parse_number: 将 node_number 元数据解析为整数的函数
+
+        返回：
+            {整数节点编号: 节点} 映射
+        """
+        positions = {}
+        for i, value in enumerate(self._meta["metadata"].get("node_number", [])):
+            number = parse_number(value) if value is not None else None
+            if number is not None:
+                positions.setdefault(number, i)
+        return CompactNodeLookup(self, positions)
+
+    def estimate_size(self) -> int:
+        """估算全部节点创建后占用的内存（字节），内存映射的文件由操作系统按需换入，不计入"""
+        return self.texts_size * 2 + len(self.ids) * 200
+
+    @property
+    def docs(self) -> Dict[str, BaseNode]:
+        return {node_id: self.node_at(i) for i, node_id in enumerate(self.ids)}
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> Optional[BaseNode]:
+        if doc_id not in self.positions:
+            if raise_error:
+                raise ValueError(f"doc_id {doc_id} not found.")
+            return None
+        return self.node_at(self.positions[doc_id])
+
+    async def aget_document(self, doc_id: str, raise_error: bool = True) -> Optional[BaseNode]:
+        return self.get_document(doc_id, raise_error)
+
+    def document_exists(self, doc_id: str) -> bool:
+        return doc_id in self.positions
+
+    async def adocument_exists(self, doc_id: str) -> bool:
+        return self.document_exists(doc_id)
+
+
+class CompactNodeLookup(Mapping):
+    """节点编号到节点的只读映射，节点在第一次被访问时创建"""
+
+    def __init__(self, docstore: CompactDocumentStore, positions: Dict[int, int]):
+        self._docstore = docstore
+        self._positions = positions
+
+    def __getitem__(self, number: int) -> TextNode:
+        return self._docstore.node_at(self._positions[number])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+
+class CompactVectorRetriever(BaseRetriever):
+    """直接在内存映射的嵌入矩阵上计算余弦相似度的检索器"""
+
+    def __init__(self, docstore: CompactDocumentStore, embeddings: np.ndarray, norms: np.ndarray, similarity_top_k: int):
+        super().__init__()
+        self._docstore = docstore
+        self._embeddings = embeddings
+        self._norms = norms
+        self._similarity_top_k = similarity_top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = Settings.embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._top_k(query_bundle.embedding)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 异步路径上通过异步接口计算问题嵌入，不阻塞事件循环，并受嵌入服务的并发上限和限速约束
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await Settings.embed_model.aget_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._top_k(query_bundle.embedding)
+
+    def _top_k(self, embedding: List[float]) -> List[NodeWithScore]:
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = (self._embeddings @ query) / (self._norms * (np.linalg.norm(query) or 1.0))
+
+        top_k = min(self._similarity_top_k, len(self._docstore.ids))
+        top_indices = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_indices = top_indices[np.argsort(-scores[top_indices])]
+
+        return [NodeWithScore(node=self._docstore.node_at(int(i)), score=float(scores[i])) for i in top_indices]
+
+
+class CompactIndex:
+    """
+    从紧凑格式加载的索引，提供问答流程用到的索引接口（docstore、as_query_engine、as_chat_engine）
+
+    节点按需从内存映射的文本文件创建，嵌入矩阵保持内存映射，多个进程加载同一索引时共享物理内存页
+    """
+
+    def __init__(self, docstore: CompactDocumentStore, embeddings: Optional[np.ndarray]):
+        # 列表索引直接使用按需创建节点的文档存储，供引用匹配和全文问答使用
+        self._docstore = docstore
+        self._list_index = ListIndex(
+            index_struct=IndexList(nodes=list(docstore.ids)),
+            storage_context=StorageContext.from_defaults(docstore=docstore),
+        )
+        self.embeddings = embeddings
+        self._norms = None
+
+    @property
+    def docstore(self) -> CompactDocumentStore:
+        return self._docstore
+
+    @property
+    def is_vector(self) -> bool:
+        return self.embeddings is not None
+
+    def get_embedding(self, node_id: str) -> Optional[List[float]]:
+        """获取节点的嵌入（列表索引返回None）"""
+        if self.embeddings is None or node_id not in self._docstore.positions:
+            return None
+        return self.embeddings[self._docstore.positions[node_id]].tolist()
+
+    def estimate_size(self) -> int:
+        """估算占用的内存（字节）"""
+        return self._docstore.estimate_size()
+
+    def as_retriever(self, similarity_top_k: int = 2, **kwargs: Any) -> BaseRetriever:
+        if not self.is_vector:
+            return self._list_index.as_retriever(**kwargs)
+        if self._norms is None:
+            self._norms = np.linalg.norm(self.embeddings, axis=1)
+            self._norms[self._norms == 0] = 1.0
+        return CompactVectorRetriever(self._docstore, self.embeddings, self._norms, similarity_top_k)
+
+    def as_query_engine(self, similarity_top_k: int = 2, **kwargs: Any):
+        if not self.is_vector:
+            return self._list_index.as_query_engine(**kwargs)
+        return RetrieverQueryEngine.from_args(self.as_retriever(similarity_top_k=similarity_top_k), **kwargs)
+
+    def as_chat_engine(self, **kwargs: Any):
+        return self._list_index.as_chat_engine(**kwargs)
+
+
+def _serialize_relationships(node: BaseNode) -> Dict[str, Any]:
+    relationships = {}
+    for relationship, related in node.relationships.items():
+        if relationship == NodeRelationship.SOURCE:
+            continue
+        if isinstance(related, list):
+            relationships[relationship.value] = [info.node_id for info in related]
+        else:
+            relationships[relationship.value] = related.node_id
+    return relationships
+
+def save_compact_index(index: Any, persist_dir: str) -> None:
+    """
+    以紧凑格式保存索引：文本拼接为一个二进制文件，元数据按列存储，嵌入保存为 float32 的 .npy 矩阵
+
+    参数：
+        index: 已构建的 ListIndex 或 VectorStoreIndex
+        persist_dir: 索引存储目录
+    """
+    os.makedirs(persist_dir, exist_ok=True)
+
+    nodes = list(index.docstore.docs.values())
+    is_vector = isinstance(index, VectorStoreIndex) or getattr(index, "is_vector", False)
+
+    # 文本按 UTF-8 拼接，偏移量数组记录每个节点的起止位置
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    with open(os.path.join(persist_dir, COMPACT_TEXTS_FILE), "wb") as f:
+        for i, node in enumerate(nodes):
+            data = node.get_content().encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(persist_dir, COMPACT_OFFSETS_FILE), offsets)
+
+    # 元数据按列存储，缺失的字段记为None
+    metadata_keys = sorted({key for node in nodes for key in node.metadata})
+    meta = {
+        "format_version": COMPACT_FORMAT_VERSION,
+        "index_type": "vector" if is_vector else "list",
+        "ids": [node.node_id for node in nodes],
+        "ref_doc_ids": [node.ref_doc_id for node in nodes],
+        "metadata": {key: [node.metadata.get(key) for node in nodes] for key in metadata_keys},
+        "excluded_embed_metadata_keys": [node.excluded_embed_metadata_keys for node in nodes],
+        "excluded_llm_metadata_keys": [node.excluded_llm_metadata_keys for node in nodes],
+        # SOURCE 以外的关系（相邻分块的 PREVIOUS/NEXT 等）只保存关联节点的ID
+        "relationships": [_serialize_relationships(node) for node in nodes],
+    }
+
+    if is_vector:
+        if isinstance(index, VectorStoreIndex):
+            vector_store = index.storage_context.vector_store
+            rows = [vector_store.get(node.node_id) for node in nodes]
+        else:
+            rows = [index.get_embedding(node.node_id) for node in nodes]
+        np.save(os.path.join(persist_dir, COMPACT_EMBEDDINGS_FILE), np.asarray(rows, dtype=np.float32))
+    else:
+        _remove_files(persist_dir, [COMPACT_EMBEDDINGS_FILE])
+
+    with open(os.path.join(persist_dir, COMPACT_META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    # 删除旧的 JSON 格式文件，避免加载时格式不明确
+    _remove_files(persist_dir, JSON_STORE_FILES)
+
+def load_compact_index(persist_dir: str) -> CompactIndex:
+    """
+    加载紧凑格式的索引
+
+    参数：
+        persist_dir: 索引存储目录
+
+    返回：
+        CompactIndex 对象
+    """
+    with open(os.path.join(persist_dir, COMPACT_META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    if meta.get("format_version") != COMPACT_FORMAT_VERSION:
+        raise ValueError(f"不支持的紧凑索引版本: {meta.get('format_version')}")
+
+    docstore = CompactDocumentStore(persist_dir, meta)
+
+    embeddings = None
+    if meta["index_type"] == "vector":
+        embeddings = np.load(os.path.join(persist_dir, COMPACT_EMBEDDINGS_FILE), mmap_mode="r")
+
+    return CompactIndex(docstore, embeddings)
+
+def _index_versions(persist_dir: str) -> List[str]:
+    """列出索引目录的各个版本目录（{persist_dir}.v{时间戳}），按时间从旧到新"""
+    parent, base = os.path.split(persist_dir)
+    prefix = f"{base}.v"
+    versions = [
+        name for name in os.listdir(parent or ".")
+        if name.startswith(prefix) and name[len(prefix):].isdigit()
+    ]
+    return [os.path.join(parent, name) for name in sorted(versions, key=lambda name: int(name[len(prefix):]))]
+
+def persist_index(index: Any, persist_dir: str, write_extra: Optional[Callable[[str], None]] = None) -> None:
+    """
+    按系统配置的存储格式保存索引
+
+    先写入新的版本目录，再把 persist_dir 这个符号链接原子地切换过去，正在加载的进程（索引目录可能由多个用户共享）
+    不会读到新旧文件混合的索引；保留上一个版本供切换时正在加载的进程读完，更早的版本删除
+
+    参数：
+        index: 已构建的索引
+        persist_dir: 索引存储目录（符号链接）
+        write_extra: 切换前在新版本目录中写入其他文件（如 BM25 索引）的函数，参数为新版本目录
+    """
+    parent, base = os.path.split(persist_dir)
+    version = time.time_ns()
+    version_dir = os.path.join(parent, f"{base}.v{version}")
+    os.makedirs(version_dir)
+
+    try:
+        if get_index_storage_format() == "compact":
+            save_compact_index(index, version_dir)
+        else:
+            index.storage_context.persist(persist_dir=version_dir)
+        if write_extra is not None:
+            write_extra(version_dir)
+    except Exception:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    if os.path.isdir(persist_dir) and not os.path.islink(persist_dir):
+        # 旧版本使用普通目录保存：先改名为版本目录（只在第一次切换时发生）
+        os.rename(persist_dir, os.path.join(parent, f"{base}.v{version - 1}"))
+
+    temp_link = f"{persist_dir}.link-{os.getpid()}"
+    if os.path.lexists(temp_link):
+        os.unlink(temp_link)
+    os.symlink(os.path.basename(version_dir), temp_link)
+    os.replace(temp_link, persist_dir)
+
+    for old_dir in [d for d in _index_versions(persist_dir) if d != version_dir][:-1]:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def load_persisted_index(persist_dir: str) -> Any:
+    """
+    加载任意格式的已保存索引
+
+    参数：
+        persist_dir: 索引存储目录
+
+    返回：
+        索引对象
+    """
+    # 只解析一次符号链接，加载期间索引切换到新版本也不会混读两个版本的文件
+    persist_dir = os.path.realpath(persist_dir)
+    if is_compact_index(persist_dir):
+        return load_compact_index(persist_dir)
+    return load_index_from_storage(StorageContext.from_defaults(persist_dir=persist_dir))
+
+def get_node_embedding(index: Any, node_id: str) -> Optional[List[float]]:
+    """
+    获取索引中某个节点的嵌入
+
+    参数：
+        index: 索引对象
+        node_id: 节点ID
+
+    返回：
+        嵌入向量，列表索引或不存在时返回None
+    """
+    if isinstance(index, CompactIndex):
+        return index.get_embedding(node_id)
+    try:
+        return index.storage_context.vector_store.get(node_id)
+    except KeyError:
+        return None
+
+def is_vector_index(index: Any) -> bool:
+    """判断索引是否支持向量相似度检索"""
+    return isinstance(index, VectorStoreIndex) or getattr(index, "is_vector", False)
@@ -0,0 +1,266 @@
+import os
+import json
+import shutil
+import datetime
+from typing import Any, ContextManager, Dict, List, Optional
+
+from src.auth import get_user_data_path
+from src.file_lock import file_lock
+from src.utils import get_document_metadata, save_document_metadata, update_document_status
+
+
+# 内容寻址存储：内容相同的PDF（按 SHA-256）共享一份转换结果和索引，
+# 各文档的 output/{user_id}/{doc_id} 和 storage/{user_id}/{doc_id} 是指向 store/{hash}/ 的符号链接
+STORE_DIR = "store"
+
+# 引用计数数据文件路径；应用、命令行和批量构建的子进程都会修改，读改写期间持有文件锁
+CONTENT_STORE_DB_PATH = os.path.join("db", "content_store.json")
+CONTENT_STORE_LOCK_PATH = os.path.join("db", "content_store.lock")
+
+# 索引构建完成后同步给共享同一内容的其他文档的元数据字段
+SHARED_INDEX_FIELDS = (
+    "indexed", "index_time", "markdown_hash", "source_index_mode", "source_splitter", "index_storage_format",
+)
+
+
+def _load_store() -> Dict[str, Any]:
+    """加载引用计数数据"""
+    if not os.path.exists(CONTENT_STORE_DB_PATH):
+        return {}
+
+    with open(CONTENT_STORE_DB_PATH, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def _save_store(store: Dict[str, Any]) -> None:
+    """保存引用计数数据"""
+    os.makedirs(os.path.dirname(CONTENT_STORE_DB_PATH), exist_ok=True)
+    temp_path = CONTENT_STORE_DB_PATH + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(store, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, CONTENT_STORE_DB_PATH)
+
+def _store_lock() -> ContextManager[bool]:
+    """引用计数数据的进程间锁（不可重入）"""
+    return file_lock(CONTENT_STORE_LOCK_PATH)
+
+def _ref(user_id: str, doc_id: str) -> str:
+    return f"{user_id}/{doc_id}"
+
+def get_store_dir(content_hash: str) -> str:
+    """获取内容的共享存储目录"""
+    return os.path.join(STORE_DIR, content_hash)
+
+def get_store_entry(content_hash: str) -> Optional[Dict[str, Any]]:
+    """获取内容的存储记录"""
+    with _store_lock():
+        return _load_store().get(content_hash)
+
+def get_content_key(user_id: str, doc_id: str) -> str:
+    """
+    获取文档内容的标识，内容相同的文档（包括不同用户各自上传的同一篇论文）标识相同
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        PDF内容的 SHA-256；没有记录内容哈希的旧文档返回 "user_id/doc_id"
+    """
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    return metadata.get("content_hash") or _ref(user_id, doc_id)
+
+def conversion_lock(content_hash: str) -> ContextManager[bool]:
+    """获取内容的转换锁（进程间），相同内容的文档依次转换，后转换的直接沿用结果"""
+    return file_lock(os.path.join(get_store_dir(content_hash), "convert.lock"))
+
+def index_lock(content_hash: str, blocking: bool = True) -> ContextManager[bool]:
+    """获取内容的索引构建锁（进程间），共享同一索引目录的文档依次构建，不会同时读取、合并和保存同一个索引"""
+    return file_lock(os.path.join(get_store_dir(content_hash), "index.lock"), blocking)
+
+def _find_linked_refs(content_hash: str) -> List[str]:
+    """扫描 output/ 和 storage/，找出仍链接到共享存储的文档（"user_id/doc_id"）"""
+    store_dir = os.path.realpath(get_store_dir(content_hash))
+    refs = set()
+    for data_type in ("output", "storage"):
+        if not os.path.isdir(data_type):
+            continue
+        for user_id in os.listdir(data_type):
+            user_dir = os.path.join(data_type, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            for doc_id in os.listdir(user_dir):
+                link_path = os.path.join(user_dir, doc_id)
+                if os.path.islink(link_path) and os.path.realpath(link_path).startswith(store_dir + os.sep):
+                    refs.add(_ref(user_id, doc_id))
+    return sorted(refs)
+
+def add_reference(content_hash: str, user_id: str, doc_id: str) -> int:
+    """
+    登记文档对内容的引用，并把文档的输出和索引目录链接到共享存储
+
+    参数：
+        content_hash: PDF内容的 SHA-256
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        当前引用数
+    """
+    with _store_lock():
+        store = _load_store()
+        entry = store.setdefault(content_hash, {
+            "refs": [],
+            "output_name": None,
+            "converted": False,
+            "index": None,
+            "created_at": datetime.datetime.now().isoformat(),
+        })
+        if _ref(user_id, doc_id) not in entry["refs"]:
+            entry["refs"].append(_ref(user_id, doc_id))
+        _save_store(store)
+
+        for data_type in ("output", "storage"):
+            shared_dir = os.path.join(get_store_dir(content_hash), data_type)
+            os.makedirs(shared_dir, exist_ok=True)
+            link_path = os.path.join(get_user_data_path(user_id, data_type), doc_id)
+            if not os.path.lexists(link_path):
+                # 使用相对路径，整体移动项目目录后链接仍然有效
+                os.symlink(os.path.relpath(shared_dir, os.path.dirname(link_path)), link_path)
+
+        return len(entry["refs"])
+
+def release_reference(content_hash: str, user_id: str, doc_id: str) -> int:
+    """
+    移除文档对内容的引用和文档的目录链接，最后一个引用移除时删除共享存储
+
+    参数：
+        content_hash: PDF内容的 SHA-256
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        剩余引用数
+    """
+    with _store_lock():
+        for data_type in ("output", "storage"):
+            link_path = os.path.join(data_type, user_id, doc_id)
+            if os.path.islink(link_path):
+                os.unlink(link_path)
+
+        store = _load_store()
+        entry = store.get(content_hash)
+        if entry is None:
+            return 0
+
+        if _ref(user_id, doc_id) in entry["refs"]:
+            entry["refs"].remove(_ref(user_id, doc_id))
+
+        if not entry["refs"]:
+            # 删除前再确认没有其他文档仍链接到共享存储（引用记录可能丢失），有则恢复引用
+            survivors = _find_linked_refs(content_hash)
+            if survivors:
+                print(f"共享存储 {content_hash} 的引用记录与链接不一致，恢复引用: {survivors}")
+                entry["refs"] = survivors
+            else:
+                del store[content_hash]
+                shutil.rmtree(get_store_dir(content_hash), ignore_errors=True)
+        _save_store(store)
+
+        return len(entry["refs"])
+
+def release_user_references(user_id: str) -> None:
+    """移除用户所有文档的引用（删除用户前调用）"""
+    with _store_lock():
+        owned = [
+            (content_hash, ref.split("/", 1)[1])
+            for content_hash, entry in _load_store().items()
+            for ref in entry["refs"]
+            if ref.split("/", 1)[0] == user_id
+        ]
+    for content_hash, doc_id in owned:
+        release_reference(content_hash, user_id, doc_id)
+
+def mark_converted(content_hash: str, user_id: str, doc_id: str, output_name: str) -> None:
+    """记录内容已转换完成（输出位于共享存储的 output/{output_name}/auto/ 下）"""
+    with _store_lock():
+        store = _load_store()
+        if content_hash in store:
+            store[content_hash]["converted"] = True
+            store[content_hash]["output_name"] = output_name
+            _save_store(store)
+
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    metadata["output_name"] = output_name
+    save_document_metadata(user_id, doc_id, metadata)
+
+def adopt_converted(user_id: str, doc_id: str) -> bool:
+    """
+    内容已由其他文档转换时直接沿用转换结果（已建索引时同时沿用索引）
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        是否已沿用
+    """
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    content_hash = metadata.get("content_hash")
+    entry = get_store_entry(content_hash) if content_hash else None
+    if not entry or not entry.get("converted"):
+        return False
+
+    output_name = entry["output_name"]
+    markdown_path = os.path.join(get_store_dir(content_hash), "output", output_name, "auto", f"{output_name}.md")
+    if not os.path.exists(markdown_path):
+        return False
+
+    metadata["output_name"] = output_name
+    if entry.get("index"):
+        metadata.update(entry["index"])
+    save_document_metadata(user_id, doc_id, metadata)
+    update_document_status(user_id, doc_id, "处理完成")
+    return True
+
+def share_index(user_id: str, doc_id: str) -> List[str]:
+    """
+    文档的索引构建完成后，把索引状态同步给共享同一内容的其他文档
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        已同步的其他文档（"user_id/doc_id"）
+    """
+    metadata = get_document_metadata(user_id, doc_id) or {}
+    content_hash = metadata.get("content_hash")
+    if not content_hash:
+        return []
+
+    index = {field: metadata.get(field) for field in SHARED_INDEX_FIELDS}
+    with _store_lock():
+        store = _load_store()
+        entry = store.get(content_hash)
+        if entry is None:
+            return []
+        entry["index"] = index
+        _save_store(store)
+        others = [ref for ref in entry["refs"] if ref != _ref(user_id, doc_id)]
+
+    from src.engine_cache import invalidate_document_cache
+    for ref in others:
+        other_user_id, other_doc_id = ref.split("/", 1)
+        other_metadata = get_document_metadata(other_user_id, other_doc_id)
+        if not other_metadata or other_metadata.get("status") not in ("处理完成", "索引构建失败"):
+            continue
+        # index_time 随之更新，其他文档基于旧索引的答案缓存自动失效
+        other_metadata.update(index)
+        other_metadata["status"] = "处理完成"
+        save_document_metadata(other_user_id, other_doc_id, other_metadata)
+        invalidate_document_cache(other_user_id, other_doc_id)
+
+    return others
@@ -0,0 +1,190 @@
+import weakref
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+from src.auth import get_system_config
+from src.build_index import parse_node_number
+
+
+# 问答模式："full_text" 每轮把整篇论文放进提示词；
+# "budgeted" 按预算只放入与问题最相关的源文本分块，论文不超过预算时仍使用全文
+CHAT_MODES = ("full_text", "budgeted")
+DEFAULT_CHAT_MODE = "full_text"
+
+# 每轮放入提示词的文档上下文 token 预算
+DEFAULT_CHAT_CONTEXT_TOKEN_BUDGET = 6000
+
+# 已加载索引的 token 数（索引被缓存淘汰后自动释放）
+_index_token_counts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_chat_mode() -> str:
+    """获取系统配置的问答模式"""
+    mode = get_system_config("chat_mode") or DEFAULT_CHAT_MODE
+    if mode not in CHAT_MODES:
+        raise ValueError(f"不支持的问答模式: {mode}")
+    return mode
+
+def get_chat_context_token_budget() -> int:
+    """获取系统配置的每轮文档上下文 token 预算"""
+    return get_system_config("chat_context_token_budget") or DEFAULT_CHAT_CONTEXT_TOKEN_BUDGET
+
+def count_tokens(text: str) -> int:
+    """统计文本的 token 数"""
+    return len(get_tokenizer()(text))
+
+def get_index_token_count(index: Any) -> int:
+    """
+    统计索引中所有节点文本的 token 数，每个加载的索引只统计一次
+
+    参数：
+        index: 索引对象
+
+    返回：
+        token 数
+    """
+    try:
+        return _index_token_counts[index]
+    except KeyError:
+        pass
+
+    total = sum(count_tokens(node.get_content()) for node in index.docstore.docs.values())
+    _index_token_counts[index] = total
+    return total
+
+
+class TokenBudgetRetriever(BaseRetriever):
+    """
+    按 token 预算选取源文本分块的检索器
+
+    分块按与问题的嵌入相似度排序（向量索引直接检索；列表索引通过带本地缓存的嵌入模型计算分块嵌入，
+    只有第一次需要请求接口），依次放入直到达到预算，最后按原文顺序排列，保持上下文连贯。
+    不使用 BM25 排序：中文问题与英文论文几乎没有相同的词。无法排序时退回全文
+    """
+
+    def __init__(
+        self,
+        node_lookup: Dict[int, Any],
+        token_budget: int,
+        vector_retriever: Optional[BaseRetriever] = None,
+        system_prompt: str = "",
+    ):
+        super().__init__()
+        self._node_lookup = node_lookup
+        self._token_budget = token_budget
+        self._vector_retriever = vector_retriever
+        self._ordered_numbers = sorted(node_lookup)
+        self._system_prompt_tokens = count_tokens(system_prompt) if system_prompt else 0
+        self._node_embeddings: Optional[np.ndarray] = None
+
+        # 返回本轮发送前的对话历史，由创建聊天引擎的一方设置，用于统计每轮提示词大小
+        self.history_source: Optional[Callable[[], List[ChatMessage]]] = None
+
+        self._token_counts: Dict[int, int] = {}
+        self.last_context_tokens = 0
+        self.last_prompt_tokens = 0
+        self.last_node_count = 0
+
+    def _node_tokens(self, number: int) -> int:
+        if number not in self._token_counts:
+            self._token_counts[number] = count_tokens(self._node_lookup[number].get_content())
+        return self._token_counts[number]
+
+    def _node_texts(self) -> List[str]:
+        # 与构建向量索引时的嵌入文本一致，两种索引模式共用嵌入缓存
+        return [self._node_lookup[number].get_content(metadata_mode=MetadataMode.EMBED) for number in self._ordered_numbers]
+
+    def _collect_vector_results(self, results: List[NodeWithScore]) -> List[tuple]:
+        ranked = []
+        for result in results:
+            number = parse_node_number(result.node.metadata.get("node_number", ""))
+            if number in self._node_lookup:
+                ranked.append((number, result.score or 0.0))
+        return ranked
+
+    def _rank_by_embedding(self, query_embedding: List[float]) -> List[tuple]:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norms = np.linalg.norm(self._node_embeddings, axis=1) * (np.linalg.norm(query) or 1.0)
+        norms[norms == 0] = 1.0
+        scores = (self._node_embeddings @ query) / norms
+        return [(self._ordered_numbers[i], float(scores[i])) for i in np.argsort(-scores)]
+
+    def _rank(self, query_bundle: QueryBundle) -> List[tuple]:
+        """按相关度返回 [(节点编号, 得分), ...]"""
+        if self._vector_retriever is not None:
+            return self._collect_vector_results(self._vector_retriever.retrieve(query_bundle))
+
+        if self._node_embeddings is None:
+            self._node_embeddings = np.asarray(
+                Settings.embed_model.get_text_embedding_batch(self._node_texts()), dtype=np.float32
+            )
+        return self._rank_by_embedding(Settings.embed_model.get_query_embedding(query_bundle.query_str))
+
+    async def _arank(self, query_bundle: QueryBundle) -> List[tuple]:
+        """_rank 的异步版本，嵌入通过异步接口计算"""
+        if self._vector_retriever is not None:
+            return self._collect_vector_results(await self._vector_retriever.aretrieve(query_bundle))
+
+        if self._node_embeddings is None:
+            self._node_embeddings = np.asarray(
+                await Settings.embed_model.aget_text_embedding_batch(self._node_texts()), dtype=np.float32
+            )
+        return self._rank_by_embedding(await Settings.embed_model.aget_query_embedding(query_bundle.query_str))
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        try:
+            ranked = self._rank(query_bundle)
+        except Exception as e:
+            print(f"按相关度排序分块失败: {str(e)}")
+            ranked = []
+        return self._select(query_bundle, ranked)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        try:
+            ranked = await self._arank(query_bundle)
+        except Exception as e:
+            print(f"按相关度排序分块失败: {str(e)}")
+            ranked = []
+        return self._select(query_bundle, ranked)
+
+    def _select(self, query_bundle: QueryBundle, ranked: List[tuple]) -> List[NodeWithScore]:
+        """按相关度顺序放入预算内的分块；没有排序结果时使用全部分块（即全文）"""
+        selected: Dict[int, float] = {}
+        used_tokens = 0
+
+        if not ranked:
+            print("未能按相关度排序分块，本轮使用全文")
+            for number in self._ordered_numbers:
+                selected[number] = 0.0
+                used_tokens += self._node_tokens(number)
+        else:
+            for number, score in ranked:
+                tokens = self._node_tokens(number)
+                if number not in selected and used_tokens + tokens <= self._token_budget:
+                    selected[number] = score
+                    used_tokens += tokens
+
+        # 实际发送的提示词 = 系统提示词 + 文档上下文 + 对话历史 + 问题
+        history_tokens = 0
+        if self.history_source is not None:
+            history_tokens = sum(count_tokens(message.content or "") for message in self.history_source())
+        question_tokens = count_tokens(query_bundle.query_str)
+
+        self.last_context_tokens = used_tokens
+        self.last_prompt_tokens = self._system_prompt_tokens + used_tokens + history_tokens + question_tokens
+        self.last_node_count = len(selected)
+        print(
+            f"本轮提示词约 {self.last_prompt_tokens} tokens: 文档上下文 {len(selected)} 个分块 {used_tokens} tokens "
+            f"(预算 {self._token_budget})，系统提示词 {self._system_prompt_tokens}，对话历史 {history_tokens}，问题 {question_tokens}"
+        )
+
+        return [
+            NodeWithScore(node=self._node_lookup[number], score=selected[number])
+            for number in sorted(selected)
+        ]
@@ -0,0 +1,233 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from pydantic import PrivateAttr
+
+from src.auth import get_system_config
+from src.provider_limits import provider_slot
+
+
+# 嵌入缓存数据库路径
+EMBEDDING_CACHE_PATH = os.path.join("db", "embedding_cache.sqlite3")
+
+# 默认最多缓存的嵌入条数（可通过 db/system_config.json 覆盖）
+DEFAULT_MAX_ENTRIES = 200000
+
+
+class EmbeddingCache:
+    """基于 SQLite 的本地嵌入缓存，按 (模型名, 嵌入类型, 文本哈希) 存储向量"""
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def make_key(model_name: str, kind: str, text: str) -> str:
+        """
+        生成缓存键
+
+        参数：
+            model_name: 嵌入模型名称
+            kind: 嵌入类型 ("text" 或 "query"，部分模型对两者使用不同的编码方式)
+            text: 文本内容
+
+        返回：
+            缓存键
+        """
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{model_name}:{kind}:{text_hash}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        批量读取缓存的嵌入
+
+        参数：
+            keys: 缓存键列表
+
+        返回：
+            命中的 {缓存键: 向量} 字典
+        """
+        found = {}
+        if not keys:
+            return found
+
+        with self._lock, self._connect() as conn:
+            unique_keys = list(dict.fromkeys(keys))
+            # SQLite 对单条语句的参数数量有限制，分批查询
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """
+        批量写入嵌入，超出容量时淘汰最久未使用的条目
+
+        参数：
+            items: {缓存键: 向量} 字典
+        """
+        if not items:
+            return
+
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()],
+            )
+
+            count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock, self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "db_size_bytes": os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+        }
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    """获取进程级的嵌入缓存单例"""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            max_entries = get_system_config("embedding_cache_max_entries") or DEFAULT_MAX_ENTRIES
+            _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, max_entries)
+        return _embedding_cache
+
+def get_embedding_cache_stats() -> Dict[str, Any]:
+    """获取嵌入缓存统计信息"""
+    return get_embedding_cache().stats()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """在任意嵌入模型外包一层本地缓存，命中时不再请求远程接口"""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, **kwargs: Any):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _cached(self, kind: str, texts: List[str], compute) -> List[Embedding]:
+        """先查缓存，只对未命中的文本调用 compute 计算嵌入"""
+        cache = get_embedding_cache()
+        keys = [cache.make_key(self.model_name, kind, text) for text in texts]
+        found = cache.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = compute([texts[i] for i in missing])
+            new_items = {keys[i]: vector for i, vector in zip(missing, computed)}
+            cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    async def _acached(self, kind: str, texts: List[str], acompute) -> List[Embedding]:
+        """_cached 的异步版本"""
+        cache = get_embedding_cache()
+        keys = [cache.make_key(self.model_name, kind, text) for text in texts]
+        found = cache.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            # 未命中的部分请求嵌入接口，受事件循环内的嵌入服务并发上限和限速约束
+            async with provider_slot("embedding"):
+                computed = await acompute([texts[i] for i in missing])
+            new_items = {keys[i]: vector for i, vector in zip(missing, computed)}
+            cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._cached(
+            "query", [query],
+            lambda texts: [self._embed_model.get_query_embedding(texts[0])],
+        )[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        async def acompute(texts):
+            return [await self._embed_model.aget_query_embedding(texts[0])]
+        return (await self._acached("query", [query], acompute))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._cached("text", texts, self._embed_model.get_text_embedding_batch)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._acached("text", texts, self._embed_model.aget_text_embedding_batch)
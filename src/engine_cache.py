@@ -0,0 +1,236 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from src.auth import get_system_config
+
+
+# 默认缓存上限（可通过 db/system_config.json 覆盖）
+DEFAULT_MAX_ENTRIES = 16
+DEFAULT_MAX_MEMORY_MB = 1024
+
+
+def get_index_mtime(persist_dir: str) -> float:
+    """
+    获取索引目录中最新文件的修改时间，用于判断缓存是否过期
+
+    参数：
+        persist_dir: 索引存储目录
+
+    返回：
+        最新修改时间（目录不存在或为空时返回0）
+    """
+    latest = 0.0
+    if not os.path.isdir(persist_dir):
+        return latest
+
+    for entry in os.scandir(persist_dir):
+        if entry.is_file():
+            latest = max(latest, entry.stat().st_mtime)
+
+    return latest
+
+def estimate_index_size(index: Any) -> int:
+    """
+    估算已加载索引占用的内存（字节）
+
+    参数：
+        index: llama_index 索引对象
+
+    返回：
+        估算的内存字节数
+    """
+    if hasattr(index, "estimate_size"):
+        return index.estimate_size()
+
+    size = 0
+    try:
+        for node in index.docstore.docs.values():
+            # 文本按 UTF-8 字节数的两倍估算（含 Python 字符串对象开销）
+            size += len(node.get_content().encode("utf-8")) * 2
+            size += len(str(node.metadata)) * 2
+    except Exception:
+        pass
+
+    # 向量索引的嵌入以 Python float 列表存储，每个元素约 32 字节
+    embedding_dict = getattr(getattr(getattr(index, "vector_store", None), "data", None), "embedding_dict", None)
+    if embedding_dict:
+        for embedding in embedding_dict.values():
+            size += len(embedding) * 32
+
+    return size
+
+
+class EngineCache:
+    """进程级的文档索引 LRU 缓存，在所有 Streamlit 会话之间共享"""
+
+    def __init__(self, max_entries: int, max_memory_bytes: int):
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[Any, int]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # 每个缓存键的加载锁，避免多个会话同时加载同一索引
+        self._loading_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        # 每个文档用到的索引位置，按文档失效时据此找到（可能与其他文档共享的）缓存项
+        self._document_locations: Dict[Tuple[str, str], Set[str]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key: Tuple[str, str, str], loader: Callable[[], Any],
+                    document: Optional[Tuple[str, str]] = None) -> Any:
+        """
+        从缓存获取索引，不存在时调用 loader 加载并放入缓存
+
+        参数：
+            key: (索引位置, 索引类型, 索引版本)
+            loader: 加载索引的无参函数
+            document: 使用该索引的 (用户ID, 文档ID)
+
+        返回：
+            索引对象
+        """
+        with self._lock:
+            if document is not None:
+                self._document_locations.setdefault(document, set()).add(key[0])
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            # 等待期间可能已被其他会话加载完成
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+                self.misses += 1
+
+            try:
+                index = loader()
+                self._put(key, index, estimate_index_size(index))
+            finally:
+                with self._lock:
+                    self._loading_locks.pop(key, None)
+
+        return index
+
+    def _put(self, key: Tuple[str, str, str], index: Any, size: int) -> None:
+        """放入缓存，并淘汰同一索引的旧版本以及超出上限的最久未使用项"""
+        with self._lock:
+            for stale_key in [k for k in self._entries if k[:2] == key[:2]]:
+                self._remove(stale_key)
+                self.invalidations += 1
+
+            self._entries[key] = (index, size)
+            self._memory_bytes += size
+
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._memory_bytes > self.max_memory_bytes
+            ):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key: Tuple[str, str, str]) -> None:
+        """移除缓存项（调用方需持有锁）"""
+        _, size = self._entries.pop(key)
+        self._memory_bytes -= size
+
+    def invalidate(self, user_id: str, doc_id: str) -> int:
+        """
+        移除某个文档的所有缓存索引（索引由内容相同的文档共享时，其他文档的同一缓存项也一并移除）
+
+        参数：
+            user_id: 用户ID
+            doc_id: 文档ID
+
+        返回：
+            移除的缓存项数量
+        """
+        with self._lock:
+            locations = self._document_locations.pop((user_id, doc_id), set())
+            keys = [k for k in self._entries if k[0] in locations]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._document_locations.clear()
+            self._memory_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_engine_cache: Optional[EngineCache] = None
+_engine_cache_lock = threading.Lock()
+
+def get_engine_cache() -> EngineCache:
+    """获取进程级的索引缓存单例"""
+    global _engine_cache
+    with _engine_cache_lock:
+        if _engine_cache is None:
+            max_entries = get_system_config("engine_cache_max_entries") or DEFAULT_MAX_ENTRIES
+            max_memory_mb = get_system_config("engine_cache_max_memory_mb") or DEFAULT_MAX_MEMORY_MB
+            _engine_cache = EngineCache(max_entries, max_memory_mb * 1024 * 1024)
+        return _engine_cache
+
+def load_cached_index(user_id: str, doc_id: str, kind: str, persist_dir: str, loader: Callable[[], Any]) -> Any:
+    """
+    通过进程级缓存加载索引
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        kind: 索引类型 ("full_text"、"source" 或 "bm25")
+        persist_dir: 索引存储目录
+        loader: 缓存未命中时加载索引的无参函数
+
+    返回：
+        索引对象
+    """
+    # 按解析链接后的实际位置缓存：共享同一内容的多个文档（可能属于不同用户）只加载一份；
+    # 版本目录和修改时间变化（重建索引）时视为新版本
+    location = os.path.join(os.path.realpath(os.path.dirname(persist_dir)), os.path.basename(persist_dir))
+    version = f"{os.path.realpath(persist_dir)}@{get_index_mtime(persist_dir)}"
+    return get_engine_cache().get_or_load((location, kind, version), loader, (user_id, doc_id))
+
+def invalidate_document_cache(user_id: str, doc_id: str) -> None:
+    """
+    使某个文档的缓存索引失效（重建索引或删除文档后调用）
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+    """
+    if _engine_cache is not None:
+        _engine_cache.invalidate(user_id, doc_id)
+
+def get_engine_cache_stats() -> Dict[str, Any]:
+    """获取索引缓存统计信息"""
+    return get_engine_cache().stats()
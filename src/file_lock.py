@@ -0,0 +1,31 @@
+import os
+import fcntl
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    进程间互斥锁（fcntl.flock），同一进程内的不同线程之间同样互斥（每次获取都打开新的文件描述符）
+
+    不可重入：持有锁的线程不能再次获取同一个锁
+
+    参数：
+        lock_path: 锁文件路径
+        blocking: 为False时不等待，锁被占用时返回False
+
+    返回：
+        是否获取到锁
+    """
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
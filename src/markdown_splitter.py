@@ -0,0 +1,222 @@
+import re
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+from llama_index.core.node_parser import NodeParser, SentenceSplitter
+from llama_index.core.schema import BaseNode, MetadataMode, NodeRelationship, TextNode
+from llama_index.core.utils import get_tokenizer
+from pydantic import Field, PrivateAttr
+
+
+# MinerU 输出的 markdown 中的结构元素
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+IMAGE_PATTERN = re.compile(r"^\s*!\[[^\]]*\]\([^)]*\)\s*$")
+CAPTION_PATTERN = re.compile(r"^\s*(Figure|Fig\.|Table|Algorithm|图|表)\s*\S", re.IGNORECASE)
+
+# 分块元数据中不参与嵌入和大模型提示词的字段
+OFFSET_METADATA_KEYS = ["char_start", "char_end"]
+
+
+class MinerUMarkdownSplitter(NodeParser):
+    """
+    面向 MinerU (magic-pdf) markdown 输出的结构感知切分器
+
+    一次线性扫描识别标题、HTML/管道表格、图片及其图注、$$ 公式块，
+    以这些结构块为最小单位组装分块：分块不跨越章节标题，表格、公式和图注不会被切开，
+    每个分块带有章节路径（section_path）和在原文中的字符偏移（char_start/char_end）
+    """
+
+    chunk_size: int = Field(default=512, description="每个分块的最大token数")
+
+    _tokenizer: Any = PrivateAttr()
+    _fallback_splitter: SentenceSplitter = PrivateAttr()
+
+    def __init__(self, chunk_size: int = 512, **kwargs: Any):
+        super().__init__(chunk_size=chunk_size, **kwargs)
+        self._tokenizer = get_tokenizer()
+        # 单个段落超过分块大小时按句子继续切分
+        self._fallback_splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MinerUMarkdownSplitter"
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self._tokenizer(text))
+
+    def _iter_blocks(self, text: str) -> Iterator[Tuple[str, int, int, int]]:
+        """
+        逐行扫描，产出结构块 (类型, 起始偏移, 结束偏移, 标题级别)
+
+        类型为 heading、paragraph、table、equation、image 之一，标题级别只对 heading 有意义
+        """
+        lines = text.splitlines(keepends=True)
+        position = 0
+        i = 0
+
+        def take(count: int) -> Tuple[int, int]:
+            # 消耗若干行，返回块的 (起始偏移, 结束偏移)，结束偏移不含行尾换行
+            nonlocal i, position
+            block = "".join(lines[i:i + count])
+            start = position
+            position += len(block)
+            i += count
+            return start, start + len(block.rstrip("\r\n"))
+
+        while i < len(lines):
+            line = lines[i]
+            stripped = line.strip()
+
+            if not stripped:
+                take(1)
+                continue
+
+            heading = HEADING_PATTERN.match(stripped)
+            if heading:
+                yield ("heading", *take(1), len(heading.group(1)))
+                continue
+
+            if stripped.startswith("$$"):
+                # 公式块：单行 $$...$$ 或多行直到下一个 $$
+                count = 1
+                if not (len(stripped) > 2 and stripped.endswith("$$")):
+                    while i + count < len(lines) and "$$" not in lines[i + count]:
+                        count += 1
+                    count = min(count + 1, len(lines) - i)
+                yield ("equation", *take(count), 0)
+                continue
+
+            if stripped.lower().startswith("<table"):
+                count = 1
+                while "</table>" not in lines[i + count - 1].lower() and i + count < len(lines):
+                    count += 1
+                yield ("table", *take(count), 0)
+                continue
+
+            if stripped.startswith("|"):
+                count = 1
+                while i + count < len(lines) and lines[i + count].strip().startswith("|"):
+                    count += 1
+                yield ("table", *take(count), 0)
+                continue
+
+            if IMAGE_PATTERN.match(stripped):
+                # 图片与紧随其后的图注（Figure/Table/图/表 开头的段落）合为一个块
+                count = 1
+                next_index = i + 1
+                while next_index < len(lines) and not lines[next_index].strip():
+                    next_index += 1
+                if next_index < len(lines) and CAPTION_PATTERN.match(lines[next_index]):
+                    count = next_index - i + 1
+                    while i + count < len(lines) and lines[i + count].strip() and not self._is_block_start(lines[i + count]):
+                        count += 1
+                yield ("image", *take(count), 0)
+                continue
+
+            # 普通段落：连续的非空行，直到空行或下一个结构块
+            count = 1
+            while i + count < len(lines) and lines[i + count].strip() and not self._is_block_start(lines[i + count]):
+                count += 1
+            yield ("paragraph", *take(count), 0)
+
+    @staticmethod
+    def _is_block_start(line: str) -> bool:
+        """判断一行是否开始一个新的结构块"""
+        stripped = line.strip()
+        return bool(
+            HEADING_PATTERN.match(stripped)
+            or stripped.startswith("$$")
+            or stripped.lower().startswith("<table")
+            or stripped.startswith("|")
+            or IMAGE_PATTERN.match(stripped)
+        )
+
+    def _split_text(self, text: str) -> List[Tuple[int, int, str]]:
+        """
+        将文本组装为分块
+
+        返回：
+            [(起始偏移, 结束偏移, 章节路径), ...]
+        """
+        chunks = []
+        section_stack: List[Tuple[int, str]] = []
+        chunk_start: Optional[int] = None
+        chunk_end = 0
+        chunk_tokens = 0
+        chunk_section = ""
+
+        def flush() -> None:
+            nonlocal chunk_start, chunk_tokens
+            if chunk_start is not None:
+                chunks.append((chunk_start, chunk_end, chunk_section))
+            chunk_start, chunk_tokens = None, 0
+
+        for kind, start, end, level in self._iter_blocks(text):
+            block_text = text[start:end]
+
+            if kind == "heading":
+                # 新章节开始：结束当前分块，标题归入下一个分块
+                flush()
+                while section_stack and section_stack[-1][0] >= level:
+                    section_stack.pop()
+                section_stack.append((level, block_text.lstrip("#").strip()))
+
+            section_path = " > ".join(title for _, title in section_stack)
+            block_tokens = self._count_tokens(block_text)
+
+            if kind == "paragraph" and block_tokens > self.chunk_size:
+                # 超长段落按句子切分，每一段单独成块；
+                # 第一段放得下时与当前分块（通常只有章节标题）合并
+                search_from = start
+                for piece in self._fallback_splitter.split_text(block_text):
+                    piece_start = text.find(piece, search_from, end)
+                    if piece_start < 0:
+                        piece_start = search_from
+                    piece_end = min(piece_start + len(piece), end)
+                    if chunk_start is not None and chunk_tokens + self._count_tokens(piece) <= self.chunk_size:
+                        chunks.append((chunk_start, piece_end, chunk_section))
+                        chunk_start, chunk_tokens = None, 0
+                    else:
+                        flush()
+                        chunks.append((piece_start, piece_end, section_path))
+                    search_from = piece_end
+                continue
+
+            if chunk_start is not None and chunk_tokens + block_tokens > self.chunk_size:
+                flush()
+
+            if chunk_start is None:
+                chunk_start = start
+                chunk_section = section_path
+            chunk_end = end
+            chunk_tokens += block_tokens
+
+        flush()
+        return chunks
+
+    def _parse_nodes(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> List[BaseNode]:
+        all_nodes: List[BaseNode] = []
+
+        for node in nodes:
+            text = node.get_content(metadata_mode=MetadataMode.NONE)
+            for start, end, section_path in self._split_text(text):
+                chunk_text = text[start:end]
+                if not chunk_text.strip():
+                    continue
+
+                chunk = TextNode(
+                    text=chunk_text,
+                    metadata={
+                        **node.metadata,
+                        "section_path": section_path,
+                        "char_start": start,
+                        "char_end": end,
+                    },
+                    excluded_embed_metadata_keys=node.excluded_embed_metadata_keys + OFFSET_METADATA_KEYS,
+                    excluded_llm_metadata_keys=node.excluded_llm_metadata_keys + OFFSET_METADATA_KEYS,
+                    start_char_idx=start,
+                    end_char_idx=end,
+                )
+                chunk.relationships[NodeRelationship.SOURCE] = node.as_related_node_info()
+                all_nodes.append(chunk)
+
+        return all_nodes
@@ -0,0 +1,402 @@
+import os
+import sys
+import time
+import signal
+import secrets
+import argparse
+import tempfile
+import threading
+import subprocess
+from multiprocessing.connection import Client, Listener
+from typing import Any, Dict, Optional, Tuple
+
+from src.auth import get_system_config
+
+
+# 默认配置（可通过 db/system_config.json 覆盖）
+DEFAULT_WORKER_PORT = 8765
+DEFAULT_WORKER_BACKEND = "magic_pdf"
+DEFAULT_CONDA_ENV = "mineru"
+# 等待工作进程启动（加载模型）的最长时间
+DEFAULT_STARTUP_TIMEOUT = 180
+
+WORKER_BACKENDS = ("magic_pdf", "stub")
+
+# 所有应用进程共享同一个工作进程，连接密钥和工作进程的进程ID保存在文件中
+AUTHKEY_PATH = os.path.join("db", "mineru_worker.key")
+PID_PATH = os.path.join("db", "mineru_worker.pid")
+
+PING_TIMEOUT = 5
+# 任务超过其超时时间再加上该宽限时间仍未结束，视为工作进程卡死
+BUSY_GRACE_SECONDS = 30
+
+
+def _load_authkey() -> bytes:
+    """读取连接密钥，不存在时生成"""
+    if not os.path.exists(AUTHKEY_PATH):
+        os.makedirs(os.path.dirname(AUTHKEY_PATH), exist_ok=True)
+        # 先写入临时文件（权限 0600），再以硬链接放到目标位置：读取方不会看到未写完的文件，
+        # 多个进程同时生成时只有第一个生效，其余进程读取已有的密钥
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(AUTHKEY_PATH))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+            os.link(temp_path, AUTHKEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(AUTHKEY_PATH, "r") as f:
+        return f.read().strip().encode("ascii")
+
+
+# ---------------------------------------------------------------------------
+# 转换后端（在工作进程中运行）
+# ---------------------------------------------------------------------------
+
+class MagicPdfBackend:
+    """在进程内调用 magic-pdf，模型只在启动时加载一次"""
+
+    name = "magic_pdf"
+
+    def __init__(self):
+        from magic_pdf.tools.common import do_parse
+        self._do_parse = do_parse
+
+        # 预先加载版面分析模型，后续任务直接复用
+        try:
+            from magic_pdf.model.doc_analyze_by_custom_model import ModelSingleton
+            ModelSingleton().get_model(False, False)
+        except Exception as e:
+            print(f"预加载 magic-pdf 模型失败，将在第一个任务时加载: {str(e)}")
+
+    def convert(self, pdf_path: str, output_dir: str, method: str) -> str:
+        pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+        # 与命令行相同的输出结构：{output_dir}/{pdf_name}/{method}/
+        self._do_parse(output_dir, pdf_name, pdf_bytes, [], method)
+        return os.path.join(output_dir, pdf_name, method)
+
+
+class StubBackend:
+    """测试用后端：不解析PDF，只生成符合 magic-pdf 输出结构的 markdown"""
+
+    name = "stub"
+
+    def convert(self, pdf_path: str, output_dir: str, method: str) -> str:
+        pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        result_dir = os.path.join(output_dir, pdf_name, method)
+        os.makedirs(os.path.join(result_dir, "images"), exist_ok=True)
+        with open(os.path.join(result_dir, f"{pdf_name}.md"), "w", encoding="utf-8") as f:
+            f.write(f"# {pdf_name}\n\n{os.path.getsize(pdf_path)} bytes\n")
+        return result_dir
+
+
+def create_backend(name: str):
+    """创建转换后端"""
+    if name == "magic_pdf":
+        return MagicPdfBackend()
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"不支持的转换后端: {name}")
+
+
+# ---------------------------------------------------------------------------
+# 工作进程
+# ---------------------------------------------------------------------------
+
+class _WorkerState:
+    """工作进程当前任务的状态，健康检查时一并返回"""
+
+    def __init__(self):
+        self.convert_lock = threading.Lock()
+        self.busy_job: Optional[str] = None
+        self.busy_since: Optional[float] = None
+        self.busy_deadline: Optional[float] = None
+
+def _handle_connection(conn, backend, state: _WorkerState) -> None:
+    """处理一个连接上的请求"""
+    with conn:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+
+        op = request.get("op")
+        if op == "ping":
+            conn.send({
+                "ok": True,
+                "backend": backend.name,
+                "pid": os.getpid(),
+                "busy_job": state.busy_job,
+                "busy_since": state.busy_since,
+                "busy_deadline": state.busy_deadline,
+            })
+        elif op == "convert":
+            try:
+                # 模型占用大量显存/内存，任务依次执行
+                with state.convert_lock:
+                    state.busy_job = request.get("job_id")
+                    state.busy_since = time.time()
+                    state.busy_deadline = state.busy_since + request.get("timeout", 0)
+                    try:
+                        result_dir = backend.convert(request["pdf_path"], request["output_dir"], request.get("method", "auto"))
+                    finally:
+                        state.busy_job = state.busy_since = state.busy_deadline = None
+                conn.send({"ok": True, "result_dir": result_dir})
+            except Exception as e:
+                conn.send({"ok": False, "error": str(e)})
+        else:
+            conn.send({"ok": False, "error": f"不支持的请求: {op}"})
+
+def serve(port: int, backend_name: str) -> None:
+    """
+    工作进程主循环：加载后端后为每个连接启动一个线程处理请求，转换任务依次执行，健康检查随时响应
+
+    请求：{"op": "ping"} 或 {"op": "convert", "job_id": ..., "pdf_path": ..., "output_dir": ..., "method": "auto", "timeout": 秒}
+    响应：{"ok": True, ...} 或 {"ok": False, "error": 错误信息}
+    """
+    backend = create_backend(backend_name)
+    state = _WorkerState()
+
+    with Listener(("127.0.0.1", port), authkey=_load_authkey()) as listener:
+        # 绑定端口成功后才记录进程ID，任何应用进程都可以据此结束卡死的工作进程
+        with open(PID_PATH, "w") as f:
+            f.write(str(os.getpid()))
+        print(f"MinerU 工作进程已启动: 127.0.0.1:{port} (后端 {backend.name}, 进程 {os.getpid()})")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"接受连接失败: {str(e)}")
+                continue
+            threading.Thread(target=_handle_connection, args=(conn, backend, state), daemon=True).start()
+
+
+# ---------------------------------------------------------------------------
+# 客户端（在应用进程中运行）
+# ---------------------------------------------------------------------------
+
+class MinerUWorkerClient:
+    """连接常驻的 MinerU 工作进程，工作进程不存在或无响应时启动/重启"""
+
+    def __init__(self, port: int, backend: str, conda_env: str):
+        self.port = port
+        self.backend = backend
+        self.conda_env = conda_env
+        self._authkey = _load_authkey()
+        self._process: Optional[subprocess.Popen] = None
+        # 工作进程一次只处理一个任务，同一应用进程内的请求依次发送
+        self._lock = threading.Lock()
+
+    def _request(self, request: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        with Client(("127.0.0.1", self.port), authkey=self._authkey) as conn:
+            conn.send(request)
+            if not conn.poll(timeout):
+                raise TimeoutError(f"工作进程在 {timeout:.0f} 秒内没有响应")
+            return conn.recv()
+
+    def _convert_request(self, request: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """
+        发送转换请求并等待结果
+
+        工作进程一次只执行一个任务，其他应用进程提交的任务正在执行时，本任务在工作进程中排队：
+        只要对方任务未超过其截止时间，就按对方的截止时间顺延等待，本任务开始后再按自身的超时时间计算
+        """
+        with Client(("127.0.0.1", self.port), authkey=self._authkey) as conn:
+            conn.send(request)
+            wait_until = time.time() + timeout
+            idle_checks = 0
+            while not conn.poll(max(wait_until - time.time(), 0)):
+                status = self.status()
+                if status is None:
+                    raise TimeoutError("工作进程没有响应")
+                idle_checks = idle_checks + 1 if status.get("busy_job") is None else 0
+                if status.get("busy_job") == request["job_id"]:
+                    if time.time() > status["busy_deadline"]:
+                        raise TimeoutError(f"工作进程在 {timeout:.0f} 秒内没有完成转换")
+                    wait_until = status["busy_deadline"]
+                elif status.get("busy_job") is not None and time.time() <= status["busy_deadline"] + BUSY_GRACE_SECONDS:
+                    # 排在其他任务之后，等到对方任务结束后本任务才开始
+                    wait_until = status["busy_deadline"] + BUSY_GRACE_SECONDS + timeout
+                elif status.get("busy_job") is not None:
+                    # 本任务还没有开始，不算转换失败，由调用方改用命令行处理
+                    raise RuntimeError("工作进程上的其他任务超时未结束")
+                elif idle_checks < 3:
+                    # 工作进程空闲（本任务刚好完成或即将开始），再等一个检查周期
+                    wait_until = time.time() + PING_TIMEOUT
+                else:
+                    raise TimeoutError("工作进程空闲，但没有返回本任务的结果")
+            return conn.recv()
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        """获取工作进程状态（进程ID、当前任务开始时间和截止时间），无响应时返回None"""
+        try:
+            response = self._request({"op": "ping"}, PING_TIMEOUT)
+        except Exception:
+            return None
+        return response if response.get("ok") else None
+
+    def ping(self) -> bool:
+        """健康检查：工作进程能在短时间内响应，且当前任务没有超过截止时间"""
+        status = self.status()
+        if status is None:
+            return False
+        deadline = status.get("busy_deadline")
+        if deadline is not None and time.time() > deadline + BUSY_GRACE_SECONDS:
+            print(f"MinerU 工作进程的任务已运行 {time.time() - status['busy_since']:.0f} 秒，超过超时时间")
+            return False
+        return True
+
+    def _start(self) -> None:
+        """启动工作进程并等待其可以响应"""
+        if self.backend == "stub":
+            cmd = [sys.executable, "-m", "src.mineru_worker"]
+        else:
+            cmd = ["conda", "run", "--no-capture-output", "-n", self.conda_env, "python", "-m", "src.mineru_worker"]
+        cmd += ["--port", str(self.port), "--backend", self.backend]
+
+        print(f"启动 MinerU 工作进程: {' '.join(cmd)}")
+        # 独立的进程组，重启时可以连同 conda run 启动的子进程一起结束
+        self._process = subprocess.Popen(cmd, start_new_session=True)
+
+        deadline = time.time() + (get_system_config("mineru_worker_startup_timeout") or DEFAULT_STARTUP_TIMEOUT)
+        while time.time() < deadline:
+            if self.ping():
+                return
+            if self._process.poll() is not None:
+                # 端口被占用时可能是其他应用进程刚启动了工作进程
+                time.sleep(1)
+                if self.ping():
+                    self._process = None
+                    return
+                raise RuntimeError(f"MinerU 工作进程启动失败，退出码 {self._process.returncode}")
+            time.sleep(1)
+
+        self._stop()
+        raise RuntimeError("MinerU 工作进程启动超时")
+
+    def _stop(self) -> None:
+        """结束工作进程（无论由哪个进程启动）"""
+        if self._process is not None and self._process.poll() is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGTERM)
+                self._process.wait(timeout=10)
+            except (ProcessLookupError, subprocess.TimeoutExpired):
+                os.killpg(self._process.pid, signal.SIGKILL)
+        self._process = None
+
+        # 其他应用进程或手动启动的工作进程：按健康检查返回的或记录在文件中的进程ID结束
+        status = self.status()
+        pid = status.get("pid") if status else _read_worker_pid()
+        if pid:
+            _kill_worker(pid)
+
+    def ensure_running(self) -> None:
+        """确保工作进程可用，无响应时重启"""
+        if self.ping():
+            return
+        self._stop()
+        self._start()
+
+    def convert(self, pdf_path: str, output_dir: str, timeout: float, method: str = "auto") -> Tuple[bool, str]:
+        """
+        在工作进程中转换PDF
+
+        参数：
+            pdf_path: PDF文件路径
+            output_dir: 输出目录
+            timeout: 超时时间（秒）
+            method: 解析方法
+
+        返回：
+            (成功状态, 结果目录或错误消息)；工作进程无法启动或卡在其他任务上（本任务未开始）时
+            抛出 RuntimeError，调用方改用命令行处理
+        """
+        with self._lock:
+            self.ensure_running()
+            job_id = secrets.token_hex(8)
+            try:
+                response = self._convert_request({
+                    "op": "convert",
+                    "job_id": job_id,
+                    "pdf_path": os.path.abspath(pdf_path),
+                    "output_dir": os.path.abspath(output_dir),
+                    "method": method,
+                    "timeout": timeout,
+                }, timeout)
+            except (TimeoutError, EOFError, ConnectionError) as e:
+                # 任务超时或工作进程崩溃：重启，避免后续任务卡在同一个进程上
+                self._stop()
+                return False, f"MinerU 工作进程出错: {str(e)}"
+            except RuntimeError:
+                # 工作进程卡在其他任务上：重启后交给调用方改用命令行处理
+                self._stop()
+                raise
+
+        if not response.get("ok"):
+            return False, response.get("error", "未知错误")
+        return True, response["result_dir"]
+
+
+def _read_worker_pid() -> Optional[int]:
+    """读取工作进程记录的进程ID"""
+    try:
+        with open(PID_PATH, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def _kill_worker(pid: int) -> None:
+    """结束工作进程，先确认该进程ID仍属于工作进程（进程ID可能已被复用）"""
+    if os.path.isdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if b"src.mineru_worker" not in f.read():
+                    return
+        except OSError:
+            # 进程已退出
+            return
+
+    print(f"结束 MinerU 工作进程: {pid}")
+    try:
+        os.kill(pid, signal.SIGTERM)
+        for _ in range(10):
+            time.sleep(1)
+            os.kill(pid, 0)
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+_client: Optional[MinerUWorkerClient] = None
+_client_lock = threading.Lock()
+
+def is_worker_enabled() -> bool:
+    """是否通过常驻工作进程转换PDF"""
+    return bool(get_system_config("mineru_worker_enabled"))
+
+def get_worker_client() -> MinerUWorkerClient:
+    """获取进程级的工作进程客户端"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            backend = get_system_config("mineru_worker_backend") or DEFAULT_WORKER_BACKEND
+            if backend not in WORKER_BACKENDS:
+                raise ValueError(f"不支持的转换后端: {backend}")
+            _client = MinerUWorkerClient(
+                port=get_system_config("mineru_worker_port") or DEFAULT_WORKER_PORT,
+                backend=backend,
+                conda_env=get_system_config("mineru_worker_conda_env") or DEFAULT_CONDA_ENV,
+            )
+        return _client
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="常驻的 MinerU 转换工作进程")
+    parser.add_argument("--port", type=int, default=DEFAULT_WORKER_PORT, help="监听端口（只监听本机）")
+    parser.add_argument("--backend", choices=WORKER_BACKENDS, default=DEFAULT_WORKER_BACKEND, help="转换后端")
+    args = parser.parse_args()
+
+    serve(args.port, args.backend)
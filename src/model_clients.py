@@ -0,0 +1,106 @@
+import os
+import threading
+from typing import Any, Dict
+
+import httpx
+from dotenv import load_dotenv
+from llama_index.core import Settings
+from llama_index.llms.openai import OpenAI
+from llama_index.embeddings.dashscope import DashScopeEmbedding
+
+from src.auth import get_system_config
+from src.embedding_cache import CachedEmbedding
+
+
+load_dotenv()
+
+# 默认连接池和超时设置（可通过 db/system_config.json 覆盖）
+DEFAULT_HTTP_POOL_SIZE = 20
+DEFAULT_REQUEST_TIMEOUT = 60.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MAX_RETRIES = 3
+
+_clients: Dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client_config() -> Dict[str, Any]:
+    """获取模型客户端的连接池和超时配置"""
+    return {
+        "http_pool_size": get_system_config("llm_http_pool_size") or DEFAULT_HTTP_POOL_SIZE,
+        "request_timeout": get_system_config("llm_request_timeout") or DEFAULT_REQUEST_TIMEOUT,
+        "connect_timeout": get_system_config("llm_connect_timeout") or DEFAULT_CONNECT_TIMEOUT,
+        "max_retries": get_system_config("llm_max_retries") or DEFAULT_MAX_RETRIES,
+    }
+
+def _create_llm() -> OpenAI:
+    """创建语言模型客户端"""
+    # 使用OpenAILike接入第三方中转API
+    # return OpenAILike(
+    #     model="deepseek-v3",
+    #     api_key=os.getenv("OPENAI_API_KEY"),
+    #     api_base=os.getenv("OPENAI_API_BASE"),
+    #     is_chat_model=True,  # 指定是否为聊天模型
+    #     is_function_calling_model=True,  # 指定是否支持函数调用
+    #     # 可以根据模型实际情况设置上下文窗口大小
+    #     context_window=16000,
+    # )
+
+    # return DashScope(
+    #     model="deepseek-v3",
+    #     api_key=os.getenv("ALI_API_KEY"),
+    #     api_base=os.getenv("ALI_API_BASE"),
+    # )
+
+    config = get_client_config()
+
+    # 共享的 keep-alive 连接池，后续请求复用已建立的 TLS 连接
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=config["http_pool_size"],
+            max_keepalive_connections=config["http_pool_size"],
+        ),
+        timeout=httpx.Timeout(config["request_timeout"], connect=config["connect_timeout"]),
+    )
+
+    return OpenAI(
+        model="gpt-4.1-mini",
+        api_key=os.getenv("OPENAI_API_KEY"),
+        api_base=os.getenv("OPENAI_API_BASE"),
+        timeout=config["request_timeout"],
+        max_retries=config["max_retries"],
+        http_client=http_client,
+        reuse_client=True,
+    )
+
+def _create_embed_model() -> CachedEmbedding:
+    """创建嵌入模型客户端（外层包装本地嵌入缓存）"""
+    return CachedEmbedding(DashScopeEmbedding(
+        model="text-embedding-v3",
+        api_key=os.getenv("ALI_API_KEY"),
+        api_base=os.getenv("ALI_API_BASE"),
+    ))
+
+def _get_client(name: str, factory) -> Any:
+    """获取进程内唯一的客户端实例，首次调用时创建"""
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def get_llm() -> OpenAI:
+    """获取进程级共享的语言模型客户端"""
+    return _get_client("llm", _create_llm)
+
+def get_embed_model() -> CachedEmbedding:
+    """获取进程级共享的嵌入模型客户端"""
+    return _get_client("embed_model", _create_embed_model)
+
+def setup_models() -> None:
+    """将共享的模型客户端设置为 llama_index 的全局默认模型"""
+    Settings.llm = get_llm()
+    Settings.embed_model = get_embed_model()
+
+def setup_embed_model() -> None:
+    """只设置全局默认嵌入模型（构建索引时不需要语言模型）"""
+    Settings.embed_model = get_embed_model()
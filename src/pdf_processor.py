@@ -1,18 +1,82 @@
 import os
+import mmap
 import shutil
+import hashlib
 import subprocess
 import datetime
 import time
 import streamlit as st
-from typing import Dict, Any, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+from pypdf import PdfReader
 
 from src.utils import update_document_status, save_document_metadata
-from src.auth import get_user_data_path
+from src.auth import get_user_data_path, get_system_config
+
+# 超过该大小的markdown文件使用内存映射读取
+MMAP_THRESHOLD_BYTES = 32 * 1024 * 1024
+
+# 保存上传文件时每次读取、校验和写入的块大小
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# PDF 文件头须出现在文件的前 1024 字节内
+PDF_HEADER = b"%PDF-"
+PDF_HEADER_SEARCH_BYTES = 1024
+
+# PDF转换默认配置（可通过 db/system_config.json 覆盖）
+# 转换超时：不少于 DEFAULT_CONVERT_TIMEOUT 秒，按页数增加
+DEFAULT_CONVERT_TIMEOUT = 300
+DEFAULT_CONVERT_TIMEOUT_PER_PAGE = 3
+# 页数超过阈值时按页码范围分片并行转换（阈值为0表示不分片）
+DEFAULT_SHARD_THRESHOLD_PAGES = 60
+DEFAULT_SHARD_PAGES = 20
+DEFAULT_SHARD_WORKERS = 2
+
+def _stream_pdf_to_file(source: Any, f: Any, max_bytes: int) -> Dict[str, Any]:
+    """
+    分块把上传内容写入文件，同时计算 SHA-256 并校验PDF文件头
+
+    超过大小上限或不是PDF时立即停止读取并抛出 ValueError
+
+    参数：
+        source: 可按块读取的文件对象
+        f: 目标文件
+        max_bytes: 大小上限（字节）
+
+    返回：
+        {"content_hash": 内容哈希, "file_size": 字节数}
+    """
+    hasher = hashlib.sha256()
+    file_size = 0
+
+    while True:
+        chunk = source.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+
+        if file_size == 0 and PDF_HEADER not in chunk[:PDF_HEADER_SEARCH_BYTES]:
+            raise ValueError("文件不是有效的PDF")
+
+        file_size += len(chunk)
+        if file_size > max_bytes:
+            raise ValueError(f"文件大小超过系统限制 ({max_bytes / (1024 * 1024):.0f}MB)")
+
+        hasher.update(chunk)
+        f.write(chunk)
+
+    if file_size == 0:
+        raise ValueError("文件为空")
+
+    return {"content_hash": hasher.hexdigest(), "file_size": file_size}
 
 def save_pdf(user_id: str, uploaded_file: Any, doc_id: str) -> Tuple[bool, str]:
     """
     保存上传的PDF文件到用户特定目录
 
+    按块读取和写入，不会再复制一份完整的文件；超过 max_document_size_mb 或不是PDF时立即停止并删除已写入的部分。
+    Streamlit 上传的文件在调用前已整个缓存在内存中，这里的检查无法避免这一次缓存，
+    上传大小由 .streamlit/config.toml 的 server.maxUploadSize 在读入前限制
+
     参数：
         user_id: 用户ID
         uploaded_file: Streamlit上传的文件对象
@@ -21,7 +85,13 @@ def save_pdf(user_id: str, uploaded_file: Any, doc_id: str) -> Tuple[bool, str]:
     返回：
         （成功状态，文件路径或错误消息）
     """
+    doc_dir = None
     try:
+        max_bytes = (get_system_config("max_document_size_mb") or 50) * 1024 * 1024
+        # 已知大小时无需读取即可拒绝
+        if getattr(uploaded_file, "size", None) and uploaded_file.size > max_bytes:
+            return False, f"文件大小超过系统限制 ({max_bytes / (1024 * 1024):.0f}MB)"
+
         # 获取用户数据目录
         user_data_dir = get_user_data_path(user_id, "data")
 
@@ -29,37 +99,186 @@ def save_pdf(user_id: str, uploaded_file: Any, doc_id: str) -> Tuple[bool, str]:
         doc_dir = os.path.join(user_data_dir, doc_id)
         os.makedirs(doc_dir, exist_ok=True)
 
-        # 保存文件
+        # 保存文件，写入的同时计算内容哈希并校验
         file_path = os.path.join(doc_dir, uploaded_file.name)
+        uploaded_file.seek(0)
         with open(file_path, "wb") as f:
-            # getbuffer() 方法返回上传文件的二进制内存视图(memoryview)对象，
-            # 此方法可以高效地获取文件内容而无需创建额外的内存副本
-            f.write(uploaded_file.getbuffer())
+            upload_info = _stream_pdf_to_file(uploaded_file, f, max_bytes)
+        content_hash = upload_info["content_hash"]
+        # 页面对象可能位于压缩对象流中，无法在写入时逐块统计；写入后读取页面树（只读取交叉引用和页面树，不会再扫描整个文件）
+        page_count = get_pdf_page_count(file_path)
 
         # 更新文档状态和元数据
         metadata = {
             "filename": uploaded_file.name,
             "original_name": uploaded_file.name,
-            "file_size": uploaded_file.size,
+            "file_size": upload_info["file_size"],
+            "page_count": page_count,
             "upload_time": datetime.datetime.now().isoformat(),
             "status": "已上传",
             "indexed": False,
+            "content_hash": content_hash,
         }
         save_document_metadata(user_id, doc_id, metadata)
 
+        # 内容相同的文档共享转换结果和索引
+        from src.content_store import add_reference
+        add_reference(content_hash, user_id, doc_id)
+
         return True, file_path
     
     except Exception as e:
+        # 删除已写入的部分
+        if doc_dir and os.path.isdir(doc_dir):
+            shutil.rmtree(doc_dir, ignore_errors=True)
         return False, str(e)
     
-def process_pdf_with_magic(user_id: str, pdf_path: str, doc_id: str) -> Tuple[bool, str]:
+def get_pdf_page_count(pdf_path: str) -> Optional[int]:
+    """
+    使用 pypdf 读取PDF页数（页面树中的页数，页面对象位于压缩对象流中时同样准确）
+
+    参数：
+        pdf_path: PDF文件路径
+
+    返回：
+        页数，无法读取时返回None（此时不按页数分片）
+    """
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except Exception as e:
+        print(f"读取PDF页数失败: {str(e)}")
+        return None
+
+def get_convert_timeout(page_count: Optional[int]) -> float:
+    """根据页数计算转换超时时间（秒），页数未知时使用默认超时"""
+    per_page = get_system_config("pdf_convert_timeout_per_page") or DEFAULT_CONVERT_TIMEOUT_PER_PAGE
+    return max(DEFAULT_CONVERT_TIMEOUT, (page_count or 0) * per_page)
+
+def _run_magic_pdf_cli(pdf_path: str, doc_output_dir: str, timeout: float,
+                       start_page: Optional[int] = None, end_page: Optional[int] = None) -> Tuple[bool, str]:
+    """
+    通过命令行调用magic-pdf（每次调用都会重新启动解释器并加载模型）
+
+    参数：
+        start_page, end_page: 只转换该页码范围（从0开始，包含结束页；end_page 为None时转换到最后一页）
+
+    返回：
+        （成功状态，错误消息）
+    """
+    # 组装命令
+    cmd = [
+        "conda", "run", "-n", "mineru",
+        "magic-pdf",
+        "-p", pdf_path,
+        "-o", doc_output_dir,
+        "-m", "auto",
+    ]
+    if start_page is not None:
+        cmd += ["-s", str(start_page)]
+    if end_page is not None:
+        cmd += ["-e", str(end_page)]
+
+    # 执行命令
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        text=True,
+        check=False,
+        timeout=timeout,
+    )
+
+    # 检查命令是否成功
+    if result.returncode != 0:
+        return False, result.stderr
+    return True, ""
+
+def _convert_pdf_in_shards(pdf_path: str, doc_output_dir: str, page_count: int,
+                           progress_callback=None) -> Tuple[bool, str]:
+    """
+    按页码范围把PDF分片，并行调用magic-pdf转换，再把各分片的markdown和图片合并到
+    {doc_output_dir}/{pdf_name}/auto/ 下，与整体转换的输出结构相同
+
+    参数：
+        pdf_path: PDF文件路径
+        doc_output_dir: 文档输出目录
+        page_count: PDF页数
+        progress_callback: 进度回调函数
+
+    返回：
+        （成功状态，错误消息）
+    """
+    shard_pages = get_system_config("pdf_shard_pages") or DEFAULT_SHARD_PAGES
+    workers = get_system_config("pdf_shard_workers") or DEFAULT_SHARD_WORKERS
+    # 最后一个分片不指定结束页，即使页数偏少也不会丢失末尾的页面
+    shards = [
+        (start, start + shard_pages - 1 if start + shard_pages < page_count else None)
+        for start in range(0, page_count, shard_pages)
+    ]
+    timeout = get_convert_timeout(shard_pages)
+
+    # 每个分片输出到单独的目录，避免同名输出互相覆盖
+    shards_dir = os.path.join(doc_output_dir, "_shards")
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    shard_dirs = [os.path.join(shards_dir, str(i)) for i in range(len(shards))]
+
+    print(f"PDF共 {page_count} 页，分为 {len(shards)} 个分片，使用 {workers} 个进程并行转换")
+
+    try:
+        errors: List[str] = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_run_magic_pdf_cli, pdf_path, shard_dir, timeout, start, end)
+                for shard_dir, (start, end) in zip(shard_dirs, shards)
+            ]
+            for done, ((start, end), future) in enumerate(zip(shards, futures), 1):
+                try:
+                    success, error = future.result()
+                except subprocess.TimeoutExpired:
+                    success, error = False, f"超过 {timeout:.0f} 秒未完成"
+                if not success:
+                    errors.append(f"第 {start + 1}-{end + 1 if end is not None else '末'} 页: {error}")
+                if progress_callback:
+                    progress_callback(f"已转换 {done}/{len(shards)} 个分片", 10 + 80 * done // len(shards))
+
+        if errors:
+            return False, "\n".join(errors)
+
+        # 合并markdown（按页码顺序）和图片（图片按内容哈希命名，不同分片不会冲突）
+        pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        result_dir = os.path.join(doc_output_dir, pdf_name, "auto")
+        images_dir = os.path.join(result_dir, "images")
+        os.makedirs(images_dir, exist_ok=True)
+
+        parts = []
+        for shard_dir in shard_dirs:
+            shard_result_dir = os.path.join(shard_dir, pdf_name, "auto")
+            with open(os.path.join(shard_result_dir, f"{pdf_name}.md"), "r", encoding="utf-8") as f:
+                parts.append(f.read().strip())
+            shard_images_dir = os.path.join(shard_result_dir, "images")
+            if os.path.isdir(shard_images_dir):
+                shutil.copytree(shard_images_dir, images_dir, dirs_exist_ok=True)
+
+        with open(os.path.join(result_dir, f"{pdf_name}.md"), "w", encoding="utf-8") as f:
+            f.write("\n\n".join(part for part in parts if part) + "\n")
+
+        return True, ""
+
+    finally:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+def process_pdf_with_magic(user_id: str, pdf_path: str, doc_id: str, progress_callback=None) -> Tuple[bool, str]:
     """
     使用magid-pdf处理PDF文件
 
+    页数超过 pdf_shard_threshold_pages 时按页码范围分片并行转换；
+    否则启用常驻工作进程（mineru_worker_enabled）时交给已加载模型的工作进程转换，
+    工作进程无法启动时退回到命令行方式。超时时间随页数增加
+
     参数：
         user_id: 用户ID
         pdf_path: PDF文件路径
         doc_id: 文档ID
+        progress_callback: 进度回调函数（分片转换时报告进度）
 
     返回：
         （成功状态，处理结果或错误消息）
@@ -75,29 +294,32 @@ def process_pdf_with_magic(user_id: str, pdf_path: str, doc_id: str) -> Tuple[bo
 
         # 文件名（不含路径）
         pdf_filename = os.path.basename(pdf_path)
+        # 优先使用上传时记录的页数
+        from src.utils import get_document_metadata
+        page_count = (get_document_metadata(user_id, doc_id) or {}).get("page_count") or get_pdf_page_count(pdf_path)
+        timeout = get_convert_timeout(page_count)
 
-        # 组装命令
-        cmd = [
-            "conda", "run", "-n", "mineru",
-            "magic-pdf",
-            "-p", pdf_path,
-            "-o", doc_output_dir,
-            "-m", "auto",
-        ]
-
-        # 执行命令
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=False,
-            timeout=300,  # 5分钟超时
-        )
-
-        # 检查命令是否成功
-        if result.returncode != 0:
+        converted = False
+        from src.mineru_worker import is_worker_enabled, get_worker_client
+        shard_threshold = get_system_config("pdf_shard_threshold_pages")
+        if shard_threshold is None:
+            shard_threshold = DEFAULT_SHARD_THRESHOLD_PAGES
+        if shard_threshold and page_count is not None and page_count > shard_threshold:
+            success, error = _convert_pdf_in_shards(pdf_path, doc_output_dir, page_count, progress_callback)
+            converted = True
+        elif is_worker_enabled():
+            try:
+                success, error = get_worker_client().convert(pdf_path, doc_output_dir, timeout)
+                converted = True
+            except RuntimeError as e:
+                print(f"MinerU 工作进程不可用，改用命令行处理: {str(e)}")
+
+        if not converted:
+            success, error = _run_magic_pdf_cli(pdf_path, doc_output_dir, timeout)
+
+        if not success:
             update_document_status(user_id, doc_id, "处理失败")
-            return False, f"处理失败: {result.stderr}"
+            return False, f"处理失败: {error}"
         
         # 更新文档状态为处理完成
         update_document_status(user_id, doc_id, "处理完成")
@@ -114,6 +336,111 @@ def process_pdf_with_magic(user_id: str, pdf_path: str, doc_id: str) -> Tuple[bo
         update_document_status(user_id, doc_id, "处理失败")
         return False, str(e)
     
+def convert_document(user_id: str, doc_id: str, progress_callback=None) -> Tuple[bool, str]:
+    """
+    转换已上传的文档（后台任务队列的 "convert" 任务处理函数）
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        progress_callback: 进度回调函数
+
+    返回：
+        （成功状态，处理结果或错误消息）
+    """
+    from src.utils import get_document_metadata
+    metadata = get_document_metadata(user_id, doc_id)
+    if not metadata or not metadata.get("filename"):
+        return False, "文档元数据不存在"
+
+    pdf_path = os.path.join(get_user_data_path(user_id, "data"), doc_id, metadata["filename"])
+    if not os.path.exists(pdf_path):
+        update_document_status(user_id, doc_id, "处理失败")
+        return False, f"PDF文件不存在: {pdf_path}"
+
+    content_hash = metadata.get("content_hash")
+    if not content_hash:
+        if progress_callback:
+            progress_callback("使用magic-pdf处理文件...", 10)
+        success, result = process_pdf_with_magic(user_id, pdf_path, doc_id, progress_callback)
+        if not success:
+            return False, f"处理文件失败: {result}"
+
+    else:
+        from src.content_store import conversion_lock, adopt_converted, mark_converted
+        # 相同内容的文档依次处理，已有转换结果时直接沿用
+        with conversion_lock(content_hash):
+            if adopt_converted(user_id, doc_id):
+                if progress_callback:
+                    progress_callback("已有相同内容的文档，沿用其转换结果", 100)
+                return True, "已有相同内容的文档，直接使用其转换结果"
+
+            if progress_callback:
+                progress_callback("使用magic-pdf处理文件...", 10)
+            success, result = process_pdf_with_magic(user_id, pdf_path, doc_id, progress_callback)
+            if not success:
+                return False, f"处理文件失败: {result}"
+            mark_converted(content_hash, user_id, doc_id, os.path.splitext(metadata["filename"])[0])
+
+    if progress_callback:
+        progress_callback("文件处理完成", 100)
+    return True, f"文件处理完成！结果保存在：{result}"
+
+def get_output_name(metadata: Dict[str, Any]) -> Optional[str]:
+    """
+    获取文档转换结果的文件名（不含扩展名），magic-pdf 的输出位于 {output_dir}/{name}/auto/{name}.md
+
+    沿用相同内容文档的转换结果时，输出文件名是最先转换的文档的文件名，记录在 output_name 中
+    """
+    if metadata.get("output_name"):
+        return metadata["output_name"]
+    if metadata.get("filename"):
+        return os.path.splitext(metadata["filename"])[0]
+    return None
+
+def get_markdown_path(user_id: str, doc_id: str) -> Tuple[bool, str]:
+    """
+    获取处理后的markdown文件路径
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+
+    返回：
+        （成功状态，markdown文件路径或错误消息）
+    """
+    # 获取文档元数据
+    from src.utils import get_document_metadata
+    metadata = get_document_metadata(user_id, doc_id)
+
+    if not metadata:
+        return False, "文档元数据不存在"
+    
+    # 检查文档是否处理完成
+    if metadata.get("status") != "处理完成":
+        return False, f"文档尚未处理完成，当前状态: {metadata.get('status', '未知')}"
+    
+    # 获取输出文件名
+    pdf_name_without_ext = get_output_name(metadata)
+    if not pdf_name_without_ext:
+        return False, "文件名未记录"
+    
+    # 确定markdown文件路径
+    user_output_dir = get_user_data_path(user_id, "output")
+    markdown_path = os.path.join(
+        user_output_dir,
+        doc_id,
+        pdf_name_without_ext,
+        "auto",
+        f"{pdf_name_without_ext}.md"
+    )
+
+    # 检查文件是否存在
+    if not os.path.exists(markdown_path):
+        return False, f"Markdown文件不存在: {markdown_path}"
+    
+    return True, markdown_path
+
 def get_markdown_content(user_id: str, doc_id: str) -> Tuple[bool, str]:
     """
     获取处理后的markdown内容
@@ -126,37 +453,16 @@ def get_markdown_content(user_id: str, doc_id: str) -> Tuple[bool, str]:
         （成功状态，markdown内容或错误消息）
     """
     try:
-        # 获取文档元数据
-        from src.utils import get_document_metadata
-        metadata = get_document_metadata(user_id, doc_id)
-
-        if not metadata:
-            return False, "文档元数据不存在"
-        
-        # 检查文档是否处理完成
-        if metadata.get("status") != "处理完成":
-            return False, f"文档尚未处理完成，当前状态: {metadata.get('status', '未知')}"
-        
-        # 获取PDF文件名
-        pdf_filename = metadata.get("filename")
-        if not pdf_filename:
-            return False, "文件名未记录"
-        
-        # 确定markdown文件路径
-        pdf_name_without_ext = os.path.splitext(pdf_filename)[0]
-        user_output_dir = get_user_data_path(user_id, "output")
-        markdown_path = os.path.join(
-            user_output_dir,
-            doc_id,
-            pdf_name_without_ext,
-            "auto",
-            f"{pdf_name_without_ext}.md"
-        )
-
-        # 检查文件是否存在
-        if not os.path.exists(markdown_path):
-            return False, f"Markdown文件不存在: {markdown_path}"
+        success, markdown_path = get_markdown_path(user_id, doc_id)
+        if not success:
+            return False, markdown_path
         
+        # 超大文件通过内存映射直接解码，避免先读入一份完整的字节副本
+        if os.path.getsize(markdown_path) >= MMAP_THRESHOLD_BYTES:
+            with open(markdown_path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return True, str(memoryview(mm), 'utf-8')
+
         # 读取markdown内容
         with open(markdown_path, 'r', encoding='utf-8') as f:
             content = f.read()
@@ -164,4 +470,4 @@ def get_markdown_content(user_id: str, doc_id: str) -> Tuple[bool, str]:
         return True, content
     
     except Exception as e:
-        return False, str(e)       
+        return False, str(e)
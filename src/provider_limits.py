@@ -0,0 +1,92 @@
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from src.auth import get_system_config
+
+
+# 每个上游服务在单个事件循环中的默认最大并发请求数（可通过 db/system_config.json 覆盖）
+DEFAULT_PROVIDER_CONCURRENCY = {
+    "llm": 8,
+    "embedding": 16,
+}
+
+# 信号量和限速器绑定在创建它们的事件循环上，每个事件循环单独维护一组（事件循环关闭后自动释放）
+_loop_semaphores: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_loop_rate_limiters: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# 命令行等调用方临时指定的每分钟请求数，优先于系统配置
+_rate_limit_overrides: Dict[str, float] = {}
+
+
+class RateLimiter:
+    """按每分钟请求数均匀放行请求的限速器（在单个事件循环内使用）"""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """等待直到可以发出下一个请求"""
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def get_provider_concurrency(provider: str) -> int:
+    """获取上游服务的最大并发请求数，配置键为 {provider}_max_concurrency"""
+    return get_system_config(f"{provider}_max_concurrency") or DEFAULT_PROVIDER_CONCURRENCY.get(provider, 4)
+
+def get_provider_rate_limit(provider: str) -> float:
+    """获取上游服务的每分钟请求数上限，配置键为 {provider}_requests_per_minute，0 表示不限速"""
+    if provider in _rate_limit_overrides:
+        return _rate_limit_overrides[provider]
+    return get_system_config(f"{provider}_requests_per_minute") or 0
+
+def set_provider_rate_limit(provider: str, requests_per_minute: float) -> None:
+    """为当前进程指定上游服务的每分钟请求数上限（覆盖系统配置，之后创建的限速器生效）"""
+    _rate_limit_overrides[provider] = requests_per_minute
+
+def provider_semaphore(provider: str) -> asyncio.Semaphore:
+    """
+    获取当前事件循环中某个上游服务的并发信号量
+
+    参数：
+        provider: 上游服务名称 ("llm" 或 "embedding")
+
+    返回：
+        asyncio.Semaphore 对象
+    """
+    loop = asyncio.get_running_loop()
+    semaphores = _loop_semaphores.setdefault(loop, {})
+    if provider not in semaphores:
+        semaphores[provider] = asyncio.Semaphore(get_provider_concurrency(provider))
+    return semaphores[provider]
+
+def _provider_rate_limiter(provider: str) -> Optional[RateLimiter]:
+    """获取当前事件循环中某个上游服务的限速器，不限速时返回None"""
+    loop = asyncio.get_running_loop()
+    limiters = _loop_rate_limiters.setdefault(loop, {})
+    if provider not in limiters:
+        requests_per_minute = get_provider_rate_limit(provider)
+        limiters[provider] = RateLimiter(requests_per_minute) if requests_per_minute else None
+    return limiters[provider]
+
+@asynccontextmanager
+async def provider_slot(provider: str) -> AsyncIterator[None]:
+    """
+    占用上游服务的一个请求名额：受并发上限约束，并按每分钟请求数限速
+
+    参数：
+        provider: 上游服务名称 ("llm" 或 "embedding")
+    """
+    async with provider_semaphore(provider):
+        limiter = _provider_rate_limiter(provider)
+        if limiter is not None:
+            await limiter.acquire()
+        yield
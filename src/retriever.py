@@ -1,53 +1,128 @@
 import os
 from dotenv import load_dotenv
-from llama_index.core import StorageContext, load_index_from_storage
-from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.schema import QueryBundle
+from llama_index.core.chat_engine import CondensePlusContextChatEngine, ContextChatEngine
 from llama_index.core.base.llms.types import ChatMessage, MessageRole
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.core import Settings
 from llama_index.llms.dashscope import DashScope
-from llama_index.embeddings.dashscope import DashScopeEmbedding
 from llama_index.llms.openai_like import OpenAILike
-from llama_index.llms.openai import OpenAI
-from typing import Tuple, Any, Dict
+from typing import Tuple, Any, Dict, Iterator, Mapping, Optional
 import json
+import hashlib
+import weakref
+import threading
+from collections import Counter
 
-from src.build_index import get_index_storage_path
+from src.build_index import get_index_storage_path, parse_node_number
+from src.engine_cache import load_cached_index
+from src.model_clients import setup_models as _setup_shared_models
+from src.compact_store import CompactIndex, load_persisted_index, is_vector_index
+from src.bm25_index import BM25Index, get_bm25_index_path
+from src.singleflight import SingleFlight
+from src.context_budget import TokenBudgetRetriever, get_chat_mode, get_chat_context_token_budget, get_index_token_count
+from src.auth import get_system_config
 from src.utils import is_document_indexed
 
 
 load_dotenv()
 
+# 向量源文本索引在引用查找时检索的候选分块数
+DEFAULT_SOURCE_SIMILARITY_TOP_K = 8
+
+# 已加载源文本索引的节点编号查找表（索引被缓存淘汰后自动释放）
+_node_lookups: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# 引用查找方式："llm" 由大模型匹配原文；"bm25" 先在本地用 BM25 逐句匹配，匹配不到时再交给大模型
+CITATION_MODES = ("llm", "bm25")
+DEFAULT_CITATION_MODE = "llm"
+
+# 本地引用匹配的结果统计（进程级）：matched 本地匹配成功；fallback 本地未匹配到，回退到大模型；
+# skipped 回答中没有可在本地匹配的句子（如不含英文术语和引用片段的中文回答对英文论文），直接使用大模型
+_citation_stats: Counter = Counter()
+_citation_stats_lock = threading.Lock()
+
+# 合并相同的并发问答和引用查找请求（进程级，所有会话共享）
+_single_flight = SingleFlight()
+
+CHAT_SYSTEM_PROMPT = """你是基于检索增强生成的AI助手，回答用户问题时基于提供的文档内容。
+            如果问题与上下文文档无关，请明确指出："提供的文档中没有关于这个问题的信息。"""
+
 
 def setup_models():
-    """初始化语言模型和嵌入模型"""
-    # 使用OpenAILike接入第三方中转API
-    # Settings.llm = OpenAILike(
-    #     model="deepseek-v3",
-    #     api_key=os.getenv("OPENAI_API_KEY"),
-    #     api_base=os.getenv("OPENAI_API_BASE"),
-    #     is_chat_model=True,  # 指定是否为聊天模型
-    #     is_function_calling_model=True,  # 指定是否支持函数调用
-    #     # 可以根据模型实际情况设置上下文窗口大小
-    #     context_window=16000,
-    # )
-
-    # Settings.llm = DashScope(
-    #     model="deepseek-v3",
-    #     api_key=os.getenv("ALI_API_KEY"),
-    #     api_base=os.getenv("ALI_API_BASE"),
-    # )
-
-    Settings.llm = OpenAI(
-        model="gpt-4.1-mini",
-        api_key=os.getenv("OPENAI_API_KEY"),
-        api_base=os.getenv("OPENAI_API_BASE"),
-    )
+    """初始化语言模型和嵌入模型（使用进程级共享的客户端，复用 HTTP 连接池）"""
+    _setup_shared_models()
+
+def _load_index(user_id: str, doc_id: str, kind: str, persist_dir: str) -> Any:
+    """
+    通过进程级缓存加载持久化的索引，多个会话共享同一份索引对象
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        kind: 索引类型 ("full_text" 或 "source")
+        persist_dir: 索引存储目录
+
+    返回：
+        索引对象
+    """
+    def loader():
+        return load_persisted_index(persist_dir)
+
+    return load_cached_index(user_id, doc_id, kind, persist_dir, loader)
 
-    Settings.embed_model = DashScopeEmbedding(
-        model="text-embedding-v3",
-        api_key=os.getenv("ALI_API_KEY"),
-        api_base=os.getenv("ALI_API_BASE"),
+def _load_bm25_index(user_id: str, doc_id: str, source_dir: str) -> Optional[BM25Index]:
+    """通过进程级缓存加载文档的 BM25 索引，旧索引没有 BM25 文件时返回None"""
+    bm25_path = get_bm25_index_path(source_dir)
+    if not os.path.exists(bm25_path):
+        return None
+    return load_cached_index(user_id, doc_id, "bm25", source_dir, lambda: BM25Index.load(bm25_path))
+
+def _create_chat_engine(user_id: str, doc_id: str, full_text_index: Any, source_dir: str) -> Any:
+    """
+    创建文档的聊天引擎
+
+    预算模式下论文超过 token 预算时，每轮只把与问题最相关的源文本分块放入提示词；
+    其余情况每轮使用全文
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        full_text_index: 全文索引
+        source_dir: 源文本索引存储目录
+
+    返回：
+        聊天引擎
+    """
+    if get_chat_mode() == "budgeted":
+        token_budget = get_chat_context_token_budget()
+        full_text_tokens = get_index_token_count(full_text_index)
+
+        if full_text_tokens > token_budget:
+            source_index = _load_index(user_id, doc_id, "source", source_dir)
+            node_lookup = get_source_node_lookup(source_index)
+            vector_retriever = None
+            if is_vector_index(source_index):
+                vector_retriever = source_index.as_retriever(similarity_top_k=len(node_lookup))
+
+            retriever = TokenBudgetRetriever(
+                node_lookup,
+                token_budget,
+                vector_retriever=vector_retriever,
+                system_prompt=CHAT_SYSTEM_PROMPT,
+            )
+            print(f"论文全文 {full_text_tokens} tokens，超过预算 {token_budget}，按相关度选取分块")
+            chat_engine = ContextChatEngine.from_defaults(retriever=retriever, system_prompt=CHAT_SYSTEM_PROMPT)
+            retriever.history_source = lambda: chat_engine.chat_history
+            return chat_engine
+
+        print(f"论文全文 {full_text_tokens} tokens，未超过预算 {token_budget}，使用全文问答")
+
+    return full_text_index.as_chat_engine(
+        chat_mode="context",
+        system_prompt=CHAT_SYSTEM_PROMPT,
+        verbose=True,
+        streaming=True,
     )
 
 def load_index_for_document(user_id: str, doc_id: str) -> Tuple[bool, Any]:
@@ -74,12 +149,10 @@ def load_index_for_document(user_id: str, doc_id: str) -> Tuple[bool, Any]:
 
         # 加载全文索引
         try:
-            full_text_storage_context = StorageContext.from_defaults(persist_dir=full_text_dir)
-            full_text_index = load_index_from_storage(full_text_storage_context)
+            full_text_index = _load_index(user_id, doc_id, "full_text", full_text_dir)
 
             # 加载源文本索引
-            source_storage_context = StorageContext.from_defaults(persist_dir=source_dir)
-            source_index = load_index_from_storage(source_storage_context)
+            source_index = _load_index(user_id, doc_id, "source", source_dir)
 
             return True, (full_text_index, source_index)
         
@@ -114,17 +187,10 @@ def load_document_engines(user_id: str, doc_id: str, enable_reference: bool = Tr
 
         # 加载全文索引
         try:
-            full_text_storage_context = StorageContext.from_defaults(persist_dir=full_text_dir)
-            full_text_index = load_index_from_storage(full_text_storage_context)
+            full_text_index = _load_index(user_id, doc_id, "full_text", full_text_dir)
             
-            # 创建聊天引擎
-            chat_engine = full_text_index.as_chat_engine(
-                chat_mode="context",
-                system_prompt="""你是基于检索增强生成的AI助手，回答用户问题时基于提供的文档内容。
-            如果问题与上下文文档无关，请明确指出："提供的文档中没有关于这个问题的信息。""",
-                verbose=True,
-                streaming=True,
-            )
+            # 创建聊天引擎（聊天引擎带有会话记忆，每次单独创建，底层索引共享）
+            chat_engine = _create_chat_engine(user_id, doc_id, full_text_index, source_dir)
             
             result_dict = {
                 "full_text_index": full_text_index,
@@ -133,16 +199,29 @@ def load_document_engines(user_id: str, doc_id: str, enable_reference: bool = Tr
             
             # 如果启用引用功能，加载源文本索引
             if enable_reference:
-                source_storage_context = StorageContext.from_defaults(persist_dir=source_dir)
-                source_index = load_index_from_storage(source_storage_context)
+                source_index = _load_index(user_id, doc_id, "source", source_dir)
                 
                 # 创建源文本查询引擎
-                source_query_engine = source_index.as_query_engine()
+                if is_vector_index(source_index):
+                    # 向量索引只把最相关的 top-k 分块交给大模型，引用成本不随论文长度增长
+                    top_k = get_system_config("source_similarity_top_k") or DEFAULT_SOURCE_SIMILARITY_TOP_K
+                    source_query_engine = source_index.as_query_engine(similarity_top_k=top_k)
+                else:
+                    source_query_engine = source_index.as_query_engine()
                 
                 # 添加到结果字典
                 result_dict["source_index"] = source_index
                 result_dict["source_query_engine"] = source_query_engine
 
+                # 加载时预先构建节点编号查找表，引用匹配时按编号直接查表
+                result_dict["source_node_lookup"] = get_source_node_lookup(source_index)
+
+                # 本地引用模式下加载 BM25 索引（旧索引没有 BM25 文件时只使用大模型）
+                if get_citation_mode() == "bm25":
+                    bm25_index = _load_bm25_index(user_id, doc_id, source_dir)
+                    if bm25_index is not None:
+                        result_dict["bm25_index"] = bm25_index
+
             return True, result_dict
         
         except Exception as e:
@@ -151,61 +230,221 @@ def load_document_engines(user_id: str, doc_id: str, enable_reference: bool = Tr
     except Exception as e:
         return False, f"加载文档引擎失败: {str(e)}"
 
-def find_source_references(source_query_engine, response_text: str) -> list:
+def seed_chat_history(chat_engine, question: str, answer: str) -> None:
     """
-    根据回复内容查找源文本参考
+    将一轮问答写入聊天引擎的会话记忆（答案来自缓存、未经过聊天引擎时使用）
+
+    参数：
+        chat_engine: 聊天引擎
+        question: 用户问题
+        answer: 回答内容
+    """
+    memory = getattr(chat_engine, "_memory", None)
+    if memory is None:
+        return
+    memory.put(ChatMessage(role=MessageRole.USER, content=question))
+    memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+def _chat_history_hash(chat_engine) -> str:
+    """计算聊天引擎当前会话记忆的哈希，只有对话上下文相同的请求才会被合并"""
+    history = getattr(chat_engine, "chat_history", None) or []
+    serialized = json.dumps(
+        [(str(message.role), message.content or "") for message in history], ensure_ascii=False
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+def stream_chat_shared(chat_engine, doc_key: str, question: str) -> Iterator[str]:
+    """
+    流式问答，同一文档、相同对话上下文的相同问题同时到达时只调用一次大模型，回答片段分发给所有请求
+
+    参数：
+        chat_engine: 当前会话的聊天引擎
+        doc_key: 文档内容标识（get_content_key，内容相同的文档共享）
+        question: 用户问题
+
+    返回：
+        回答片段迭代器
+    """
+    key = ("chat", doc_key, _chat_history_hash(chat_engine), question)
+    tokens, leader = _single_flight.stream(key, lambda: chat_engine.stream_chat(question).response_gen)
+
+    def generate():
+        parts = []
+        for token in tokens:
+            parts.append(token)
+            yield token
+        # 共享他人调用的回答时，本会话的聊天引擎没有经过这一轮，需要补写会话记忆
+        if not leader:
+            seed_chat_history(chat_engine, question, "".join(parts))
+
+    return generate()
+
+def find_source_references_shared(doc_key: str, source_query_engine, response_text: str, bm25_index=None) -> list:
+    """
+    查找源文本参考，同一文档的相同回答同时查找时只执行一次
 
     参数：
+        doc_key: 文档内容标识（get_content_key，内容相同的文档共享）
         source_query_engine: 源文本查询引擎
         response_text: 回复内容
+        bm25_index: 文档的 BM25 索引
 
     返回：
         源文本参考列表（节点编号）
     """
+    key = ("citation", doc_key, hashlib.sha256(response_text.encode("utf-8")).hexdigest())
+    source_list = _single_flight.do(
+        key, lambda: find_source_references_with_fallback(source_query_engine, response_text, bm25_index)
+    )
+    return list(source_list)
+
+def get_single_flight_stats() -> Dict[str, int]:
+    """获取请求合并的统计信息"""
+    return _single_flight.stats()
+
+def get_citation_mode() -> str:
+    """获取系统配置的引用查找方式"""
+    mode = get_system_config("citation_mode") or DEFAULT_CITATION_MODE
+    if mode not in CITATION_MODES:
+        raise ValueError(f"不支持的引用查找方式: {mode}")
+    return mode
+
+def get_citation_stats() -> Dict[str, Any]:
+    """获取本地引用匹配的统计信息（回退率为未能在本地匹配、交给大模型的比例）"""
+    with _citation_stats_lock:
+        matched, fallback, skipped = _citation_stats["matched"], _citation_stats["fallback"], _citation_stats["skipped"]
+    total = matched + fallback + skipped
+    return {
+        "matched": matched,
+        "fallback": fallback,
+        "skipped": skipped,
+        "fallback_rate": (fallback + skipped) / total if total else 0.0,
+    }
+
+def record_citation_result(outcome: str) -> None:
+    """记录一次本地引用匹配的结果 ("matched"、"fallback" 或 "skipped")"""
+    with _citation_stats_lock:
+        _citation_stats[outcome] += 1
+
+def match_source_references_locally(bm25_index: BM25Index, response_text: str) -> list:
+    """
+    用 BM25 索引在本地逐句匹配源文本参考，并记录匹配结果
+
+    参数：
+        bm25_index: 文档的 BM25 索引
+        response_text: 回复内容
+
+    返回：
+        源文本参考列表（节点编号），未匹配到时返回空列表
+    """
+    source_list = []
     try:
-        # 构建查询提示词
-        query_prompt = f"""作为一个智能文档助手，请帮我分析用户陈述的内容在原文中是否有相关依据。请找出原文中支持或反驳这些陈述的段落，并按照JSON格式返回结果（只需要给出该段落的node_number和前10个单词即可），格式为：{{"node34":"Relevant content in English...", "node27":"Relevant content in English...", "node19":"Relevant content in English...", "node27":"Relevant content in English..."}}。如果不同句子的前几个单词属于同一个node，或者不同位置的前几个单词相同，那么node_number和片段都可以重复出现。如果找不到相关内容，请返回空JSON对象 {{}}。
+        if not bm25_index.has_matchable_text(response_text):
+            outcome = "skipped"
+        else:
+            source_list = bm25_index.match_references(response_text)
+            outcome = "matched" if source_list else "fallback"
+    except Exception as e:
+        print(f"本地匹配源文本参考失败: {str(e)}")
+        outcome = "fallback"
+
+    record_citation_result(outcome)
+    return source_list
+
+def find_source_references_with_fallback(source_query_engine, response_text: str, bm25_index=None) -> list:
+    """
+    查找源文本参考：有 BM25 索引时先在本地逐句匹配，匹配不到时再调用大模型
+
+    参数：
+        source_query_engine: 源文本查询引擎
+        response_text: 回复内容
+        bm25_index: 文档的 BM25 索引，为None时直接使用大模型
+
+    返回：
+        源文本参考列表（节点编号）
+    """
+    if bm25_index is not None:
+        source_list = match_source_references_locally(bm25_index, response_text)
+        if source_list:
+            return source_list
+
+    return find_source_references(source_query_engine, response_text)
+
+def build_source_query(response_text: str) -> QueryBundle:
+    """
+    构建查找源文本参考的查询
+
+    参数：
+        response_text: 回复内容
+
+    返回：
+        查询对象（向量索引按回复内容检索候选分块，而不是按整个提示词）
+    """
+    query_prompt = f"""作为一个智能文档助手，请帮我分析用户陈述的内容在原文中是否有相关依据。请找出原文中支持或反驳这些陈述的段落，并按照JSON格式返回结果（只需要给出该段落的node_number和前10个单词即可），格式为：{{"node34":"Relevant content in English...", "node27":"Relevant content in English...", "node19":"Relevant content in English...", "node27":"Relevant content in English..."}}。如果不同句子的前几个单词属于同一个node，或者不同位置的前几个单词相同，那么node_number和片段都可以重复出现。如果找不到相关内容，请返回空JSON对象 {{}}。
 
 用户陈述：
 
 {response_text}
 """
+    return QueryBundle(query_str=query_prompt, custom_embedding_strs=[response_text])
+
+def parse_source_references(response_text: str) -> list:
+    """
+    从大模型的回复中解析源文本参考
+
+    参数：
+        response_text: 大模型返回的内容（包含JSON对象）
+
+    返回：
+        源文本参考列表（节点编号）
+    """
+    try:
+        # 查找第一个 { 和最后一个 } 的位置
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
         
-        # 查询源文本
-        source_response = source_query_engine.query(query_prompt)
-        print("source_response: ", source_response)
-        
-        # 尝试解析JSON响应
-        try:
-            # 提取响应中的JSON部分
-            response_text = source_response.response
-            # 查找第一个 { 和最后一个 } 的位置
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = response_text[start_idx:end_idx]
-                source_json = json.loads(json_str)
+        if start_idx >= 0 and end_idx > start_idx:
+            json_str = response_text[start_idx:end_idx]
+            source_json = json.loads(json_str)
+            # 返回节点编号列表，而不是值列表
+            source_list = list(source_json.keys())
+            print("source_list: ", source_list)
+            return source_list
+        else:
+            return []
+    except json.JSONDecodeError:
+        # 如果JSON解析失败，尝试使用正则表达式提取
+        import re
+        json_pattern = r'\{.*\}'
+        match = re.search(json_pattern, response_text, re.DOTALL)
+        if match:
+            try:
+                source_json = json.loads(match.group(0))
                 # 返回节点编号列表，而不是值列表
                 source_list = list(source_json.keys())
-                print("source_list: ", source_list)
                 return source_list
-            else:
+            except:
                 return []
-        except json.JSONDecodeError:
-            # 如果JSON解析失败，尝试使用正则表达式提取
-            import re
-            json_pattern = r'\{.*\}'
-            match = re.search(json_pattern, response_text, re.DOTALL)
-            if match:
-                try:
-                    source_json = json.loads(match.group(0))
-                    # 返回节点编号列表，而不是值列表
-                    source_list = list(source_json.keys())
-                    return source_list
-                except:
-                    return []
-            return []
+        return []
+
+def find_source_references(source_query_engine, response_text: str) -> list:
+    """
+    根据回复内容查找源文本参考
+
+    参数：
+        source_query_engine: 源文本查询引擎
+        response_text: 回复内容
+
+    返回：
+        源文本参考列表（节点编号）
+    """
+    try:
+        # 查询源文本
+        source_response = source_query_engine.query(build_source_query(response_text))
+        print("source_response: ", source_response)
+        
+        # 解析JSON响应
+        return parse_source_references(source_response.response)
     
     except Exception as e:
         print(f"查找源文本参考失败: {str(e)}")
@@ -228,42 +467,74 @@ def get_source_nodes_from_index(source_index):
         print(f"获取源文本节点失败: {str(e)}")
         return []
 
-def match_source_references(source_list: list, source_nodes: list) -> list:
+def get_source_node_lookup(source_index) -> Mapping[int, Any]:
+    """
+    获取源文本索引的 node_number → 节点 查找表，每个加载的索引只构建一次
+
+    参数：
+        source_index: 源文本索引
+
+    返回：
+        {整数节点编号: 节点}
+    """
+    try:
+        return _node_lookups[source_index]
+    except KeyError:
+        pass
+
+    if isinstance(source_index, CompactIndex):
+        # 紧凑格式的索引按元数据列建立编号映射，节点在被引用时才创建
+        lookup = source_index.docstore.node_lookup(parse_node_number)
+        _node_lookups[source_index] = lookup
+        return lookup
+
+    lookup = {}
+    for node in get_source_nodes_from_index(source_index):
+        number = parse_node_number(node.metadata.get("node_number", ""))
+        if number is not None:
+            lookup.setdefault(number, node)
+
+    _node_lookups[source_index] = lookup
+    return lookup
+
+def match_source_references(source_list: list, source_nodes) -> list:
     """
     匹配源列表中的节点编号与节点metadata中的node_number
     
     参数：
-        source_list: 包含节点编号的列表 (例如 ["node12", "node34"])
-        source_nodes: 包含节点对象的列表
+        source_list: 包含节点编号的列表 (例如 [12, 34] 或大模型返回的 ["node12", "node34"])
+        source_nodes: get_source_node_lookup 返回的查找表，或包含节点对象的列表
         
     返回：
         包含匹配结果的列表，每个结果是一个字典，包含source_item和node_text
     """
+    # 传入节点列表时先构建查找表
+    if not isinstance(source_nodes, Mapping):
+        source_nodes = {
+            parse_node_number(node.metadata.get("node_number", "")): node
+            for node in reversed(list(source_nodes))
+            if hasattr(node, "metadata")
+        }
+
     # 创建一个列表存储匹配结果
     matching_results = []
     # 用于去重的集合，存储已经添加的node_text
     added_texts = set()
     
-    # 遍历 source_list 中的每一个节点编号
+    # 遍历 source_list 中的每一个节点编号，直接查表
     for node_id in source_list:
-        if not node_id:
+        number = parse_node_number(node_id) if node_id else None
+        node = source_nodes.get(number) if number is not None else None
+        if node is None:
             continue
-            
-        # 对于每个节点编号，检查它是否存在于任何 source_nodes 的 metadata.node_number 中
-        for node in source_nodes:
-            if (hasattr(node, 'metadata') and 
-                'node_number' in node.metadata and 
-                node.metadata['node_number'] == node_id):
-                
-                # 如果该节点的文本还未添加过，则添加到结果中
-                if node.text not in added_texts:
-                    matching_results.append({
-                        "source_item": node_id,
-                        "node_text": node.text
-                    })
-                    # 将文本添加到已添加集合中
-                    added_texts.add(node.text)
-                    # 找到匹配后可以跳出内层循环
-                    break
+
+        # 如果该节点的文本还未添加过，则添加到结果中
+        if node.text not in added_texts:
+            matching_results.append({
+                "source_item": node_id,
+                "node_text": node.text
+            })
+            # 将文本添加到已添加集合中
+            added_texts.add(node.text)
     
     return matching_results
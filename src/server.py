@@ -0,0 +1,224 @@
+import json
+import base64
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, task_id
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+from src.auth import authenticate_user
+from src.utils import get_user_documents, get_document_metadata, is_document_indexed
+from src.retriever import get_source_node_lookup, match_source_references
+from src.async_retriever import aload_document_engines, astream_chat, afind_source_references
+from src.answer_cache import get_cached_answer, save_cached_answer
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """接口基类：HTTP Basic 认证，错误以JSON返回"""
+
+    def get_current_user(self) -> Optional[str]:
+        header = self.request.headers.get("Authorization", "")
+        if not header.startswith("Basic "):
+            return None
+        try:
+            username, _, password = base64.b64decode(header[6:]).decode("utf-8").partition(":")
+        except (ValueError, UnicodeDecodeError):
+            return None
+        success, user_id = authenticate_user(username, password)
+        return user_id if success else None
+
+    def prepare(self) -> None:
+        if self.current_user is None:
+            self.set_header("WWW-Authenticate", 'Basic realm="ask_paper"')
+            raise tornado.web.HTTPError(401, "用户名或密码错误")
+
+    def write_error(self, status_code: int, **kwargs: Any) -> None:
+        # 错误信息放在 log_message 中（状态行只能使用 ASCII 字符）
+        exception = kwargs.get("exc_info", (None, None, None))[1]
+        message = exception.log_message if isinstance(exception, tornado.web.HTTPError) else None
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(json.dumps({"error": message or self._reason}, ensure_ascii=False))
+
+    def write_json(self, data: Any) -> None:
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(json.dumps(data, ensure_ascii=False))
+
+    def get_json_body(self) -> Dict[str, Any]:
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, "请求体不是有效的JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "请求体必须是JSON对象")
+        return body
+
+    async def load_engines(self, doc_id: str, enable_reference: bool) -> Dict[str, Any]:
+        """加载当前用户某个文档的问答引擎，文档不存在时返回404，尚未索引时返回409"""
+        if not get_document_metadata(self.current_user, doc_id):
+            raise tornado.web.HTTPError(404, "文档不存在")
+        if not is_document_indexed(self.current_user, doc_id):
+            raise tornado.web.HTTPError(409, "文档尚未索引")
+
+        success, result = await aload_document_engines(self.current_user, doc_id, enable_reference)
+        if not success:
+            raise tornado.web.HTTPError(500, result)
+        return result
+
+
+async def resolve_references(engines: Dict[str, Any], answer: str) -> List[Dict[str, Any]]:
+    """查找回答的源文本参考，返回 [{"source_item": 节点编号, "node_text": 原文}, ...]"""
+    if "source_query_engine" not in engines:
+        return []
+    source_list = await afind_source_references(
+        engines["source_query_engine"], answer, engines.get("bm25_index")
+    )
+    return match_source_references(source_list, get_source_node_lookup(engines["source_index"]))
+
+def parse_chat_history(history: Any) -> List[ChatMessage]:
+    """将请求中的对话历史 [{"role": "user"|"assistant", "content": ...}] 转换为聊天消息"""
+    if not isinstance(history, list):
+        raise tornado.web.HTTPError(400, "history 必须是列表")
+
+    messages = []
+    for item in history:
+        role = item.get("role") if isinstance(item, dict) else None
+        if role not in ("user", "assistant"):
+            raise tornado.web.HTTPError(400, "history 中的 role 只能是 user 或 assistant")
+        messages.append(ChatMessage(role=MessageRole(role), content=str(item.get("content", ""))))
+    return messages
+
+
+class DocumentsHandler(BaseHandler):
+    """GET /api/documents：列出当前用户已索引的文档"""
+
+    async def get(self) -> None:
+        documents = await asyncio.to_thread(get_user_documents, self.current_user)
+        self.write_json({
+            "documents": [
+                {
+                    "doc_id": doc["doc_id"],
+                    "filename": doc.get("filename"),
+                    "upload_time": doc.get("upload_time"),
+                    "index_time": doc.get("index_time"),
+                }
+                for doc in documents
+                if doc.get("indexed")
+            ]
+        })
+
+
+class AskHandler(BaseHandler):
+    """
+    POST /api/documents/{doc_id}/ask：提问，以 server-sent events 流式返回回答
+
+    请求体：{"question": 问题, "history": 之前的对话, "references": 是否返回参考}
+    事件：token（回答片段）、references（源文本参考）、done（完整回答）、error
+    接口不保存会话，多轮对话由调用方在 history 中传入
+    """
+
+    async def send_event(self, event: str, data: Dict[str, Any]) -> None:
+        self.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n")
+        await self.flush()
+
+    async def post(self, doc_id: str) -> None:
+        body = self.get_json_body()
+        question = str(body.get("question", "")).strip()
+        if not question:
+            raise tornado.web.HTTPError(400, "question 不能为空")
+        history = parse_chat_history(body.get("history", []))
+        enable_reference = bool(body.get("references", True))
+
+        engines = await self.load_engines(doc_id, enable_reference)
+
+        self.set_header("Content-Type", "text/event-stream; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        # 关闭反向代理的响应缓冲，片段到达后立即转发
+        self.set_header("X-Accel-Buffering", "no")
+
+        try:
+            # 只有对话的第一个问题使用答案缓存（后续问题的回答依赖对话上下文）
+            cached_answer = None
+            if not history:
+                cached_answer = await asyncio.to_thread(get_cached_answer, self.current_user, doc_id, question)
+
+            if cached_answer:
+                answer = cached_answer["answer"]
+                await self.send_event("token", {"text": answer})
+            else:
+                parts = []
+                async for token in astream_chat(engines["chat_engine"], question, history):
+                    parts.append(token)
+                    await self.send_event("token", {"text": token})
+                answer = "".join(parts)
+
+            references = None
+            if enable_reference:
+                if cached_answer and cached_answer["references"] is not None:
+                    references = cached_answer["references"]
+                else:
+                    references = await resolve_references(engines, answer)
+                await self.send_event("references", {"references": references})
+
+            if not history and not cached_answer:
+                await asyncio.to_thread(
+                    save_cached_answer, self.current_user, doc_id, question, answer, references
+                )
+
+            await self.send_event("done", {"answer": answer})
+
+        except StreamClosedError:
+            # 客户端已断开
+            return
+        except Exception as e:
+            await self.send_event("error", {"error": f"处理问题时出错：{str(e)}"})
+
+        self.finish()
+
+
+class ReferencesHandler(BaseHandler):
+    """POST /api/documents/{doc_id}/references：查找回答的源文本参考，请求体 {"answer": 回答}"""
+
+    async def post(self, doc_id: str) -> None:
+        body = self.get_json_body()
+        answer = str(body.get("answer", "")).strip()
+        if not answer:
+            raise tornado.web.HTTPError(400, "answer 不能为空")
+
+        engines = await self.load_engines(doc_id, True)
+        self.write_json({"references": await resolve_references(engines, answer)})
+
+
+def make_app() -> tornado.web.Application:
+    """创建问答服务应用"""
+    return tornado.web.Application([
+        (r"/api/documents", DocumentsHandler),
+        (r"/api/documents/([\w-]+)/ask", AskHandler),
+        (r"/api/documents/([\w-]+)/references", ReferencesHandler),
+    ])
+
+async def serve(sockets) -> None:
+    server = HTTPServer(make_app())
+    server.add_sockets(sockets)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="论文问答 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8600, help="监听端口")
+    parser.add_argument("--workers", type=int, default=1, help="工作进程数（0 表示与CPU核数相同）")
+    args = parser.parse_args()
+
+    # 先绑定端口再创建工作进程，所有进程共享同一个监听套接字；
+    # 索引缓存、模型客户端等在每个进程中首次使用时创建
+    sockets = bind_sockets(args.port, address=args.host)
+    if args.workers != 1:
+        fork_processes(args.workers)
+
+    print(f"问答服务已启动: http://{args.host}:{args.port} (进程 {task_id() or 0})")
+    asyncio.run(serve(sockets))
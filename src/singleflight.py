@@ -0,0 +1,136 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+
+class _Flight:
+    """一次进行中的上游调用，保存结果或已产生的流式片段"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tokens: List[Any] = []
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求：同一个键同时只有一个上游调用，其余请求等待并共享其结果
+
+    只合并正在进行中的调用，调用结束后同一个键的新请求会重新调用上游
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def _join(self, key: Hashable) -> Tuple[_Flight, bool]:
+        """获取键对应的进行中调用，不存在时创建，返回 (调用, 是否为发起者)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            self.calls += 1
+            return flight, True
+
+    def _finish(self, key: Hashable, flight: _Flight) -> None:
+        """结束调用并唤醒所有等待者"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.condition:
+            flight.done = True
+            flight.condition.notify_all()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        执行上游调用，相同键的并发请求共享同一次调用的结果
+
+        参数：
+            key: 请求键
+            fn: 上游调用的无参函数
+
+        返回：
+            上游调用的结果（上游出错时所有等待者都会收到同一个异常）
+        """
+        flight, leader = self._join(key)
+
+        if leader:
+            try:
+                flight.result = fn()
+            except Exception as e:
+                flight.error = e
+            finally:
+                self._finish(key, flight)
+        else:
+            with flight.condition:
+                flight.condition.wait_for(lambda: flight.done)
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stream(self, key: Hashable, fn: Callable[[], Iterable[Any]]) -> Tuple[Iterator[Any], bool]:
+        """
+        执行流式上游调用，相同键的并发请求共享同一个流，每个请求都从头收到全部片段
+
+        上游在后台线程中读取，发起请求的会话中断时其他等待者仍能收到完整的流
+
+        参数：
+            key: 请求键
+            fn: 返回片段迭代器的无参函数
+
+        返回：
+            (片段迭代器, 是否为发起者)
+        """
+        flight, leader = self._join(key)
+
+        if leader:
+            threading.Thread(target=self._run_stream, args=(key, flight, fn), daemon=True).start()
+
+        return self._follow(flight), leader
+
+    def _run_stream(self, key: Hashable, flight: _Flight, fn: Callable[[], Iterable[Any]]) -> None:
+        """在后台线程中读取上游流，并把每个片段分发给所有等待者"""
+        try:
+            for token in fn():
+                with flight.condition:
+                    flight.tokens.append(token)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            self._finish(key, flight)
+
+    @staticmethod
+    def _follow(flight: _Flight) -> Iterator[Any]:
+        """按顺序产出流式调用的片段，直到上游结束"""
+        position = 0
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(lambda: len(flight.tokens) > position or flight.done)
+                new_tokens = flight.tokens[position:]
+                finished = flight.done and position + len(new_tokens) == len(flight.tokens)
+
+            yield from new_tokens
+            position += len(new_tokens)
+
+            if finished:
+                break
+
+        if flight.error is not None:
+            raise flight.error
+
+    def stats(self) -> Dict[str, int]:
+        """获取合并统计信息"""
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
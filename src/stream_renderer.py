@@ -0,0 +1,94 @@
+import time
+from typing import Any, Dict
+
+from src.auth import get_system_config
+
+
+# 默认帧预算（可通过 db/system_config.json 覆盖）
+DEFAULT_FRAME_INTERVAL_MS = 50
+DEFAULT_FRAME_MAX_CHARS = 400
+
+CURSOR = "▌"
+
+
+class StreamRenderer:
+    """
+    流式回答的渲染器：把回答片段按时间和字数预算合并成帧再刷新到页面
+
+    每次刷新都要重新渲染整段 markdown，逐片段刷新时渲染开销随回答长度平方增长；
+    按帧刷新后刷新次数只取决于生成耗时。帧间隔至少是上一帧渲染耗时的两倍，
+    渲染变慢时自动降低刷新频率，保证大部分时间用于接收模型输出
+    """
+
+    def __init__(self, placeholder: Any, frame_interval_ms: int = None, frame_max_chars: int = None):
+        self.placeholder = placeholder
+        self.frame_interval = (
+            frame_interval_ms or get_system_config("stream_frame_interval_ms") or DEFAULT_FRAME_INTERVAL_MS
+        ) / 1000
+        self.frame_max_chars = frame_max_chars or get_system_config("stream_frame_max_chars") or DEFAULT_FRAME_MAX_CHARS
+
+        self._parts = []
+        self._pending_chars = 0
+        self._started_at = time.perf_counter()
+        self._last_frame_at = 0.0
+        self._last_render_cost = 0.0
+
+        self.frames = 0
+        self.tokens = 0
+        self.render_seconds = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def append(self, token: str) -> None:
+        """追加一个回答片段，达到帧预算时刷新页面"""
+        self._parts.append(token)
+        self._pending_chars += len(token)
+        self.tokens += 1
+
+        # 两帧之间至少留出上一帧渲染耗时的两倍，未刷新内容较多时可提前到这个下限
+        min_interval = self._last_render_cost * 2
+        elapsed = time.perf_counter() - self._last_frame_at
+        if elapsed >= max(self.frame_interval, min_interval) or (
+            self._pending_chars >= self.frame_max_chars and elapsed >= min_interval
+        ):
+            self._render(self.text + CURSOR)
+
+    def _render(self, content: str) -> None:
+        """渲染一帧并记录耗时"""
+        started = time.perf_counter()
+        self.placeholder.markdown(content)
+        finished = time.perf_counter()
+
+        self._last_render_cost = finished - started
+        self._last_frame_at = finished
+        self._pending_chars = 0
+        self.render_seconds += self._last_render_cost
+        self.frames += 1
+
+    def finish(self) -> str:
+        """
+        渲染完整回答（去掉光标）并输出渲染统计
+
+        返回：
+            完整回答
+        """
+        text = self.text
+        self._render(text)
+
+        stats = self.stats()
+        print(
+            f"流式渲染: {stats['tokens']} 个片段, {stats['frames']} 帧, "
+            f"渲染耗时 {stats['render_seconds']:.3f}s / 总耗时 {stats['total_seconds']:.3f}s"
+        )
+        return text
+
+    def stats(self) -> Dict[str, Any]:
+        """获取渲染统计信息"""
+        return {
+            "tokens": self.tokens,
+            "frames": self.frames,
+            "render_seconds": self.render_seconds,
+            "total_seconds": time.perf_counter() - self._started_at,
+        }
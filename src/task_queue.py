@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import uuid
+import queue
+import datetime
+import threading
+from typing import ContextManager, Dict, Any, Optional, List, Tuple, Callable
+
+from src.auth import get_system_config
+from src.file_lock import file_lock
+
+
+# 任务数据文件路径；多个进程（网页、问答服务、命令行）共用，读改写期间持有文件锁
+TASK_DB_PATH = os.path.join("db", "tasks.json")
+TASK_LOCK_PATH = os.path.join("db", "tasks.lock")
+
+# 任务状态
+TASK_QUEUED = "queued"
+TASK_RUNNING = "running"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+
+TASK_STATUS_LABELS = {
+    TASK_QUEUED: "排队中",
+    TASK_RUNNING: "运行中",
+    TASK_DONE: "已完成",
+    TASK_FAILED: "失败",
+}
+
+# 最多保留的已结束任务记录数
+MAX_FINISHED_TASKS = 200
+
+# 每个进程定期刷新自己排队和运行中任务的心跳；所属进程已退出或心跳超时的任务由其他进程接管
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+
+_slot_condition = threading.Condition()
+_running_count = 0
+_pending: "queue.Queue[str]" = queue.Queue()
+_dispatcher: Optional[threading.Thread] = None
+_dispatcher_lock = threading.Lock()
+
+
+def _db_lock() -> ContextManager[bool]:
+    """任务数据的进程间锁（不可重入）"""
+    return file_lock(TASK_LOCK_PATH)
+
+def _load_tasks() -> Dict[str, Any]:
+    """加载任务数据"""
+    if not os.path.exists(TASK_DB_PATH):
+        return {}
+
+    with open(TASK_DB_PATH, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def _save_tasks(tasks: Dict[str, Any]) -> None:
+    """保存任务数据，只保留最近的已结束任务"""
+    finished = sorted(
+        (t for t in tasks.values() if t["status"] in (TASK_DONE, TASK_FAILED)),
+        key=lambda t: t.get("finished_at") or "",
+    )
+    for task in finished[:-MAX_FINISHED_TASKS]:
+        del tasks[task["task_id"]]
+
+    os.makedirs(os.path.dirname(TASK_DB_PATH), exist_ok=True)
+    temp_path = TASK_DB_PATH + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(tasks, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, TASK_DB_PATH)
+
+def _update_task(task_id: str, **fields: Any) -> None:
+    """更新任务记录中的字段"""
+    with _db_lock():
+        tasks = _load_tasks()
+        if task_id in tasks:
+            tasks[task_id].update(fields)
+            _save_tasks(tasks)
+
+def _get_task_handler(kind: str) -> Callable[..., Tuple[bool, str]]:
+    """
+    获取任务类型对应的处理函数（延迟导入，避免循环依赖）
+
+    参数：
+        kind: 任务类型
+
+    返回：
+        处理函数，签名为 (user_id, doc_id, progress_callback, **kwargs) -> (成功状态, 消息)
+    """
+    if kind == "build_index":
+        from src.build_index import build_index_for_document
+        return build_index_for_document
+    if kind == "convert":
+        from src.pdf_processor import convert_document
+        return convert_document
+
+    raise ValueError(f"不支持的任务类型: {kind}")
+
+def _get_max_concurrent_tasks() -> int:
+    """获取系统配置的最大并发任务数"""
+    return max(1, get_system_config("max_concurrent_tasks") or 1)
+
+def _run_task(task_id: str) -> None:
+    """在工作线程中执行任务"""
+    global _running_count
+    try:
+        # 检查和标记运行在同一次加锁内完成，已被其他进程接管的任务不再执行
+        with _db_lock():
+            tasks = _load_tasks()
+            task = tasks.get(task_id)
+            if not task or task["status"] != TASK_QUEUED or task.get("owner_pid") != os.getpid():
+                return
+            task["status"] = TASK_RUNNING
+            task["started_at"] = datetime.datetime.now().isoformat()
+            task["heartbeat_at"] = time.time()
+            _save_tasks(tasks)
+
+        def progress_callback(message: str, percent: int) -> None:
+            _update_task(task_id, message=message, progress=percent)
+
+        try:
+            handler = _get_task_handler(task["kind"])
+            success, message = handler(task["user_id"], task["doc_id"], progress_callback, **task.get("kwargs", {}))
+        except Exception as e:
+            success, message = False, f"任务执行出错: {str(e)}"
+
+        _update_task(
+            task_id,
+            status=TASK_DONE if success else TASK_FAILED,
+            message=message,
+            progress=100 if success else task.get("progress", 0),
+            finished_at=datetime.datetime.now().isoformat(),
+        )
+
+    finally:
+        with _slot_condition:
+            _running_count -= 1
+            _slot_condition.notify_all()
+
+def _dispatch_loop() -> None:
+    """按提交顺序取出任务，并发数达到上限时等待空闲名额"""
+    global _running_count
+    while True:
+        task_id = _pending.get()
+        with _slot_condition:
+            # 每次都重新读取配置，管理员修改并发数后立即生效
+            while _running_count >= _get_max_concurrent_tasks():
+                _slot_condition.wait(timeout=5)
+            _running_count += 1
+
+        threading.Thread(target=_run_task, args=(task_id,), name=f"task-{task_id[:8]}", daemon=True).start()
+
+def _is_owner_alive(task: Dict[str, Any], recovering: bool = False) -> bool:
+    """判断任务所属进程是否仍在处理该任务"""
+    owner_pid = task.get("owner_pid")
+    if owner_pid is None or time.time() - task.get("heartbeat_at", 0) > HEARTBEAT_TIMEOUT:
+        return False
+    if owner_pid == os.getpid():
+        # 本进程刚启动时，记录在本进程ID名下的任务来自此前使用相同ID的已退出进程
+        return not recovering
+    try:
+        os.kill(owner_pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _reclaim_orphaned_tasks(recovering: bool = False) -> None:
+    """接管所属进程已退出或心跳超时的未完成任务，重新排队到本进程"""
+    with _db_lock():
+        tasks = _load_tasks()
+        orphaned = sorted(
+            (t for t in tasks.values()
+             if t["status"] in (TASK_QUEUED, TASK_RUNNING) and not _is_owner_alive(t, recovering)),
+            key=lambda t: t["created_at"],
+        )
+        for task in orphaned:
+            task["status"] = TASK_QUEUED
+            task["owner_pid"] = os.getpid()
+            task["heartbeat_at"] = time.time()
+        if orphaned:
+            _save_tasks(tasks)
+
+    for task in orphaned:
+        print(f"接管未完成的任务: {task['task_id']} ({task['kind']})")
+        _pending.put(task["task_id"])
+
+def _heartbeat_loop() -> None:
+    """定期刷新本进程任务的心跳，并接管其他已退出进程的任务"""
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            with _db_lock():
+                tasks = _load_tasks()
+                owned = [
+                    t for t in tasks.values()
+                    if t["status"] in (TASK_QUEUED, TASK_RUNNING) and t.get("owner_pid") == os.getpid()
+                ]
+                for task in owned:
+                    task["heartbeat_at"] = time.time()
+                if owned:
+                    _save_tasks(tasks)
+
+            _reclaim_orphaned_tasks()
+        except Exception as e:
+            print(f"刷新任务心跳失败: {str(e)}")
+
+def _ensure_dispatcher() -> None:
+    """启动调度线程和心跳线程，并接管已退出进程未完成的任务（其他进程正在处理的任务不受影响）"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            return
+
+        _reclaim_orphaned_tasks(recovering=True)
+
+        _dispatcher = threading.Thread(target=_dispatch_loop, name="task-dispatcher", daemon=True)
+        _dispatcher.start()
+        threading.Thread(target=_heartbeat_loop, name="task-heartbeat", daemon=True).start()
+
+def submit_task(kind: str, user_id: str, doc_id: str, **kwargs: Any) -> str:
+    """
+    提交后台任务，同一文档的同类任务未结束时直接返回已有任务
+
+    参数：
+        kind: 任务类型 ("convert" 或 "build_index")
+        user_id: 用户ID
+        doc_id: 文档ID
+        **kwargs: 传给处理函数的额外参数（需可JSON序列化）
+
+    返回：
+        任务ID
+    """
+    _ensure_dispatcher()
+
+    with _db_lock():
+        tasks = _load_tasks()
+        for task in tasks.values():
+            if (task["kind"], task["user_id"], task["doc_id"]) == (kind, user_id, doc_id) \
+                    and task["status"] in (TASK_QUEUED, TASK_RUNNING):
+                return task["task_id"]
+
+        task_id = str(uuid.uuid4())
+        tasks[task_id] = {
+            "task_id": task_id,
+            "kind": kind,
+            "user_id": user_id,
+            "doc_id": doc_id,
+            "kwargs": kwargs,
+            "status": TASK_QUEUED,
+            "message": "等待执行",
+            "progress": 0,
+            "created_at": datetime.datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "owner_pid": os.getpid(),
+            "heartbeat_at": time.time(),
+        }
+        _save_tasks(tasks)
+
+    _pending.put(task_id)
+    return task_id
+
+def get_task(task_id: str) -> Optional[Dict[str, Any]]:
+    """
+    获取任务记录
+
+    参数：
+        task_id: 任务ID
+
+    返回：
+        任务记录或None
+    """
+    with _db_lock():
+        return _load_tasks().get(task_id)
+
+def get_document_task(user_id: str, doc_id: str, kind: str) -> Optional[Dict[str, Any]]:
+    """
+    获取文档最近一次提交的指定类型任务
+
+    参数：
+        user_id: 用户ID
+        doc_id: 文档ID
+        kind: 任务类型
+
+    返回：
+        任务记录或None
+    """
+    with _db_lock():
+        tasks = [
+            t for t in _load_tasks().values()
+            if (t["kind"], t["user_id"], t["doc_id"]) == (kind, user_id, doc_id)
+        ]
+    if not tasks:
+        return None
+    return max(tasks, key=lambda t: t["created_at"])
+
+def list_tasks(user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    列出任务记录（最新的在前）
+
+    参数：
+        user_id: 只列出该用户的任务，为None时列出全部
+
+    返回：
+        任务记录列表
+    """
+    with _db_lock():
+        tasks = list(_load_tasks().values())
+    if user_id is not None:
+        tasks = [t for t in tasks if t["user_id"] == user_id]
+    tasks.sort(key=lambda t: t["created_at"], reverse=True)
+    return tasks
+
+def is_task_active(task: Optional[Dict[str, Any]]) -> bool:
+    """判断任务是否仍在排队或运行"""
+    return bool(task) and task["status"] in (TASK_QUEUED, TASK_RUNNING)
@@ -7,6 +7,15 @@ import shutil
 from typing import Dict, Any, Optional, List, Tuple
 
 
+# 判断是否处于 Streamlit 会话中
+def _has_streamlit_session() -> bool:
+    """判断当前线程是否运行在 Streamlit 会话中（后台任务线程和命令行中没有会话状态）"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return False
+    return get_script_run_ctx(suppress_warning=True) is not None
+
 # 文档 ID 生成
 def generate_document_id() -> str:
     """生成唯一的文档ID"""
@@ -55,13 +64,14 @@ def update_document_status(user_id: str, doc_id: str, status: str) -> None:
     metadata["updated_at"] = datetime.datetime.now().isoformat()
     
     # 更新会话状态
-    if "documents" not in st.session_state:
-        st.session_state.documents = {}
-    
-    if user_id not in st.session_state.documents:
-        st.session_state.documents[user_id] = {}
-    
-    st.session_state.documents[user_id][doc_id] = metadata
+    if _has_streamlit_session():
+        if "documents" not in st.session_state:
+            st.session_state.documents = {}
+        
+        if user_id not in st.session_state.documents:
+            st.session_state.documents[user_id] = {}
+        
+        st.session_state.documents[user_id][doc_id] = metadata
     
     # 保存更新后的完整元数据
     save_document_metadata(user_id, doc_id, metadata)
@@ -174,6 +184,27 @@ def is_document_processed(user_id: str, doc_id: str) -> bool:
     
     return metadata.get("status") == "处理完成"
 
+# 可以构建索引的文档状态：转换已完成，或上次索引构建失败（转换结果仍在，可以重试）
+INDEXABLE_STATUSES = ("处理完成", "索引构建失败")
+
+def is_document_indexable(user_id: str, doc_id: str) -> bool:
+    """
+    检查文档是否可以构建索引
+    
+    参数:
+        user_id: 用户ID
+        doc_id: 文档ID
+        
+    返回:
+        是否可以构建索引
+    """
+    metadata = get_document_metadata(user_id, doc_id)
+    
+    if not metadata:
+        return False
+    
+    return metadata.get("status") in INDEXABLE_STATUSES
+
 # 检查文档是否已建索引
 def is_document_indexed(user_id: str, doc_id: str) -> bool:
     """
@@ -233,6 +264,11 @@ def delete_document(user_id: str, doc_id: str) -> Tuple[bool, str]:
         if not metadata:
             return False, "文档不存在"
         
+        # 输出和索引目录是共享存储的链接时移除链接，最后一个引用移除时删除共享存储
+        if metadata.get("content_hash"):
+            from src.content_store import release_reference
+            release_reference(metadata["content_hash"], user_id, doc_id)
+
         # 删除文档相关的所有数据
         paths_to_delete = []
         
@@ -254,17 +290,22 @@ def delete_document(user_id: str, doc_id: str) -> Tuple[bool, str]:
         # 执行删除
         for path in paths_to_delete:
             shutil.rmtree(path)
+
+        # 释放进程级缓存中的索引
+        from src.engine_cache import invalidate_document_cache
+        invalidate_document_cache(user_id, doc_id)
         
-        # 从会话状态中移除文档（如果存在）
-        if "documents" in st.session_state and user_id in st.session_state.documents:
-            if doc_id in st.session_state.documents[user_id]:
-                del st.session_state.documents[user_id][doc_id]
-        
-        # 如果当前正在查看这个文档，清除查看状态
-        if "current_doc_id" in st.session_state and st.session_state.current_doc_id == doc_id:
-            if "current_content" in st.session_state:
-                del st.session_state.current_content
-            del st.session_state.current_doc_id
+        if _has_streamlit_session():
+            # 从会话状态中移除文档（如果存在）
+            if "documents" in st.session_state and user_id in st.session_state.documents:
+                if doc_id in st.session_state.documents[user_id]:
+                    del st.session_state.documents[user_id][doc_id]
+            
+            # 如果当前正在查看这个文档，清除查看状态
+            if "current_doc_id" in st.session_state and st.session_state.current_doc_id == doc_id:
+                if "current_content" in st.session_state:
+                    del st.session_state.current_content
+                del st.session_state.current_doc_id
         
         return True, "文档删除成功"
     